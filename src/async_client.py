@@ -0,0 +1,404 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Optional
+
+import requests
+
+import deadline
+import http_session
+import metrics
+import rest_session
+
+log = logging.getLogger()
+
+
+class Engine(object):
+    """
+    runs coroutines which call the Deep Security APIs on an event loop in a background thread,
+    so that synchronous code, such as the resource providers, can drive them with `run` and `map`.
+
+    The HTTP calls themselves are made by the shared session on a fixed pool of `max_workers`
+    threads, so that they share its connection pool, retries, rate limiter and deadline, and
+    no thread is created per call.
+    """
+
+    def __init__(self, max_workers: int = 32):
+        super(Engine, self).__init__()
+        self.max_workers = max_workers
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self.lock:
+            if self.loop is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix="async-client",
+                    initializer=self._mark_worker,
+                )
+                self.loop = asyncio.new_event_loop()
+                self.loop.set_default_executor(self.executor)
+                self.thread = threading.Thread(
+                    target=self.loop.run_forever, name="async-client-loop", daemon=True
+                )
+                self.thread.start()
+            return self.loop
+
+    def _mark_worker(self):
+        self.local.worker = True
+
+    @property
+    def in_engine(self) -> bool:
+        """
+        returns true if the current thread is the loop or one of the workers of the engine.
+        """
+        return getattr(self.local, "worker", False) or (
+            self.thread is not None and threading.current_thread() is self.thread
+        )
+
+    def run(self, coroutine: Awaitable):
+        """
+        runs `coroutine` to completion and returns its result.
+        """
+        if self.in_engine:
+            coroutine.close()
+            raise RuntimeError("cannot wait for a coroutine inside the async client")
+        return self.submit(coroutine).result()
+
+    def submit(self, coroutine: Awaitable) -> Future:
+        """
+        schedules `coroutine` on the engine, and returns a future of its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start())
+
+    async def call(self, function: Callable, *args, **kwargs):
+        """
+        calls the blocking `function` on a worker thread.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(function, *args, **kwargs)
+        )
+
+    async def gather(
+        self, function: Callable, items: list, max_concurrency: int
+    ) -> list:
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def call(item):
+            async with semaphore:
+                return await self.call(function, item)
+
+        return await asyncio.gather(*[call(item) for item in items])
+
+    def map(self, function: Callable, items: list, max_concurrency: int = 8) -> list:
+        """
+        returns the results of the blocking `function` for all `items`, with at most
+        `max_concurrency` calls in flight. Close to the deadline, or when called from inside the
+        engine, the items are processed one by one on the calling thread.
+        """
+        max_concurrency = deadline.current.workers(
+            max_concurrency, http_session.session().timeout
+        )
+        if len(items) < 2 or max_concurrency < 2 or self.in_engine:
+            return [function(item) for item in items]
+        return self.run(self.gather(function, items, max_concurrency))
+
+
+engine = Engine(int(os.getenv("ASYNC_MAX_WORKERS", "32")))
+
+
+def run(coroutine: Awaitable):
+    """
+    runs `coroutine` on the shared engine, and returns its result.
+    """
+    return engine.run(coroutine)
+
+
+def map(function: Callable, items: list, max_concurrency: int = 8) -> list:
+    """
+    returns the results of `function` for all `items`, executed concurrently on the shared engine.
+    """
+    return engine.map(function, items, max_concurrency)
+
+
+class Pager(object):
+    """
+    the searches for the pages of objects matching `search`, ordered by ID: each next page
+    starts after the ID of the last object of the previous one.
+    """
+
+    def __init__(self, search: dict = None, page_size: int = 1000, descending=False):
+        super(Pager, self).__init__()
+        self.page_size = page_size
+        self.search = dict(search) if search else {}
+        self.criteria = list(self.search.get("searchCriteria", []))
+        self.search.update({"maxItems": page_size, "sortByObjectID": True})
+        if descending:
+            self.search["sortDescending"] = True
+        self.cursor = "less-than" if descending else "greater-than"
+
+    def advance(self, page: List[dict]) -> bool:
+        """
+        returns true if there may be a page after `page`, and updates the search for it.
+        """
+        if len(page) < self.page_size or "ID" not in page[-1]:
+            return False
+        self.search["searchCriteria"] = self.criteria + [
+            {"fieldName": "ID", "idTest": self.cursor, "idValue": page[-1]["ID"]}
+        ]
+        return True
+
+
+class Client(object):
+    """
+    a client of a Deep Security API at `api_endpoint`. `call` blocks until the response
+    arrives; the coroutine `request` runs it on the engine, with at most `max_concurrency`
+    requests in flight.
+    """
+
+    timer = "AsyncApi"
+
+    def __init__(self, api_endpoint: str, max_concurrency: int = 8):
+        super(Client, self).__init__()
+        self.api_endpoint = api_endpoint
+        self.max_concurrency = max_concurrency
+        self.lock = threading.Lock()
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def call(self, method: str, path: str, **kwargs) -> requests.Response:
+        raise NotImplementedError()
+
+    async def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        async with self.semaphore:
+            with metrics.timer(self.timer):
+                return await engine.call(self.call, method, path, **kwargs)
+
+
+class ApiClient(Client):
+    """
+    a client of the Deep Security /api. The coroutines `request`, `search` and `search_pages`
+    run on the engine, with at most `max_concurrency` requests in flight. `find` and `find_all`
+    are their blocking equivalents, for code which already runs on a worker thread, such as
+    the lookups of the template substitutor.
+    """
+
+    def __init__(
+        self,
+        api_endpoint: str,
+        api_key: str,
+        api_version: str = "v1",
+        max_concurrency: int = 8,
+        refresh_api_key: Callable[[], str] = None,
+    ):
+        super(ApiClient, self).__init__(api_endpoint, max_concurrency)
+        self.headers = {"api-secret-key": api_key, "api-version": api_version}
+        self.refresh_api_key = refresh_api_key
+
+    def call(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        calls `path` of the api on the shared session, and blocks until the response arrives.
+        If the API key is rejected, it is refreshed with `refresh_api_key` and the call is
+        retried once. Concurrent calls which are rejected share a single refresh.
+        """
+        headers = self.headers
+        response = http_session.session().request(
+            method, f"{self.api_endpoint}/{path}", headers=headers, **kwargs
+        )
+        if response.status_code not in (401, 403) or not self.refresh_api_key:
+            return response
+
+        with self.lock:
+            if self.headers is headers:
+                self.headers = dict(headers)
+                self.headers["api-secret-key"] = self.refresh_api_key()
+        if self.headers["api-secret-key"] == headers["api-secret-key"]:
+            return response
+
+        log.info("retrying with refreshed api key")
+        metrics.add("ApiKeyRefreshes")
+        return http_session.session().request(
+            method, f"{self.api_endpoint}/{path}", headers=self.headers, **kwargs
+        )
+
+    @staticmethod
+    def plural(name: str) -> str:
+        return f"{name[0:-1]}ies" if name[-1] == "y" else f"{name}s"
+
+    def search_path(self, ds_type: str) -> str:
+        return f"{self.plural(ds_type).lower()}/search"
+
+    def search_result(
+        self, ds_type: str, response: requests.Response
+    ) -> (List[dict], str):
+        metrics.add("SearchBytes", len(response.content), "Bytes")
+        if response.status_code != 200:
+            return (
+                None,
+                f"search for '{ds_type}' failed with status {response.status_code} - {response.text}",
+            )
+        key_name = self.plural(ds_type)
+        results = response.json()
+        if key_name not in results:
+            return (
+                None,
+                f"no field '{key_name}' expected in response, but it is missing.",
+            )
+        return results[key_name], None
+
+    async def search(self, ds_type: str, search: dict) -> (List[dict], str):
+        """
+        returns the objects of `ds_type` matching `search`, or an error message.
+        """
+        try:
+            response = await self.request(
+                "POST", self.search_path(ds_type), json=search
+            )
+            return self.search_result(ds_type, response)
+        except IOError as e:
+            return None, f"search for {ds_type} failed, {e}"
+
+    def find(self, ds_type: str, search: dict) -> (List[dict], str):
+        """
+        returns the objects of `ds_type` matching `search`, or an error message. Blocks the
+        calling thread.
+        """
+        try:
+            with metrics.timer("Search"):
+                response = self.call("POST", self.search_path(ds_type), json=search)
+            return self.search_result(ds_type, response)
+        except IOError as e:
+            return None, f"search for {ds_type} failed, {e}"
+
+    async def search_pages(
+        self,
+        ds_type: str,
+        search: dict = None,
+        page_size: int = 1000,
+        descending: bool = False,
+    ) -> AsyncIterator[List[dict]]:
+        """
+        yields the pages of objects of `ds_type` matching `search`, ordered by ID. Raises
+        IOError if a page cannot be retrieved.
+        """
+        pager = Pager(search, page_size, descending)
+        while True:
+            page, err = await self.search(ds_type, pager.search)
+            if err:
+                raise IOError(err)
+            if page:
+                yield page
+            if not pager.advance(page):
+                return
+
+    def find_all(
+        self, ds_type: str, search: dict = None, page_size: int = 1000
+    ) -> (List[dict], str):
+        """
+        returns all objects of `ds_type` matching `search`, by paging through the results
+        ordered by ID. Blocks the calling thread.
+        """
+        pager = Pager(search, page_size)
+        results = []
+        while True:
+            page, err = self.find(ds_type, pager.search)
+            if err:
+                return None, err
+            results.extend(page)
+            if not pager.advance(page):
+                return results, None
+
+    def pages(
+        self,
+        ds_type: str,
+        search: dict = None,
+        page_size: int = 1000,
+        prefetch: bool = False,
+        descending: bool = False,
+    ) -> Iterator[List[dict]]:
+        """
+        returns an iterator over the pages of `search_pages` for synchronous code. With
+        `prefetch`, the next page is requested while the caller processes the current one.
+        """
+        iterator = self.search_pages(ds_type, search, page_size, descending).__aiter__()
+
+        async def next_page() -> Optional[List[dict]]:
+            try:
+                return await iterator.__anext__()
+            except StopAsyncIteration:
+                return None
+
+        future = engine.submit(next_page())
+        while True:
+            page = future.result()
+            if page is None:
+                return
+            if prefetch:
+                future = engine.submit(next_page())
+            yield page
+            if not prefetch:
+                future = engine.submit(next_page())
+
+
+class RestClient(Client):
+    """
+    a client of the legacy Deep Security /rest API. It uses the session of `session_key`, which
+    is kept in the container, and obtains one with `login` when there is none. A rejected
+    session is replaced by a new login, and the call is retried once.
+    """
+
+    timer = "AsyncRest"
+
+    def __init__(
+        self,
+        api_endpoint: str,
+        session_key: tuple,
+        login: Callable[[], Optional[str]],
+        max_concurrency: int = 8,
+    ):
+        super(RestClient, self).__init__(api_endpoint, max_concurrency)
+        self.session_key = session_key
+        self.login = login
+
+    def call(self, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        """
+        calls `path` of the api with the session, and blocks until the response arrives.
+        returns None if the login failed.
+        """
+        key = self.session_key
+        response = None
+        try:
+            for _ in range(2):
+                session_id = rest_session.sessions.get(
+                    key, self.api_endpoint, self.login
+                )
+                if not session_id:
+                    return None
+
+                response = http_session.session().request(
+                    method,
+                    f"{self.api_endpoint}/{path}",
+                    cookies={"sID": session_id},
+                    **kwargs,
+                )
+                if response.status_code not in (401, 403):
+                    rest_session.sessions.touch(key)
+                    return response
+
+                log.info("session rejected, logging in again")
+                rest_session.sessions.invalidate(key, session_id)
+            return response
+        finally:
+            rest_session.sessions.release(key)
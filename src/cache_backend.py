@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+log = logging.getLogger()
+
+
+class CacheBackend(object):
+    """
+    a second level store for cached lookup results and catalogs, which outlives the in-memory
+    caches. Keys are tuples of strings, values must be serializable to JSON.
+
+    A backend must never fail the caller: errors are logged and reported as a cache miss.
+    """
+
+    def get(self, key: tuple):
+        """
+        returns the value stored for `key`, or None if there is no valid entry.
+        """
+        return self.get_entry(key)[0]
+
+    def get_entry(self, key: tuple) -> (object, float):
+        """
+        returns the value stored for `key` and the time at which it expires, or None and None
+        if there is no valid entry.
+        """
+        return None, None
+
+    def put(self, key: tuple, value, ttl: float):
+        """
+        stores `value` for `key` during `ttl` seconds.
+        """
+        pass
+
+    def invalidate(self, prefix: tuple = None):
+        """
+        removes all entries whose key starts with `prefix`, or all entries if no prefix is specified.
+        """
+        pass
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    stores entries in the SQLite database at `path`, which can be shared by concurrent processes.
+
+    The database uses write-ahead logging, so readers are not blocked by a writer. Each thread
+    uses its own connection.
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        super(SQLiteBackend, self).__init__()
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def serialize_key(key: tuple) -> str:
+        return json.dumps(list(key), separators=(",", ":"))
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            connection.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+            self.local.connection = connection
+        return connection
+
+    def get_entry(self, key: tuple) -> (object, float):
+        try:
+            row = self.connection.execute(
+                "SELECT value, expires FROM entries WHERE key = ? AND expires > ?",
+                (self.serialize_key(key), time.time()),
+            ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            self.errors += 1
+            log.warning("failed to read from cache %s, %s", self.path, e)
+            return None, None
+
+        if row is None:
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return json.loads(row[0]), row[1]
+
+    def put(self, key: tuple, value, ttl: float):
+        if ttl <= 0:
+            return
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+                (self.serialize_key(key), json.dumps(value), time.time() + ttl),
+            )
+        except (sqlite3.Error, OSError) as e:
+            self.errors += 1
+            log.warning("failed to write to cache %s, %s", self.path, e)
+
+    def invalidate(self, prefix: tuple = None):
+        try:
+            if prefix is None:
+                self.connection.execute("DELETE FROM entries")
+            else:
+                # a serialized prefix is the serialized key without the closing bracket
+                pattern = self.serialize_key(prefix)[:-1]
+                self.connection.execute(
+                    "DELETE FROM entries WHERE key = ? OR substr(key, 1, ?) = ?",
+                    (pattern + "]", len(pattern) + 1, pattern + ","),
+                )
+        except (sqlite3.Error, OSError) as e:
+            self.errors += 1
+            log.warning("failed to invalidate cache %s, %s", self.path, e)
+
+    def expire(self):
+        """
+        removes all expired entries.
+        """
+        try:
+            self.connection.execute(
+                "DELETE FROM entries WHERE expires <= ?", (time.time(),)
+            )
+        except (sqlite3.Error, OSError) as e:
+            self.errors += 1
+            log.warning("failed to expire cache %s, %s", self.path, e)
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+def create_backend(name: str, path: str) -> CacheBackend:
+    """
+    creates the cache backend `name`, which is either `none` or `sqlite`.
+    """
+    if name == "sqlite":
+        return SQLiteBackend(path)
+    if name not in ("", "none"):
+        log.warning("unknown cache backend %s, caching in memory only", name)
+    return CacheBackend()
+
+
+backend = create_backend(
+    os.getenv("CACHE_BACKEND", "none"),
+    os.getenv("CACHE_PATH", "/tmp/cfn-deep-security-provider/cache.db"),
+)
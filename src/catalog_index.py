@@ -0,0 +1,200 @@
+import os
+import re
+import time
+import logging
+import threading
+from typing import Callable, Dict, List
+
+import cache_backend
+
+log = logging.getLogger()
+
+
+class CatalogIndex(object):
+    """
+    name to IDs index of all objects of a single Deep Security type.
+    """
+
+    def __init__(self, objects: List[dict]):
+        super(CatalogIndex, self).__init__()
+        self.loaded = time.monotonic()
+        self.names: Dict[str, List[int]] = {}
+        for obj in objects:
+            if "ID" in obj and "name" in obj:
+                self.names.setdefault(obj["name"], []).append(obj["ID"])
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.loaded
+
+    def matching(self, matcher: re.Pattern) -> List[int]:
+        """
+        returns the sorted IDs of all objects with a name which fully matches `matcher`.
+        """
+        return sorted(
+            i
+            for name, ids in self.names.items()
+            if matcher.fullmatch(name)
+            for i in ids
+        )
+
+    def to_dict(self) -> dict:
+        return {"names": self.names, "timestamp": time.time() - self.age}
+
+    @staticmethod
+    def from_dict(value: dict) -> "CatalogIndex":
+        result = CatalogIndex([])
+        result.names = value["names"]
+        result.loaded = time.monotonic() - max(0.0, time.time() - value["timestamp"])
+        return result
+
+
+class CatalogIndexes(object):
+    """
+    maintains a full catalog index for each of the `types` with a bounded number of objects.
+
+    An index is reloaded when it is older than `ttl` seconds, or when a name is not found in an
+    index which is older than `refresh_interval` seconds. Loaded indexes are stored in the
+    `backend`, which is consulted before the index is loaded from the API.
+
+    Other types are indexed on demand with `probe`, if they turn out to be small.
+    """
+
+    namespace = "catalog"
+
+    def __init__(
+        self,
+        types: List[str],
+        ttl: float = 300,
+        refresh_interval: float = 15,
+        backend: cache_backend.CacheBackend = None,
+    ):
+        super(CatalogIndexes, self).__init__()
+        self.types = set(types)
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.backend = backend if backend else cache_backend.CacheBackend()
+        self.indexes: Dict[tuple, CatalogIndex] = {}
+        self.large: Dict[tuple, float] = {}
+        self.locks: Dict[tuple, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def is_indexed(self, ds_type: str) -> bool:
+        return ds_type in self.types and self.ttl > 0
+
+    def _lock(self, key: tuple) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def get(
+        self, endpoint: str, ds_type: str, search_all: Callable, max_age: float = None
+    ) -> (CatalogIndex, str):
+        """
+        returns the index of `ds_type` at `endpoint`, loading it with `search_all` if there is
+        no index younger than `max_age` seconds.
+        """
+        key = (endpoint, ds_type)
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock(key):
+            index = self._cached(key, max_age)
+            if index:
+                return index, None
+
+            log.debug("loading catalog index of %s", ds_type)
+            objects, err = search_all(ds_type)
+            if err:
+                return None, err
+            return self._store(key, objects), None
+
+    def probe(
+        self, endpoint: str, ds_type: str, find: Callable, max_objects: int
+    ) -> (CatalogIndex, str):
+        """
+        returns the index of `ds_type` at `endpoint` if the type has at most `max_objects`
+        objects, loading it with a single search of `find`. Returns no index if the type has
+        more objects; such a type is not probed again for `ttl` seconds.
+        """
+        key = (endpoint, ds_type)
+        if self.ttl <= 0:
+            return None, None
+        with self._lock(key):
+            index = self._cached(key, self.ttl)
+            if index:
+                return index, None
+            if self.large.get(key, 0) > time.monotonic():
+                return None, None
+
+            log.debug("probing the size of %s", ds_type)
+            objects, err = find(
+                ds_type, {"maxItems": max_objects + 1, "sortByObjectID": True}
+            )
+            if err:
+                return None, err
+            if len(objects) > max_objects:
+                self.large[key] = time.monotonic() + self.ttl
+                return None, None
+            return self._store(key, objects), None
+
+    def _cached(self, key: tuple, max_age: float) -> CatalogIndex:
+        index = self.indexes.get(key)
+        if index and index.age < max_age:
+            return index
+
+        stored = self.backend.get((self.namespace,) + key)
+        if stored is not None:
+            index = CatalogIndex.from_dict(stored)
+            if index.age < max_age:
+                self.indexes[key] = index
+                return index
+        return None
+
+    def _store(self, key: tuple, objects: List[dict]) -> CatalogIndex:
+        index = CatalogIndex(objects)
+        self.indexes[key] = index
+        self.backend.put((self.namespace,) + key, index.to_dict(), self.ttl)
+        return index
+
+    def lookup(
+        self, endpoint: str, ds_type: str, name: str, search_all: Callable
+    ) -> (List[int], str):
+        """
+        returns the IDs of all objects of `ds_type` named `name`.
+        """
+        index, err = self.get(endpoint, ds_type, search_all)
+        if err:
+            return None, err
+
+        ids = index.names.get(name, [])
+        if not ids and index.age >= self.refresh_interval:
+            index, err = self.get(
+                endpoint, ds_type, search_all, max_age=self.refresh_interval
+            )
+            if err:
+                return None, err
+            ids = index.names.get(name, [])
+        return ids, None
+
+    def invalidate(self, endpoint: str = None, ds_type: str = None):
+        with self.lock:
+            for entries in (self.indexes, self.large):
+                for key in list(entries.keys()):
+                    if (endpoint is None or key[0] == endpoint) and (
+                        ds_type is None or key[1] == ds_type
+                    ):
+                        del entries[key]
+
+        if endpoint is None:
+            # stored keys start with the endpoint, so these can only be removed all together
+            self.backend.invalidate((self.namespace,))
+        else:
+            prefix = (endpoint,) if ds_type is None else (endpoint, ds_type)
+            self.backend.invalidate((self.namespace,) + prefix)
+
+
+indexes = CatalogIndexes(
+    types=os.getenv(
+        "CATALOG_INDEX_TYPES", "ipList,portList,macList,context,schedule,policy"
+    ).split(","),
+    ttl=float(os.getenv("CATALOG_INDEX_TTL", "300")),
+    backend=cache_backend.backend,
+)
@@ -0,0 +1,152 @@
+import os
+import time
+import gzip
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import lookup_cache
+from async_client import ApiClient
+from catalog_index import CatalogIndex
+from template_substitutor import TemplateSubstitutor
+
+log = logging.getLogger()
+
+
+class SnapshotWriter(object):
+    """
+    writes a gzip compressed snapshot of the objects of a Deep Security tenant to `path`.
+
+    The snapshot is a stream of JSON lines: a header, one line per object, and an index of the
+    IDs by type and name at the end. Objects are written as they are added, only the index is
+    kept in memory.
+
+    The snapshot is written to a temporary file, which replaces `path` on `close`. An export
+    which fails is discarded with `abort`, so that it never leaves an incomplete snapshot.
+    """
+
+    def __init__(self, path: str, api_endpoint: str):
+        super(SnapshotWriter, self).__init__()
+        self.path = path
+        self.temp_path = f"{path}.tmp"
+        self.file = gzip.open(self.temp_path, "wt", encoding="utf-8")
+        self.index: Dict[str, Dict[str, List[int]]] = {}
+        self.count = 0
+        self.write_line(
+            {
+                "snapshot": 1,
+                "url": api_endpoint,
+                "created": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+
+    def write_line(self, line: dict):
+        self.file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def add_type(self, ds_type: str):
+        self.index.setdefault(ds_type, {})
+
+    def write(self, ds_type: str, objects: List[dict]):
+        names = self.index.setdefault(ds_type, {})
+        for obj in objects:
+            self.write_line({"type": ds_type, "object": obj})
+            if "ID" in obj and "name" in obj:
+                names.setdefault(obj["name"], []).append(obj["ID"])
+            self.count += 1
+
+    def close(self):
+        self.write_line({"index": self.index})
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """
+        discards the snapshot, unless it was closed.
+        """
+        if self.file.closed and not os.path.exists(self.temp_path):
+            return
+        self.file.close()
+        os.remove(self.temp_path)
+
+
+class Snapshot(object):
+    """
+    the index of a snapshot, which resolves lookups without calling the Deep Security API.
+    """
+
+    def __init__(self, index: Dict[str, Dict[str, List[int]]], header: dict = None):
+        super(Snapshot, self).__init__()
+        self.header = header if header else {}
+        created = self.header.get("created")
+        timestamp = (
+            datetime.fromisoformat(created).timestamp() if created else time.time()
+        )
+        self.indexes: Dict[str, CatalogIndex] = {
+            ds_type: CatalogIndex.from_dict({"names": names, "timestamp": timestamp})
+            for ds_type, names in index.items()
+        }
+
+    @staticmethod
+    def load(path: str) -> "Snapshot":
+        """
+        reads the index of the snapshot at `path`. The objects are skipped.
+        """
+        header, index = None, None
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith('{"type":'):
+                    continue
+                record = json.loads(line)
+                if "snapshot" in record:
+                    header = record
+                elif "index" in record:
+                    index = record["index"]
+        if header is None or index is None:
+            raise ValueError(f"{path} is not a complete snapshot")
+        return Snapshot(index, header)
+
+    def get(self, ds_type: str) -> (CatalogIndex, str):
+        if ds_type not in self.indexes:
+            return None, f"{ds_type} is not in the snapshot"
+        return self.indexes[ds_type], None
+
+    def lookup(self, ds_type: str, name: str) -> (int, str):
+        index, err = self.get(ds_type)
+        if err:
+            return None, err
+        ids = index.names.get(name, [])
+        return TemplateSubstitutor._unique(ds_type, name, *lookup_cache.result(ids))
+
+    def lookup_all(self, ds_type: str, pattern: str) -> (List[int], str):
+        index, err = self.get(ds_type)
+        if err:
+            return None, err
+        ids = index.matching(TemplateSubstitutor.name_pattern(pattern))
+        return TemplateSubstitutor._any(ds_type, pattern, ids)
+
+
+async def export(
+    client: ApiClient, writer: SnapshotWriter, types: List[str], page_size: int = 1000
+):
+    """
+    pages through all objects of `types` concurrently, and adds them to the snapshot. Raises
+    IOError if a type cannot be retrieved, after the export of the other types is cancelled.
+    """
+
+    async def export_type(ds_type: str):
+        writer.add_type(ds_type)
+        count = 0
+        async for page in client.search_pages(ds_type, page_size=page_size):
+            writer.write(ds_type, page)
+            count += len(page)
+        log.info("exported %d %s", count, ds_type)
+
+    tasks = [asyncio.ensure_future(export_type(t)) for t in types]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
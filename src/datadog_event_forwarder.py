@@ -2,21 +2,29 @@ import json
 import logging
 import os
 import re
+import threading
 from datetime import datetime
 from json.decoder import JSONDecodeError
-from typing import List
+from typing import Dict, Iterable, Iterator, List
 from urllib.parse import parse_qs, urlparse
 from io import StringIO
-from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
 import datadog
+import deadline
+import http_session
+import metrics
+import secret_cache
 from botocore.exceptions import ClientError
 from ruamel.yaml import YAML
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 log = logging.getLogger()
 
+# the environment variables which refer to a parameter, as they were before they were loaded
+ssm_references: Dict[str, str] = {}
+reconnect_lock = threading.Lock()
+
 
 def tags(tags: str = os.environ.get("DATADOG_TAGS", "")) -> List[str]:
     """
@@ -86,9 +94,15 @@ def message_hostname(message: dict) -> str:
         return message["TargetName"]
     return "app.deepsecurity.trendmicro.com"
 
+
+hostname_pattern = re.compile(
+    r"(?P<fqdn>.*)\s*\((?P<name>[^)]*)\)\s+\[(?P<instanceid>i-[^\]]*)\]"
+)
+
+
 def hostname_tags(hostname: str) -> (str, dict):
     tags = []
-    m = re.match(r'(?P<fqdn>.*)\s*\((?P<name>[^)]*)\)\s+\[(?P<instanceid>i-[^\]]*)\]', hostname)
+    m = hostname_pattern.match(hostname)
     if m and m.group("instanceid"):
         hostname = m.group("instanceid")
     if m and m.group("name"):
@@ -96,37 +110,102 @@ def hostname_tags(hostname: str) -> (str, dict):
 
     return (hostname, tags)
 
-def message_to_text(message: dict) -> str:
-    result = StringIO()
-    message = copy(message)
 
-    for name, value in map(
-        lambda name: (name, message.get(name)), ["Description", "OSSEC_Log"]
-    ):
-        if value:
-            result.write(value)
+class EventConverter(object):
+    """
+    converts Deep Security events to Datadog events. The static tags and the serializer of
+    the event text are created once, so a single converter should be reused for all events.
+
+    The event text is rendered as YAML, or as JSON if `text_format` is `json`.
+    """
+
+    excluded_fields = {
+        "Title",
+        "Description",
+        "LogDate",
+        "OSSEC_Description",
+        "OSSEC_Log",
+    }
+
+    def __init__(self, static_tags: str = "", text_format: str = "yaml"):
+        super(EventConverter, self).__init__()
+        self.tags = tags(static_tags)
+        self.text_format = text_format
+        self.yaml = YAML() if text_format == "yaml" else None
+
+    def text_fields(self, message: dict) -> dict:
+        """
+        returns the fields of `message` to render in the text, with the integer codes replaced
+        by their string representation, if present.
+        """
+        result = {}
+        for name, value in message.items():
+            if name in self.excluded_fields:
+                continue
+            if (
+                name.endswith("String")
+                and isinstance(message.get(name[0:-6]), int)
+                and name[0:-6] not in self.excluded_fields
+            ):
+                continue
+            if isinstance(value, int) and f"{name}String" in message:
+                value = message[f"{name}String"]
+            result[name] = value
+        return result
+
+    def message_to_text(self, message: dict) -> str:
+        result = StringIO()
+        for name in ["Description", "OSSEC_Log"]:
+            if message.get(name):
+                result.write(message[name])
+                result.write("\n")
+                break
+
+        if self.yaml:
+            self.yaml.dump(self.text_fields(message), result)
+        else:
+            json.dump(self.text_fields(message), result, indent=2, default=str)
             result.write("\n")
-            break
+        return result.getvalue()
+
+    def convert(self, message_id: str, message: dict) -> dict:
+        """
+        converts the Deep Security event `message` into the arguments of a Datadog event.
+        """
+        hostname, datadog_tags = hostname_tags(message_hostname(message))
+        datadog_tags.extend(self.tags)
+
+        return dict(
+            priority="normal",
+            alert_type=log_level(message),
+            title=message_to_title(message_id, message),
+            text=self.message_to_text(message),
+            date_happened=date_happened(message),
+            tags=datadog_tags,
+            host=hostname,
+            source_type_name="DeepSecurity",
+        )
 
-    for name in ["Title", "Description", "LogDate", "OSSEC_Description", "OSSEC_Log"]:
-        if name in message:
-            message.pop(name)
 
-    to_remove = list(
-        filter(
-            lambda k: isinstance(message[k], int) and f"{k}String" in message,
-            message.keys(),
+_converter = None
+
+
+def converter() -> EventConverter:
+    """
+    returns the converter of this container, created on first use after the environment
+    variables have been loaded from the parameter store.
+    """
+    global _converter
+    if _converter is None:
+        _converter = EventConverter(
+            static_tags=os.getenv("DATADOG_TAGS", ""),
+            text_format=os.getenv("DATADOG_TEXT_FORMAT", "yaml"),
         )
-    )
-    for key in to_remove:
-        key_str = f"{key}String"
-        v = message[key_str]
-        message[key] = v
-        message.pop(key_str)
+    return _converter
+
 
-    yaml = YAML()
-    yaml.dump(message, result)
-    return result.getvalue()
+def message_to_text(message: dict) -> str:
+    return converter().message_to_text(message)
 
 
 def message_to_title(message_id, message: dict) -> str:
@@ -137,59 +216,176 @@ def message_to_title(message_id, message: dict) -> str:
     return f"{event_type} : {title}"
 
 
-def send_datadog_event(message_id: str, message: dict):
-    log.debug("forwarding event %s to datadog", message_id)
-    yaml = YAML()
-    hostname, datadog_tags = hostname_tags(message_hostname(message))
-    datadog_tags.extend(tags())
-
-    response = datadog.api.Event.create(
-        priority="normal",
-        alert_type=log_level(message),
-        title=message_to_title(message_id, message),
-        text=message_to_text(message),
-        date_happened=date_happened(message),
-        tags=datadog_tags,
-        host=hostname,
-        source_type_name="DeepSecurity",
+def datadog_event(message_id: str, message: dict) -> dict:
+    return converter().convert(message_id, message)
+
+
+def is_rejected(response: dict) -> bool:
+    """
+    returns true if Datadog rejected the API key of the request. The client of the Datadog API
+    does not report the status code of a failed request, only the errors.
+    """
+    return bool(
+        set(response.get("errors") or []).intersection(["Forbidden", "Unauthorized"])
     )
 
-    if response["status"] != "ok":
-        log.error("Failed to forward event to datadog: %s", response)
+
+def submit_datadog_event(message_id: str, event: dict, retry: bool = True) -> bool:
+    log.debug("forwarding event %s to datadog", message_id)
+    api_key = datadog.api._api_key
+    try:
+        with metrics.timer("SubmitEvent"):
+            response = datadog.api.Event.create(**event)
+    except Exception as e:
+        log.error("Failed to forward event %s to datadog: %s", message_id, e)
+        return False
+
+    if response.get("status") != "ok":
+        if retry and is_rejected(response) and reconnect_to_datadog(api_key):
+            return submit_datadog_event(message_id, event, retry=False)
+        log.error("Failed to forward event %s to datadog: %s", message_id, response)
+        return False
+    return True
+
+
+def send_datadog_event(message_id: str, message: dict) -> bool:
+    return submit_datadog_event(message_id, datadog_event(message_id, message))
+
+
+def datadog_log(event: dict) -> dict:
+    """
+    converts the Datadog `event` into a log entry for the logs intake.
+    """
+    return {
+        "ddsource": "DeepSecurity",
+        "ddtags": ",".join(event["tags"]),
+        "hostname": event["host"],
+        "service": "deep-security",
+        "status": event["alert_type"],
+        "title": event["title"],
+        "message": f"{event['title']}\n{event['text']}",
+        "date": event["date_happened"] * 1000,
+    }
+
+
+def logs_intake_url() -> str:
+    site = os.getenv("DATADOG_SITE", os.getenv("DD_SITE", "datadoghq.com"))
+    return os.getenv("DATADOG_LOGS_URL", f"https://http-intake.logs.{site}/api/v2/logs")
+
+
+def submit_datadog_logs(events: List[tuple]) -> List[str]:
+    """
+    submits the `events` as logs to the Datadog logs intake, in batches of at most 1000 logs.
+    returns the message ids of the events which failed to be submitted.
+    """
+    failed = []
+    for i in range(0, len(events), 1000):
+        batch = events[i : i + 1000]
+        try:
+            for retry in (True, False):
+                api_key = datadog.api._api_key
+                with metrics.timer("SubmitLogs"):
+                    response = http_session.session().post(
+                        logs_intake_url(),
+                        headers={"DD-API-KEY": api_key},
+                        json=[datadog_log(event) for _, event in batch],
+                    )
+                if not (
+                    retry
+                    and response.status_code in (401, 403)
+                    and reconnect_to_datadog(api_key)
+                ):
+                    break
+            if response.status_code not in (200, 202):
+                log.error(
+                    "Failed to forward %d events to datadog logs, %s",
+                    len(batch),
+                    response.text,
+                )
+                failed.extend(message_id for message_id, _ in batch)
+        except IOError as e:
+            log.error("Failed to forward %d events to datadog logs, %s", len(batch), e)
+            failed.extend(message_id for message_id, _ in batch)
+    return failed
+
+
+def send_datadog_events(messages: List[tuple]) -> dict:
+    """
+    converts all (message_id, message) `messages` first, and submits them concurrently to
+    Datadog as events, or as logs if DATADOG_DELIVERY is `logs`. Returns the message ids of
+    the forwarded and failed messages.
+    """
+    events = []
+    failed = []
+    for message_id, message in messages:
+        try:
+            events.append((message_id, datadog_event(message_id, message)))
+        except Exception as e:
+            log.error("Failed to convert event %s, %s", message_id, e)
+            failed.append(message_id)
+
+    if os.getenv("DATADOG_DELIVERY", "events") == "logs":
+        failed.extend(submit_datadog_logs(events))
+    elif events:
+        max_workers = min(int(os.getenv("DATADOG_MAX_WORKERS", "8")), len(events))
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            results = executor.map(lambda e: submit_datadog_event(*e), events)
+            failed.extend(
+                message_id
+                for (message_id, _), success in zip(events, results)
+                if not success
+            )
+
+    failed_ids = set(failed)
+    return {
+        "forwarded": [
+            message_id for message_id, _ in events if message_id not in failed_ids
+        ],
+        "failed": failed,
+    }
 
 
 def load_ssm_parameters(env: dict):
-    ssm = boto3.client("ssm")
-    for name, url in map(
-        lambda n: (n, urlparse(env[n], scheme="ssm")),
-        filter(lambda n: env[n].startswith("ssm:"), env.keys()),
-    ):
+    references = list(
+        map(
+            lambda n: (n, urlparse(env[n], scheme="ssm")),
+            filter(lambda n: env[n].startswith("ssm:"), env.keys()),
+        )
+    )
+    try:
+        values = secret_cache.secrets.get_many(
+            [url.path for _, url in references if url.path]
+        )
+        error = "parameter not found"
+    except ClientError as e:
+        values = {}
+        error = e
+
+    for name, url in references:
         if url.path:
             parameters = parse_qs(url.query)
-            try:
-                response = ssm.get_parameter(Name=url.path, WithDecryption=True)
-                env[name] = response["Parameter"]["Value"]
+            if url.path in values:
+                env[name] = values[url.path]
                 log.debug(
                     "replacing environment variable %s with value from ssm://%s",
                     name,
                     url.path,
                 )
-            except ClientError as e:
-                if parameters.get("default"):
-                    env[name] = parameters.get("default")[0]
-                    log.warning(
-                        "default set for environment variable %s with value from %s, %s",
-                        name,
-                        url.path,
-                        e,
-                    )
-                else:
-                    log.error(
-                        "environment variable %s with value from ssm://%s, could not be retrieved, %s",
-                        name,
-                        url.path,
-                        e,
-                    )
+            elif parameters.get("default"):
+                env[name] = parameters.get("default")[0]
+                log.warning(
+                    "default set for environment variable %s with value from %s, %s",
+                    name,
+                    url.path,
+                    error,
+                )
+            else:
+                log.error(
+                    "environment variable %s with value from ssm://%s, could not be retrieved, %s",
+                    name,
+                    url.path,
+                    error,
+                )
         else:
             log.error(
                 "environment variable %s with value from %s, does not specify a parameter name",
@@ -200,30 +396,122 @@ def load_ssm_parameters(env: dict):
 
 def connect_to_datadog():
     if not datadog.api._api_host:
+        ssm_references.update(
+            {n: v for n, v in os.environ.items() if v.startswith("ssm:")}
+        )
         load_ssm_parameters(os.environ)
         datadog.initialize(host_name="app.deepsecurity.trendmicro.com")
 
 
-def handler(event, context):
-    connect_to_datadog()
+def reconnect_to_datadog(api_key: str) -> bool:
+    """
+    reloads the parameters of the environment and initializes the Datadog client again, after
+    Datadog rejected `api_key`. Returns true if the API key changed, and the request should be
+    retried. Concurrent requests which were rejected share a single reload.
+    """
+    with reconnect_lock:
+        if datadog.api._api_key == api_key and ssm_references:
+            secret_cache.secrets.invalidate(
+                [urlparse(v, scheme="ssm").path for v in ssm_references.values()]
+            )
+            env = dict(ssm_references)
+            load_ssm_parameters(env)
+            os.environ.update({n: v for n, v in env.items() if v != ssm_references[n]})
+            datadog.api._api_key = None
+            datadog.api._application_key = None
+            datadog.initialize(host_name="app.deepsecurity.trendmicro.com")
 
+        if datadog.api._api_key == api_key:
+            return False
+    log.info("retrying with refreshed datadog api key")
+    metrics.add("ApiKeyRefreshes")
+    return True
+
+
+def sns_messages(event: dict) -> Iterator[tuple]:
+    """
+    yields the (message_id, message) of all SNS records in the Lambda `event`.
+    """
     for sns in map(
         lambda r: r["Sns"], filter(lambda r: "Sns" in r, event.get("Records", []))
     ):
+        yield sns.get("MessageId"), sns.get("Message")
+
+
+def deep_security_events(messages: Iterable[tuple], counters: dict) -> Iterator[tuple]:
+    """
+    yields the (message_id, event) of all Deep Security events in the SNS `messages`. A
+    message contains an array of events; if there is more than one, the index of the event
+    is appended to the message id.
+    """
+    for message_id, message in messages:
         try:
-            message_id = sns.get("MessageId")
-            event = json.loads(sns.get("Message"))
-            if event and isinstance(event, list):
-                send_datadog_event(message_id, event[0])
-            else:
-                log.error(
-                    "message %s expected array as message got a %s",
-                    message_id,
-                    type(event),
-                )
-        except JSONDecodeError as e:
+            events = json.loads(message)
+        except (JSONDecodeError, TypeError) as e:
             log.error(
                 "message %s received does not contain a json  message, %s",
                 message_id,
                 e,
             )
+            counters["invalid"] += 1
+            continue
+
+        if not events or not isinstance(events, list):
+            log.error(
+                "message %s expected array as message got a %s",
+                message_id,
+                type(events),
+            )
+            counters["invalid"] += 1
+            continue
+
+        for i, event in enumerate(events):
+            counters["received"] += 1
+            yield (message_id if len(events) == 1 else f"{message_id}/{i}"), event
+
+
+def batches(iterable: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def handler(event, context):
+    with deadline.invocation(context):
+        with metrics.invocation("DatadogEventForwarder") as invocation:
+            result = forward(event)
+            invocation.add("EventsReceived", result["received"])
+            invocation.add("EventsForwarded", result["forwarded"])
+            invocation.add("EventsFailed", len(result["failed"]))
+            invocation.add("InvalidMessages", result["invalid"])
+            return result
+
+
+def forward(event) -> dict:
+    with metrics.timer("Connect"):
+        connect_to_datadog()
+
+    counters = {"received": 0, "forwarded": 0, "invalid": 0}
+    failed = []
+    batch_size = max(int(os.getenv("DATADOG_BATCH_SIZE", "100")), 1)
+    for batch in batches(
+        deep_security_events(sns_messages(event), counters), batch_size
+    ):
+        with metrics.timer("Submit"):
+            result = send_datadog_events(batch)
+        counters["forwarded"] += len(result["forwarded"])
+        failed.extend(result["failed"])
+
+    log.info(
+        "received %d events, forwarded %d, failed %d, invalid messages %d",
+        counters["received"],
+        counters["forwarded"],
+        len(failed),
+        counters["invalid"],
+    )
+    return dict(counters, failed=failed)
@@ -0,0 +1,93 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+log = logging.getLogger()
+
+
+class DeadlineExceeded(IOError):
+    pass
+
+
+class Deadline(object):
+    """
+    the time budget of an invocation. `reserve` seconds of the budget are kept to send the
+    response, and are never handed out as a timeout.
+
+    A deadline without a budget never expires.
+    """
+
+    def __init__(self, budget: float = None, reserve: float = 10):
+        super(Deadline, self).__init__()
+        self.budget = budget
+        self.reserve = reserve
+        self.started = time.monotonic()
+
+    @staticmethod
+    def from_context(context, reserve: float = 10) -> "Deadline":
+        remaining = getattr(context, "get_remaining_time_in_millis", None)
+        return Deadline(remaining() / 1000.0 if remaining else None, reserve)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def remaining(self) -> float:
+        """
+        returns the seconds left before the reserve, or infinity if there is no budget.
+        """
+        if self.budget is None:
+            return float("inf")
+        return self.budget - self.reserve - self.elapsed
+
+    def diagnostics(self, action: str) -> str:
+        return (
+            f"deadline exceeded while {action}, after {self.elapsed:.1f}s of a "
+            f"{self.budget:.0f}s budget"
+        )
+
+    def check(self, action: str):
+        """
+        raises DeadlineExceeded if there is no time left for `action`.
+        """
+        if self.remaining <= 0:
+            raise DeadlineExceeded(self.diagnostics(action))
+
+    def timeout(self, default: float, action: str = "calling the api") -> float:
+        """
+        returns the timeout for a request, which is `default` or less if the deadline is near.
+        """
+        self.check(action)
+        return min(default, self.remaining)
+
+    def allows(self, seconds: float) -> bool:
+        """
+        returns true if something which takes `seconds` can finish before the deadline.
+        """
+        return seconds < self.remaining
+
+    def workers(self, default: int, seconds_per_task: float) -> int:
+        """
+        returns the number of concurrent workers to use: `default`, or a single worker once
+        there is not enough time left for a task of `seconds_per_task`.
+        """
+        return default if self.allows(seconds_per_task) else 1
+
+
+reserve = float(os.getenv("DEADLINE_RESERVE", "10"))
+current = Deadline()
+
+
+@contextmanager
+def invocation(context):
+    """
+    sets the deadline of the current invocation from the Lambda `context`.
+    """
+    global current
+    current = Deadline.from_context(context, reserve)
+    try:
+        yield current
+    finally:
+        current = Deadline()
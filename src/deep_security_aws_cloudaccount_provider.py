@@ -1,8 +1,11 @@
 import os
 import json
 import logging
-import boto3
-import requests
+import deadline
+import http_session
+import metrics
+import secret_cache
+from async_client import RestClient
 from cfn_resource_provider import ResourceProvider
 from template_substitutor import TemplateSubstitutor
 
@@ -49,8 +52,6 @@ request_schema = {
 class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
     def __init__(self):
         super(DeepSecurityAWSCloudAccountProvider, self).__init__()
-        self.cookies = {}
-        self.ssm = boto3.client("ssm")
 
     def convert_property_types(self):
         self.heuristic_convert_property_types(self.properties)
@@ -65,8 +66,8 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
         )
 
     @property
-    def resource_url(self):
-        return f"{self.api_endpoint}/cloudaccounts/aws"
+    def resource_path(self):
+        return "cloudaccounts/aws"
 
     @property
     def user_parameter_name(self):
@@ -87,16 +88,28 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
         )
 
     def get_ssm_parameter(self, name):
-        value = self.ssm.get_parameter(Name=name, WithDecryption=True)
-        return value["Parameter"]["Value"]
+        return secret_cache.secrets.get(name)
+
+    @property
+    def credential_parameter_names(self):
+        return [
+            self.user_parameter_name,
+            self.password_parameter_name,
+            self.tenant_parameter_name,
+        ]
 
     @property
     def credentials(self):
+        values = secret_cache.secrets.get_many(self.credential_parameter_names)
+        for name in self.credential_parameter_names:
+            if name not in values:
+                raise secret_cache.ParameterNotFound(f"parameter {name} not found")
+
         return {
             "dsCredentials": {
-                "userName": self.user,
-                "password": self.password,
-                "tenantName": self.tenant,
+                "userName": values[self.user_parameter_name],
+                "password": values[self.password_parameter_name],
+                "tenantName": values[self.tenant_parameter_name],
             }
         }
 
@@ -113,41 +126,45 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
         return self.get_ssm_parameter(self.tenant_parameter_name)
 
     @property
-    def session_id(self):
-        return self.cookies.get("sID")
-
-    @session_id.setter
-    def session_id(self, value):
-        if value:
-            self.cookies["sID"] = value
-        elif "sID" in self.cookies:
-            self.cookies.pop("sID")
-
-    def login(self):
-        self.session_id = None
-        response = requests.post(
-            f"{self.api_endpoint}/authentication/login", json=self.credentials
-        )
-        if response.status_code == 200:
-            self.cookies["sID"] = response.text
-        else:
-            self.fail(
-                f"login failed with status code {response.status_code}, {response.text}"
+    def session_key(self) -> tuple:
+        return (self.api_endpoint, *self.credential_parameter_names)
+
+    def login(self) -> str:
+        """
+        logs in to the legacy REST API, and returns the session id. returns None if the login failed.
+        """
+        with metrics.timer("Login"):
+            response = http_session.session().post(
+                f"{self.api_endpoint}/authentication/login", json=self.credentials
             )
-
-    def logout(self):
-        if self.session_id:
-            response = requests.delete(
-                f"{self.api_endpoint}/authentication/logout",
-                cookies=self.cookies,
-                params={"sID": self.session_id},
-            )
-            if response.status_code == 200:
-                self.session_id = None
-            else:
-                log.error(
-                    f"failed to logout with status code {response.status_code}, {response.text}"
+            if response.status_code in (401, 403):
+                log.info("login rejected, retrying with refreshed credentials")
+                secret_cache.secrets.invalidate(self.credential_parameter_names)
+                response = http_session.session().post(
+                    f"{self.api_endpoint}/authentication/login", json=self.credentials
                 )
+        if response.status_code == 200:
+            return response.text
+
+        self.fail(
+            f"login failed with status code {response.status_code}, {response.text}"
+        )
+        return None
+
+    def create_client(self) -> RestClient:
+        return RestClient(self.api_endpoint, self.session_key, self.login)
+
+    def call_api(self, method, path, **kwargs):
+        """
+        calls `path` of the legacy REST API with the client, which keeps the session in the
+        container and logs in again if it is rejected. returns None if the login failed.
+        """
+        with metrics.timer("Api"):
+            response = self.create_client().call(method, path, **kwargs)
+        if response is not None:
+            metrics.add("ApiBytesSent", len(response.request.body or b""), "Bytes")
+            metrics.add("ApiBytesReceived", len(response.content), "Bytes")
+        return response
 
     @property
     def body(self):
@@ -159,15 +176,11 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
             return None
 
     def create(self):
-        self.login()
-        if self.status == "FAILED":
-            return
-
         try:
-            response = requests.post(
-                self.resource_url, cookies=self.cookies, json=self.body
-            )
-            if response.status_code in (200, 201):
+            response = self.call_api("POST", self.resource_path, json=self.body)
+            if response is None:
+                self.physical_resource_id = "failed-to-create"
+            elif response.status_code in (200, 201):
                 r = response.json()
                 self.physical_resource_id = str(
                     r["AddAwsAccountResponse"]["internalId"]
@@ -181,26 +194,19 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
             self.physical_resource_id = "failed-to-create"
             self.fail(f"failed to create the cloud account, {e}")
 
-        self.logout()
-
     def update(self):
-        self.login()
-        if self.status == "FAILED":
-            return
-
         try:
-            response = requests.post(
-                f"{self.resource_url}/{self.physical_resource_id}/update",
-                cookies=self.cookies,
+            response = self.call_api(
+                "POST",
+                f"{self.resource_path}/{self.physical_resource_id}/update",
                 json=self.body,
             )
-            if response.status_code not in (200, 201, 204):
+            if response is not None and response.status_code not in (200, 201, 204):
                 self.fail(
                     f"Could not update the cloud account with code {response.status_code}, {response.text}"
                 )
         except IOError as e:
             self.fail(f"failed to update the cloud account, {e}")
-        self.logout()
 
     def delete(self):
         if (
@@ -209,26 +215,23 @@ class DeepSecurityAWSCloudAccountProvider(ResourceProvider):
         ):
             return
 
-        self.login()
-        if self.status == "FAILED":
-            return
-
         try:
-            response = requests.delete(
-                f"{self.resource_url}/{self.physical_resource_id}", cookies=self.cookies
+            response = self.call_api(
+                "DELETE", f"{self.resource_path}/{self.physical_resource_id}"
             )
-            if response.status_code not in (200, 204, 404):
+            if response is not None and response.status_code not in (200, 204, 404):
                 self.fail(
                     f"Could not delete the cloud account with code {response.status_code}, {response.text}"
                 )
         except IOError as e:
             self.fail(f"failed to delete the cloud account, {e}")
 
-        self.logout()
-
 
 provider = DeepSecurityAWSCloudAccountProvider()
 
 
 def handler(request, context):
-    return provider.handle(request, context)
+    with metrics.invocation(
+        "DeepSecurityAWSCloudAccountProvider", ResourceType=request.get("ResourceType")
+    ), deadline.invocation(context):
+        return provider.handle(request, context)
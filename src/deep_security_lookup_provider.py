@@ -1,10 +1,13 @@
 import os
+import json
 import logging
-import requests
+import deadline
+import lookup_cache
+import catalog_index
+import metrics
 from deep_security_provider import DeepSecurityProvider
 import copy
 
-
 log = logging.getLogger()
 log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
@@ -47,6 +50,9 @@ request_schema = {
                 "portList",
                 "schedule",
                 "policy",
+                "intrusionPreventionRule",
+                "integrityMonitoringRule",
+                "logInspectionRule",
             ],
         },
         "Search": {
@@ -82,17 +88,6 @@ class DeepSecurityLookupProvider(DeepSecurityProvider):
     def search_type(self):
         return self.get("Type")
 
-    @property
-    def search_type_plural(self):
-        if self.search_type[-1] == "y":
-            return f"{self.search_type[0:-1]}ies"
-        else:
-            return f"{self.search_type}s"
-
-    @property
-    def resource_url(self):
-        return f"{self.api_endpoint}/{self.search_type_plural.lower()}/search"
-
     @property
     def search_criteria(self):
         result = copy.deepcopy(self.get("Search", {}))
@@ -104,35 +99,69 @@ class DeepSecurityLookupProvider(DeepSecurityProvider):
             )
         return result
 
+    @property
+    def cache_key(self):
+        if self.get("Search"):
+            name = json.dumps(self.search_criteria, sort_keys=True)
+        else:
+            name = self.get("Name")
+        return (
+            lookup_cache.endpoint_key(
+                self.api_endpoint, self.headers["api-secret-key"], self.api_version
+            ),
+            self.search_type,
+            name,
+        )
+
     def search(self):
         self.add_api_key()
-        try:
-            response = requests.post(
-                self.resource_url, headers=self.headers, json=self.search_criteria
-            )
-            if response.status_code in (200, 201):
-                results = response.json()
-                if self.search_type_plural in results:
-                    ids = list(
-                        map(
-                            lambda r: r["ID"],
-                            filter(
-                                lambda r: "ID" in r, results[self.search_type_plural]
-                            ),
-                        )
-                    )
-                    if not ids or len(ids) > 1:
-                        self.fail(f"expected precisely 1 result, got {len(ids)}")
-                    else:
-                        self.physical_resource_id = str(ids[0])
-                else:
-                    self.fail(
-                        f"no {self.search_type_plural} found in search result, did find {results.keys()}"
-                    )
-            else:
-                self.fail(f"Search for {self.search_type} failed, {response.text}")
-        except IOError as e:
-            self.fail(f"Search for {self.search_type} failed, {e}")
+        key = self.cache_key
+        value, count = lookup_cache.get(key)
+        if value is not None or count is not None:
+            metrics.add("LookupCacheHits")
+        else:
+            metrics.add("LookupCacheMisses")
+            ids, err = lookup_cache.flights.do(key, self.find)
+            if err:
+                self.fail(err)
+                return
+            value, count = lookup_cache.result(ids)
+
+        if value is None:
+            self.fail(f"expected precisely 1 result, got {count}")
+        else:
+            self.physical_resource_id = str(value)
+
+    def find(self) -> (list, str):
+        """
+        returns the IDs of all objects matching the search, and caches the result.
+        """
+        if not self.get("Search") and catalog_index.indexes.is_indexed(
+            self.search_type
+        ):
+            ids, err = self.index_search()
+        else:
+            ids, err = self.api_search()
+        if not err:
+            lookup_cache.put(self.cache_key, ids)
+        return ids, err
+
+    def api_search(self) -> (list, str):
+        results, err = self.client.find(self.search_type, self.search_criteria)
+        if err:
+            return None, err
+        return [r["ID"] for r in results if "ID" in r], None
+
+    def index_search(self) -> (list, str):
+        ids, err = catalog_index.indexes.lookup(
+            self.cache_key[0],
+            self.search_type,
+            self.get("Name"),
+            self.client.find_all,
+        )
+        if err:
+            return None, f"Search for {self.search_type} failed, {err}"
+        return ids, None
 
     def create(self):
         self.search()
@@ -150,4 +179,7 @@ provider = DeepSecurityLookupProvider()
 
 
 def handler(request, context):
-    return provider.handle(request, context)
+    with metrics.invocation(
+        "DeepSecurityLookupProvider", ResourceType=request.get("ResourceType")
+    ), deadline.invocation(context):
+        return provider.handle(request, context)
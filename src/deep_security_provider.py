@@ -1,8 +1,12 @@
 import os
-import json
+import copy
 import logging
-import boto3
-import requests
+import deadline
+import lookup_cache
+import catalog_index
+import metrics
+import secret_cache
+from async_client import ApiClient
 from cfn_resource_provider import ResourceProvider
 from template_substitutor import TemplateSubstitutor
 
@@ -31,9 +35,20 @@ request_schema = {
                     "default": "/cfn-deep-security-provider/api_key",
                     "description": "Name of the parameter in the Parameter Store for the API key",
                 },
+                "MaxConcurrentLookups": {
+                    "type": "integer",
+                    "default": 8,
+                    "minimum": 1,
+                    "description": "maximum number of lookups to resolve concurrently",
+                },
             },
         },
         "Value": {"type": "object", "description": "values for this resource"},
+        "PartialUpdate": {
+            "type": "boolean",
+            "default": False,
+            "description": "on update, only send the top-level fields of Value which changed",
+        },
     },
 }
 
@@ -42,18 +57,51 @@ class DeepSecurityProvider(ResourceProvider):
     def __init__(self):
         super(DeepSecurityProvider, self).__init__()
         self.headers = {}
-        self.ssm = boto3.client("ssm")
+        self.client = None
 
     def convert_property_types(self):
-        self.heuristic_convert_property_types(self.properties)
+        self.convert_types(self.properties)
+
+    def convert_types(self, properties: dict) -> dict:
+        self.heuristic_convert_property_types(properties)
         if (
             self.resource_type == "Custom::DeepSecurityFirewallRule"
-            and self.get("Value", {}).get("priority") is not None
+            and properties.get("Value", {}).get("priority") is not None
         ):
             # priority is an integer, presented as string :-(
-            self.properties["Value"]["priority"] = str(
-                self.get("Value").get("priority")
-            )
+            properties["Value"]["priority"] = str(properties["Value"].get("priority"))
+        return properties
+
+    @property
+    def normalized_old_properties(self) -> dict:
+        return self.convert_types(copy.deepcopy(self.old_properties))
+
+    def is_unchanged(self) -> bool:
+        """
+        returns true if the properties of an update, including the lookup templates, are the
+        same as the old properties.
+        """
+        if "OldResourceProperties" not in self.request:
+            return False
+
+        ignored = ("ServiceToken", "PartialUpdate")
+        old = {
+            k: v for k, v in self.normalized_old_properties.items() if k not in ignored
+        }
+        new = {k: v for k, v in self.properties.items() if k not in ignored}
+        return old == new
+
+    @property
+    def changed_value(self) -> dict:
+        """
+        returns the top-level fields of Value which are new or changed since the last update.
+        """
+        old = self.normalized_old_properties.get("Value", {})
+        return {k: v for k, v in self.get("Value", {}).items() if old.get(k) != v}
+
+    @property
+    def partial_update(self) -> bool:
+        return bool(self.get("PartialUpdate", False))
 
     def is_supported_resource_type(self):
         return self.resource_type.startswith("Custom::DeepSecurity")
@@ -62,6 +110,10 @@ class DeepSecurityProvider(ResourceProvider):
     def property_name(self):
         return self.resource_type.replace("Custom::DeepSecurity", "")
 
+    @property
+    def lookup_type(self):
+        return self.property_name[0].lower() + self.property_name[1:]
+
     @property
     def property_name_plural(self):
         name = self.property_name.lower()
@@ -70,15 +122,19 @@ class DeepSecurityProvider(ResourceProvider):
         else:
             return f"{name}s"
 
-    @property
-    def api_endpoint(self):
-        return self.get("Connection", {}).get(
+    @staticmethod
+    def get_api_endpoint(properties: dict) -> str:
+        return properties.get("Connection", {}).get(
             "URL", "https://app.deepsecurity.trendmicro.com/api"
         )
 
     @property
-    def resource_url(self):
-        return f"{self.api_endpoint}/{self.property_name_plural}"
+    def api_endpoint(self):
+        return self.get_api_endpoint(self.properties)
+
+    @property
+    def resource_path(self):
+        return self.property_name_plural
 
     @property
     def api_key_parameter_name(self):
@@ -87,8 +143,7 @@ class DeepSecurityProvider(ResourceProvider):
         )
 
     def get_ssm_parameter(self, name):
-        value = self.ssm.get_parameter(Name=name, WithDecryption=True)
-        return value["Parameter"]["Value"]
+        return secret_cache.secrets.get(name)
 
     @property
     def api_key(self):
@@ -98,16 +153,66 @@ class DeepSecurityProvider(ResourceProvider):
     def api_version(self):
         return self.get("Connection", {}).get("Version", "v1")
 
+    @property
+    def max_concurrent_lookups(self):
+        return int(self.get("Connection", {}).get("MaxConcurrentLookups", 8))
+
     def add_api_key(self):
         self.headers["api-secret-key"] = self.api_key
         self.headers["api-version"] = self.api_version
+        self.client = self.create_client()
+
+    def refresh_api_key(self) -> str:
+        """
+        reads the API key from the parameter store again, after it was rejected by the API.
+        """
+        secret_cache.secrets.invalidate([self.api_key_parameter_name])
+        self.headers["api-secret-key"] = self.api_key
+        return self.headers["api-secret-key"]
+
+    def call_api(self, method, path, **kwargs):
+        """
+        calls `path` of the Deep Security API with the client, which refreshes a rejected API
+        key and retries the call once.
+        """
+        with metrics.timer("Api"):
+            response = self.client.call(method, path, **kwargs)
+        metrics.add("ApiBytesSent", len(response.request.body or b""), "Bytes")
+        metrics.add("ApiBytesReceived", len(response.content), "Bytes")
+        return response
+
+    def create_client(self) -> ApiClient:
+        return ApiClient(
+            self.api_endpoint,
+            self.headers["api-secret-key"],
+            self.api_version,
+            refresh_api_key=self.refresh_api_key,
+        )
 
-    def get_resolved_value(self):
-        substitutor = TemplateSubstitutor(
-            self.api_endpoint, self.api_key, self.api_version
+    def create_substitutor(self) -> TemplateSubstitutor:
+        return TemplateSubstitutor(
+            self.api_endpoint,
+            self.headers["api-secret-key"],
+            self.api_version,
+            max_workers=self.max_concurrent_lookups,
+            client=self.client,
         )
+
+    def invalidate_lookups(self):
+        """
+        forgets the cached lookups and the catalog index of the type of this resource, so that
+        subsequent lookups find the objects it created, changed or deleted.
+        """
+        endpoint = lookup_cache.endpoint_key(
+            self.api_endpoint, self.headers["api-secret-key"], self.api_version
+        )
+        lookup_cache.invalidate(endpoint, self.lookup_type)
+        catalog_index.indexes.invalidate(endpoint, self.lookup_type)
+
+    def get_resolved_value(self, value: dict = None):
+        substitutor = self.create_substitutor()
         result, err = substitutor.replace_lookups(
-            json.loads(json.dumps(self.get("Value")))
+            value if value is not None else self.get("Value")
         )
         if err:
             self.fail(", ".join(err))
@@ -122,12 +227,11 @@ class DeepSecurityProvider(ResourceProvider):
             return
 
         try:
-            response = requests.post(
-                self.resource_url, headers=self.headers, json=value
-            )
+            response = self.call_api("POST", self.resource_path, json=value)
             if response.status_code in (200, 201):
                 r = response.json()
                 self.physical_resource_id = str(r["ID"])
+                self.invalidate_lookups()
             else:
                 self.physical_resource_id = "failed-to-create"
                 self.fail(
@@ -138,18 +242,32 @@ class DeepSecurityProvider(ResourceProvider):
             self.fail("Could not create the %s, %s" % (self.property_name, str(e)))
 
     def update(self):
+        if self.is_unchanged():
+            log.info(
+                "%s %s is unchanged, skipping update",
+                self.property_name,
+                self.physical_resource_id,
+            )
+            return
+
+        changes = None
+        if self.partial_update:
+            changes = self.changed_value
+            if not changes:
+                log.info("no changes in the value of %s", self.physical_resource_id)
+                return
 
         self.add_api_key()
-        url = "%s/%s" % (self.resource_url, self.physical_resource_id)
+        path = "%s/%s" % (self.resource_path, self.physical_resource_id)
 
-        value = self.get_resolved_value()
+        value = self.get_resolved_value(changes)
         if not value:
             return
 
         try:
-            response = requests.post(url, headers=self.headers, json=value)
+            response = self.call_api("POST", path, json=value)
             if response.status_code in (200, 201):
-                r = response.json()
+                self.invalidate_lookups()
             else:
                 self.fail(
                     "Could not update the %s, %s" % (self.property_name, response.text)
@@ -159,12 +277,12 @@ class DeepSecurityProvider(ResourceProvider):
 
     def delete(self):
         self.add_api_key()
-        url = "%s/%s" % (self.resource_url, self.physical_resource_id)
+        path = "%s/%s" % (self.resource_path, self.physical_resource_id)
 
         try:
-            response = requests.delete(url, headers=self.headers)
+            response = self.call_api("DELETE", path)
             if response.status_code in (200, 204, 404):
-                pass
+                self.invalidate_lookups()
             elif response.status_code == 400:
                 self.success("delete failed, %s" % response.text)
             else:
@@ -179,4 +297,7 @@ provider = DeepSecurityProvider()
 
 
 def handler(request, context):
-    return provider.handle(request, context)
+    with metrics.invocation(
+        "DeepSecurityProvider", ResourceType=request.get("ResourceType")
+    ), deadline.invocation(context):
+        return provider.handle(request, context)
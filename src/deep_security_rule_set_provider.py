@@ -0,0 +1,397 @@
+import os
+import json
+import uuid
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import async_client
+import deadline
+import metrics
+from deep_security_provider import DeepSecurityProvider
+
+log = logging.getLogger()
+log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+request_schema = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "type": "object",
+    "required": ["Type", "Values"],
+    "properties": {
+        "Connection": {
+            "type": "object",
+            "properties": {
+                "URL": {
+                    "type": "string",
+                    "default": "https://app.deepsecurity.trendmicro.com/api",
+                    "description": "endpoint of the deep security API",
+                },
+                "Version": {
+                    "type": "string",
+                    "default": "v1",
+                    "description": "of the api to use",
+                },
+                "ApiKeyParameterName": {
+                    "type": "string",
+                    "default": "/cfn-deep-security-provider/api_key",
+                    "description": "Name of the parameter in the Parameter Store for the API key",
+                },
+                "MaxConcurrentLookups": {
+                    "type": "integer",
+                    "default": 8,
+                    "minimum": 1,
+                    "description": "maximum number of lookups to resolve concurrently",
+                },
+                "MaxConcurrentRequests": {
+                    "type": "integer",
+                    "default": 8,
+                    "minimum": 1,
+                    "description": "maximum number of objects to create, update or delete concurrently",
+                },
+            },
+        },
+        "Type": {
+            "type": "string",
+            "description": "of the objects, as in Custom::DeepSecurity<Type>, eg FirewallRule",
+        },
+        "Key": {
+            "type": "string",
+            "default": "name",
+            "description": "field of the values which identifies an object in the set",
+        },
+        "Values": {
+            "type": "array",
+            "items": {"type": "object"},
+            "description": "values of the objects in this set",
+        },
+    },
+}
+
+Operation = Tuple[str, str, Optional[str], Optional[dict]]
+
+
+class DeepSecurityRuleSetProvider(DeepSecurityProvider):
+    """
+    manages a set of Deep Security objects of a single type in one custom resource. The objects
+    are identified by the value of the `Key` field, and are created, updated and deleted
+    concurrently. On update, only the objects which were added, changed or removed are sent.
+
+    If an object cannot be created or updated, the objects created so far are deleted and the
+    updated objects are restored to their previous value.
+    """
+
+    prefix = "ruleset-"
+
+    # the response to CloudFormation, including the status, reason and ids, may not exceed
+    # 4096 bytes.
+    max_data_size = 3072
+
+    def __init__(self):
+        super(DeepSecurityRuleSetProvider, self).__init__()
+        self.request_schema = request_schema
+
+    def is_supported_resource_type(self):
+        return self.resource_type == "Custom::DeepSecurityRuleSet"
+
+    def is_valid_request(self):
+        if not super(DeepSecurityRuleSetProvider, self).is_valid_request():
+            return False
+
+        values = self.get("Values")
+        if not all(v.get(self.key_name) is not None for v in values):
+            self.fail(f"'Values' must be a list of objects with a '{self.key_name}'")
+            return False
+
+        keys = [str(v[self.key_name]) for v in values]
+        duplicates = sorted(set(k for k in keys if keys.count(k) > 1))
+        if duplicates:
+            self.fail(f"duplicate {self.key_name} in 'Values': {', '.join(duplicates)}")
+            return False
+
+        # the objects of the set are found by their key, so a new key would not find them
+        old_key = self.normalized_old_properties.get("Key", "name")
+        if self.request_type == "Update" and old_key != self.key_name:
+            self.fail(
+                f"'Key' cannot be changed from '{old_key}' to '{self.key_name}', "
+                "replace the resource instead"
+            )
+            return False
+
+        return True
+
+    def convert_types(self, properties: dict) -> dict:
+        self.heuristic_convert_property_types(properties)
+        if properties.get("Type") == "FirewallRule":
+            for value in properties.get("Values", []):
+                if isinstance(value, dict) and value.get("priority") is not None:
+                    # priority is an integer, presented as string :-(
+                    value["priority"] = str(value["priority"])
+        return properties
+
+    @property
+    def property_name(self):
+        return self.get("Type")
+
+    @property
+    def key_name(self) -> str:
+        return self.get("Key", "name")
+
+    @property
+    def max_concurrent_requests(self) -> int:
+        return int(self.get("Connection", {}).get("MaxConcurrentRequests", 8))
+
+    def keyed(self, values: List[dict]) -> "OrderedDict[str, dict]":
+        return OrderedDict((str(v[self.key_name]), v) for v in values)
+
+    @property
+    def values(self) -> "OrderedDict[str, dict]":
+        return self.keyed(self.get("Values", []))
+
+    @property
+    def old_values(self) -> "OrderedDict[str, dict]":
+        return self.keyed(self.normalized_old_properties.get("Values", []))
+
+    def requires_replacement(self) -> bool:
+        """
+        returns true if the update changes the type or endpoint of the objects, which creates a
+        new set. CloudFormation deletes the old set afterwards.
+        """
+        old = self.normalized_old_properties
+        return (
+            old.get("Type") != self.get("Type")
+            or self.get_api_endpoint(old) != self.api_endpoint
+        )
+
+    def concurrently(self, function, items: list) -> list:
+        """
+        returns the results of `function` for all `items`, with at most MaxConcurrentRequests
+        calls in flight.
+        """
+        return async_client.map(function, items, self.max_concurrent_requests)
+
+    def find_id(self, key: str) -> (Optional[str], Optional[str]):
+        """
+        returns the ID of the object with `key`, or None if there is no such object.
+        """
+        search = {
+            "maxItems": 2,
+            "searchCriteria": [{"fieldName": self.key_name, "stringValue": key}],
+        }
+        objects, err = self.client.find(self.lookup_type, search)
+        if err:
+            return None, err
+        if len(objects) > 1:
+            return None, f"{self.property_name} '{key}' is ambiguous"
+        return (str(objects[0]["ID"]) if objects else None), None
+
+    def find_ids(self, keys: List[str]) -> (Dict[str, str], List[str]):
+        """
+        returns the IDs of the existing objects with `keys`.
+        """
+        ids = {}
+        errors = []
+        for key, (object_id, err) in zip(keys, self.concurrently(self.find_id, keys)):
+            if err:
+                errors.append(err)
+            elif object_id is not None:
+                ids[key] = object_id
+        return ids, errors
+
+    def execute_operation(self, operation: Operation) -> (Optional[str], Optional[str]):
+        """
+        executes a create, update or delete of a single object, and returns its ID.
+        """
+        action, key, object_id, value = operation
+        path = f"{self.resource_path}/{object_id}" if object_id else self.resource_path
+        try:
+            if action == "delete":
+                response = self.call_api("DELETE", path)
+                if response.status_code in (200, 204, 404):
+                    return object_id, None
+                if response.status_code == 400:
+                    log.warning("delete of %s failed, %s", key, response.text)
+                    return object_id, None
+            else:
+                response = self.call_api("POST", path, json=value)
+                if response.status_code in (200, 201):
+                    return str(response.json()["ID"]), None
+            return (
+                None,
+                f"Could not {action} the {self.property_name} '{key}', {response.text}",
+            )
+        except IOError as e:
+            return None, f"Could not {action} the {self.property_name} '{key}', {e}"
+
+    def execute_operations(
+        self, operations: List[Operation]
+    ) -> (Dict[str, str], List[str]):
+        """
+        executes all `operations` concurrently, and returns the IDs of the objects for which
+        the operation succeeded.
+        """
+        ids = {}
+        errors = []
+        for operation, (object_id, err) in zip(
+            operations, self.concurrently(self.execute_operation, operations)
+        ):
+            if err:
+                errors.append(err)
+            else:
+                ids[operation[1]] = object_id
+        metrics.add("RuleSetOperations", len(operations))
+        if operations:
+            self.invalidate_lookups()
+        return ids, errors
+
+    def resolve_values(self, values: "OrderedDict[str, dict]") -> Optional[dict]:
+        """
+        returns `values` with all lookups resolved, or None if a lookup failed.
+        """
+        resolved = self.get_resolved_value(list(values.values()))
+        return (
+            OrderedDict(zip(values.keys(), resolved)) if resolved is not None else None
+        )
+
+    def rollback(self, created: Dict[str, str], updated: Dict[str, str]):
+        """
+        deletes the `created` objects, and restores the `updated` objects to their old value.
+        """
+        log.info(
+            "rolling back %d created and %d updated %s objects",
+            len(created),
+            len(updated),
+            self.property_name,
+        )
+        operations = [("delete", k, i, None) for k, i in created.items()]
+        if updated:
+            old_values = self.old_values
+            restored = self.resolve_values(
+                OrderedDict((k, old_values[k]) for k in updated)
+            )
+            if restored is not None:
+                operations.extend(
+                    ("update", k, updated[k], v) for k, v in restored.items()
+                )
+        _, errors = self.execute_operations(operations)
+        metrics.add("RuleSetRollbacks")
+        for err in errors:
+            log.error("rollback failed, %s", err)
+
+    def set_ids(self, ids: Dict[str, str]):
+        """
+        returns all IDs in the order of Values as the attribute `IDs`, and the ID of each
+        object as the attribute named by its key. The response to CloudFormation is limited
+        to 4096 bytes: if the attributes per key do not fit in `max_data_size`, only `IDs`
+        is returned.
+        """
+        keys = list(self.values.keys())
+        data = OrderedDict([("IDs", ",".join(ids[k] for k in keys))])
+        per_key = OrderedDict((k, ids[k]) for k in keys)
+        if len(json.dumps(dict(data, **per_key))) <= self.max_data_size:
+            data.update(per_key)
+        else:
+            log.warning(
+                "returning only IDs, the IDs of %d objects by key exceed %d bytes",
+                len(keys),
+                self.max_data_size,
+            )
+        for name, value in data.items():
+            self.set_attribute(name, value)
+
+    def create(self):
+        self.add_api_key()
+        values = self.resolve_values(self.values)
+        if values is None:
+            self.physical_resource_id = "failed-to-create"
+            return
+
+        ids, errors = self.execute_operations(
+            [("create", k, None, v) for k, v in values.items()]
+        )
+        if errors:
+            self.rollback(ids, {})
+            self.physical_resource_id = "failed-to-create"
+            self.fail(", ".join(errors))
+            return
+
+        self.physical_resource_id = f"{self.prefix}{uuid.uuid4()}"
+        self.set_ids(ids)
+
+    def update(self):
+        if self.requires_replacement():
+            self.create()
+            return
+
+        self.add_api_key()
+        old_values, new_values = self.old_values, self.values
+        ids, errors = self.find_ids(list(old_values.keys()))
+        if errors:
+            self.fail(", ".join(errors))
+            return
+
+        # objects which disappeared since the last update are created again
+        added = [k for k in new_values if k not in ids]
+        changed = [k for k in new_values if k in ids and old_values[k] != new_values[k]]
+        removed = [k for k in old_values if k not in new_values and k in ids]
+        log.info(
+            "%s set: %d added, %d changed, %d removed",
+            self.property_name,
+            len(added),
+            len(changed),
+            len(removed),
+        )
+
+        values = self.resolve_values(
+            OrderedDict((k, new_values[k]) for k in added + changed)
+        )
+        if values is None:
+            return
+
+        result, errors = self.execute_operations(
+            [("create", k, None, values[k]) for k in added]
+            + [("update", k, ids[k], values[k]) for k in changed]
+        )
+        if errors:
+            self.rollback(
+                {k: result[k] for k in added if k in result},
+                {k: ids[k] for k in changed if k in result},
+            )
+            self.fail(", ".join(errors))
+            return
+        ids.update(result)
+
+        # objects are removed once all others are in place. A failed delete is not rolled
+        # back: the rollback of the stack update creates the deleted objects again.
+        _, errors = self.execute_operations(
+            [("delete", k, ids[k], None) for k in removed]
+        )
+        self.set_ids(ids)
+        if errors:
+            self.fail(", ".join(errors))
+
+    def delete(self):
+        if not self.physical_resource_id.startswith(self.prefix):
+            log.info("%s was never created", self.physical_resource_id)
+            return
+
+        self.add_api_key()
+        keys = list(self.values.keys())
+        ids, errors = self.find_ids(keys)
+        if errors:
+            self.fail(", ".join(errors))
+            return
+
+        _, errors = self.execute_operations(
+            [("delete", k, ids[k], None) for k in keys if k in ids]
+        )
+        if errors:
+            self.fail(", ".join(errors))
+
+
+provider = DeepSecurityRuleSetProvider()
+
+
+def handler(request, context):
+    with metrics.invocation(
+        "DeepSecurityRuleSetProvider", ResourceType=request.get("ResourceType")
+    ), deadline.invocation(context):
+        return provider.handle(request, context)
@@ -1,10 +1,9 @@
 import os
 import logging
-import boto3
-import requests
+import deadline
+import metrics
 from deep_security_provider import DeepSecurityProvider
 
-
 log = logging.getLogger()
 log.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 
@@ -19,9 +18,7 @@ class DeepSecuritySystemSettingProvider(DeepSecurityProvider):
     def do_update(self):
         self.add_api_key()
         try:
-            response = requests.post(
-                self.resource_url, headers=self.headers, json=self.get("Value")
-            )
+            response = self.call_api("POST", self.resource_path, json=self.get("Value"))
             if response.status_code in (200, 201):
                 r = response.json()
             else:
@@ -38,6 +35,9 @@ class DeepSecuritySystemSettingProvider(DeepSecurityProvider):
             self.physical_resource_id = "failed-to-create"
 
     def update(self):
+        if self.is_unchanged():
+            log.info("system settings are unchanged, skipping update")
+            return
         self.do_update()
 
     def delete(self):
@@ -48,4 +48,7 @@ provider = DeepSecuritySystemSettingProvider()
 
 
 def handler(request, context):
-    return provider.handle(request, context)
+    with metrics.invocation(
+        "DeepSecuritySystemSettingProvider", ResourceType=request.get("ResourceType")
+    ), deadline.invocation(context):
+        return provider.handle(request, context)
@@ -0,0 +1,196 @@
+import os
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import deadline
+import metrics
+from rate_limiter import Limiters, parse_retry_after
+
+log = logging.getLogger()
+
+# server errors which are worth retrying
+server_errors = (500, 502, 503, 504)
+
+
+class DeepSecurityRetry(Retry):
+    """
+    retries server errors only for idempotent methods: a failed create may have been processed,
+    and retrying it could create the object twice. Searches, which are POSTs, and throttled
+    requests are retried by the session, so that the rate limiter sees every attempt.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return False
+        return super(DeepSecurityRetry, self).is_retry(
+            method, status_code, has_retry_after
+        )
+
+    def is_exhausted(self) -> bool:
+        # a retry which cannot finish before the deadline is not attempted
+        return super(DeepSecurityRetry, self).is_exhausted() or not (
+            deadline.current.allows(self.get_backoff_time())
+        )
+
+    def increment(self, *args, **kwargs):
+        metrics.add("Retries")
+        return super(DeepSecurityRetry, self).increment(*args, **kwargs)
+
+
+class DeadlineSession(requests.Session):
+    """
+    a session which times out requests after `timeout` seconds, or earlier when the deadline of
+    the invocation is near. A request cannot be started once the deadline has passed.
+
+    Requests to a host pass through its adaptive rate limiter. Throttled requests (429) are
+    retried for all methods, up to `retries` times, after the Retry-After delay or with
+    exponential backoff. Server errors of searches are retried in the same way: a search
+    does not change anything, although it is a POST.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 30,
+        limiters: Limiters = None,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+    ):
+        super(DeadlineSession, self).__init__()
+        self.timeout = timeout
+        self.limiters = limiters if limiters else Limiters()
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    @staticmethod
+    def is_search(method: str, url: str) -> bool:
+        return method.upper() == "POST" and urlparse(url).path.endswith("/search")
+
+    def request(self, method, url, *args, **kwargs):
+        action = f"calling {method} {url}"
+        timeout = kwargs.get("timeout")
+        limiter = self.limiters.get(urlparse(url).netloc)
+        attempt = 0
+        while True:
+            started = limiter.acquire(action)
+            try:
+                kwargs["timeout"] = (
+                    timeout
+                    if timeout is not None
+                    else deadline.current.timeout(self.timeout, action)
+                )
+                response = super(DeadlineSession, self).request(
+                    method, url, *args, **kwargs
+                )
+            except requests.exceptions.Timeout:
+                limiter.release(started, throttled=False)
+                # a timeout which was shortened by the deadline is reported as such
+                deadline.current.check(action)
+                raise
+            except BaseException:
+                limiter.release(started, throttled=False)
+                raise
+
+            throttled = response.status_code == 429
+            if throttled:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                delay = (
+                    retry_after
+                    if retry_after is not None
+                    else self.backoff_factor * (2**attempt)
+                )
+                limiter.release(started, throttled=True, retry_after=delay)
+                metrics.add("Throttles")
+            elif response.status_code in server_errors and self.is_search(method, url):
+                delay = self.backoff_factor * (2**attempt)
+                limiter.release(started, throttled=False)
+            else:
+                limiter.release(started, throttled=False)
+                return response
+
+            if attempt >= self.retries or not deadline.current.allows(delay):
+                return response
+
+            attempt += 1
+            metrics.add("Retries")
+            response.close()
+            log.debug(
+                "%s failed with %d, retrying in %.1fs",
+                action,
+                response.status_code,
+                delay,
+            )
+            if not throttled:
+                # the rate limiter only waits for throttled hosts
+                time.sleep(delay)
+
+
+def create_session(
+    pool_size: int = 10,
+    retries: int = 3,
+    backoff_factor: float = 0.5,
+    timeout: float = 30,
+    limiters: Limiters = None,
+) -> requests.Session:
+    """
+    creates a session with a keep-alive connection pool of `pool_size` connections per host,
+    which retries throttled and failed requests with exponential backoff, and times out
+    requests after `timeout` seconds. Requests are limited by `limiters`, which defaults to
+    a rate of 50 requests per second and at most `pool_size` concurrent requests per host.
+    """
+    retry = DeepSecurityRetry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=server_errors,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    result = DeadlineSession(
+        timeout,
+        limiters if limiters else Limiters(max_concurrency=pool_size),
+        retries,
+        backoff_factor,
+    )
+    # the session is shared by all tenants, so it must not keep cookies between requests
+    result.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    result.mount("https://", adapter)
+    result.mount("http://", adapter)
+    return result
+
+
+_session = None
+_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+    """
+    returns the session shared by all Deep Security API calls in this container.
+    """
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                pool_size = int(os.getenv("HTTP_POOL_SIZE", "10"))
+                _session = create_session(
+                    pool_size=pool_size,
+                    retries=int(os.getenv("HTTP_MAX_RETRIES", "3")),
+                    backoff_factor=float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5")),
+                    timeout=float(os.getenv("HTTP_TIMEOUT", "30")),
+                    limiters=Limiters(
+                        rate=float(os.getenv("HTTP_RATE_LIMIT", "50")),
+                        burst=float(os.getenv("HTTP_BURST", "100")),
+                        max_concurrency=int(
+                            os.getenv("HTTP_MAX_CONCURRENCY", str(pool_size))
+                        ),
+                    ),
+                )
+    return _session
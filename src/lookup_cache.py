@@ -0,0 +1,231 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+import cache_backend
+
+log = logging.getLogger()
+
+
+def endpoint_key(api_endpoint: str, api_key: str, api_version: str) -> str:
+    """
+    returns the key of the Deep Security tenant behind `api_endpoint`. Different API keys on
+    the same endpoint may point to different tenants, so a digest of the key is included.
+    """
+    digest = hashlib.sha256(f"{api_version}:{api_key}".encode("utf-8")).hexdigest()
+    return f"{api_endpoint}#{digest[:16]}"
+
+
+class LookupCache(object):
+    """
+    thread-safe cache of resolved Deep Security IDs, keyed by (endpoint, ds_type, name).
+
+    Entries expire `ttl` seconds after they were stored. When more than `max_size` entries
+    are cached, the least recently used entry is evicted. Entries are also written to the
+    `backend`, which is consulted on a miss.
+    """
+
+    namespace = "lookup"
+
+    def __init__(
+        self,
+        ttl: float = 300,
+        max_size: int = 4096,
+        backend: cache_backend.CacheBackend = None,
+    ):
+        super(LookupCache, self).__init__()
+        self.ttl = ttl
+        self.max_size = max_size
+        self.backend = backend if backend else cache_backend.CacheBackend()
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def backend_key(self, key) -> tuple:
+        if key is None:
+            return (self.namespace,)
+        return (self.namespace,) + (key if isinstance(key, tuple) else (key,))
+
+    def get(self, key: tuple):
+        """
+        returns the cached value for `key`, or None if there is no valid entry.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry:
+                del self.entries[key]
+
+        if self.ttl > 0:
+            value, expires = self.backend.get_entry(self.backend_key(key))
+            if value is not None:
+                with self.lock:
+                    self.hits += 1
+                # the entry expires from memory when it expires from the backend
+                self._put(key, value, expires - time.time())
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: tuple, value):
+        if self.ttl <= 0:
+            return
+        self._put(key, value, self.ttl)
+        self.backend.put(self.backend_key(key), value, self.ttl)
+
+    def _put(self, key: tuple, value, ttl: float):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + min(ttl, self.ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: tuple = None):
+        """
+        removes `key`, and all entries whose key starts with `key`, from the cache, or all
+        entries if no key is specified.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                for k in [k for k in self.entries if k[0 : len(key)] == key]:
+                    del self.entries[k]
+        self.backend.invalidate(self.backend_key(key))
+
+    @property
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class NegativeCache(LookupCache):
+    """
+    caches the number of objects found by lookups which did not find precisely one object, so
+    that lookups which fail are not repeated against the API for `ttl` seconds. The error
+    message is left to the caller, as the cache is shared by the substitutor and the lookup
+    provider.
+    """
+
+    namespace = "negative"
+
+
+class Flight(object):
+    def __init__(self):
+        super(Flight, self).__init__()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    coalesces concurrent calls for the same key: the first caller executes the call, and all
+    callers which arrive while it is in flight wait for, and share, its result.
+    """
+
+    def __init__(self):
+        super(SingleFlight, self).__init__()
+        self.flights: Dict[tuple, Flight] = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: tuple, function: Callable):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+cache = LookupCache(
+    ttl=float(os.getenv("LOOKUP_CACHE_TTL", "300")),
+    max_size=int(os.getenv("LOOKUP_CACHE_SIZE", "4096")),
+    backend=cache_backend.backend,
+)
+negative_cache = NegativeCache(
+    ttl=float(os.getenv("LOOKUP_NEGATIVE_CACHE_TTL", "30")),
+    max_size=int(os.getenv("LOOKUP_CACHE_SIZE", "4096")),
+    backend=cache_backend.backend,
+)
+flights = SingleFlight()
+
+
+def result(ids: List) -> tuple:
+    """
+    returns the ID of a lookup which found `ids`, or None and the number of IDs if there is
+    not precisely one.
+    """
+    return (ids[0], None) if len(ids) == 1 else (None, len(ids))
+
+
+def get(key: tuple) -> tuple:
+    """
+    returns the cached (ID, None) of the lookup `key`, (None, count) if the lookup did not find
+    precisely one object, or (None, None) if there is no cached result.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value, None
+    return None, negative_cache.get(key)
+
+
+def put(key: tuple, ids: List):
+    """
+    caches the result of the lookup `key`, which found `ids`.
+    """
+    value, count = result(ids)
+    if value is not None:
+        cache.put(key, value)
+    else:
+        negative_cache.put(key, count)
+
+
+def invalidate(endpoint: str, ds_type: str):
+    """
+    forgets all lookups of `ds_type` at `endpoint`, after an object of that type was created,
+    changed or deleted.
+    """
+    cache.invalidate((endpoint, ds_type))
+    negative_cache.invalidate((endpoint, ds_type))
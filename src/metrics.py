@@ -0,0 +1,111 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+
+class Metrics(object):
+    """
+    accumulates the timings and counters of a single invocation, and writes them as one
+    CloudWatch Embedded Metric Format (EMF) log line.
+
+    Values with the same name are summed, so a phase which is executed more than once reports
+    its total time, and `<Phase>Calls` reports how often it was executed.
+    """
+
+    def __init__(self, namespace: str, **dimensions: str):
+        super(Metrics, self).__init__()
+        self.namespace = namespace
+        self.dimensions = {k: v for k, v in dimensions.items() if v is not None}
+        self.values: Dict[str, float] = {}
+        self.units: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, value: float = 1, unit: str = "Count"):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    @contextmanager
+    def timer(self, phase: str):
+        """
+        adds the elapsed time of the block to `<phase>Time` and counts `<phase>Calls`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(
+                f"{phase}Time", (time.perf_counter() - start) * 1000, "Milliseconds"
+            )
+            self.add(f"{phase}Calls")
+
+    def to_emf(self) -> dict:
+        with self.lock:
+            values = dict(self.values)
+            units = dict(self.units)
+        result = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": self.namespace,
+                        "Dimensions": [sorted(self.dimensions.keys())],
+                        "Metrics": [
+                            {"Name": name, "Unit": units[name]}
+                            for name in sorted(values.keys())
+                        ],
+                    }
+                ],
+            }
+        }
+        result.update(self.dimensions)
+        result.update(
+            {
+                name: round(value, 3) if isinstance(value, float) else value
+                for name, value in values.items()
+            }
+        )
+        return result
+
+    def emit(self, stream=None):
+        (stream if stream else sys.stdout).write(
+            json.dumps(self.to_emf(), separators=(",", ":")) + "\n"
+        )
+
+
+namespace = os.getenv("METRICS_NAMESPACE", "cfn-deep-security-provider")
+current = Metrics(namespace)
+
+
+def add(name: str, value: float = 1, unit: str = "Count"):
+    """
+    adds `value` to the metric `name` of the current invocation.
+    """
+    current.add(name, value, unit)
+
+
+def timer(phase: str):
+    """
+    times `phase` in the current invocation.
+    """
+    return current.timer(phase)
+
+
+@contextmanager
+def invocation(service: str, **dimensions: str):
+    """
+    starts a new set of metrics for an invocation of `service`, and emits them when the block
+    ends. Nothing is emitted if METRICS_NAMESPACE is empty.
+    """
+    global current
+    current = Metrics(namespace, Service=service, **dimensions)
+    try:
+        with current.timer("Invocation"):
+            yield current
+    finally:
+        if namespace:
+            current.emit()
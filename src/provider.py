@@ -1,21 +1,27 @@
 import os
 import logging
-import deep_security_provider
-import deep_security_system_settings_provider
-import deep_security_lookup_provider
-import deep_security_aws_cloudaccount_provider
+import importlib
 
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 
+providers = {
+    "Custom::DeepSecuritySystemSetting": "deep_security_system_settings_provider",
+    "Custom::DeepSecurityLookup": "deep_security_lookup_provider",
+    "Custom::DeepSecurityAWSCloudAccount": "deep_security_aws_cloudaccount_provider",
+    "Custom::DeepSecurityRuleSet": "deep_security_rule_set_provider",
+}
+
+
+def provider_module(resource_type: str):
+    """
+    returns the provider module for `resource_type`, which is imported on first use. All
+    other Custom::DeepSecurity resource types are handled by deep_security_provider.
+    """
+    return importlib.import_module(
+        providers.get(resource_type, "deep_security_provider")
+    )
+
 
 def handler(request, context):
-    request_type = request["ResourceType"]
-    if request_type == "Custom::DeepSecuritySystemSetting":
-        return deep_security_system_settings_provider.handler(request, context)
-    elif request_type == "Custom::DeepSecurityLookup":
-        return deep_security_lookup_provider.handler(request, context)
-    elif request_type == "Custom::DeepSecurityAWSCloudAccount":
-        return deep_security_aws_cloudaccount_provider.handler(request, context)
-    else:
-        return deep_security_provider.handler(request, context)
+    return provider_module(request["ResourceType"]).handler(request, context)
@@ -0,0 +1,172 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+import deadline
+import metrics
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    returns the seconds to wait from a Retry-After header, which is either a number of seconds
+    or an HTTP date. Returns None if there is no valid header.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    """
+    hands out `rate` tokens per second, with bursts of at most `burst` tokens.
+
+    A token is reserved immediately, and `take` returns the time to wait before it may be used,
+    so callers are served in order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        super(TokenBucket, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class AdaptiveLimiter(object):
+    """
+    limits the request rate and the number of concurrent requests to a single host, and adapts
+    both with additive increase, multiplicative decrease (AIMD): every successful request raises
+    the limits by about 1 per round trip, every throttled request halves them. Requests which
+    were started before the last decrease do not decrease the limits again, so a burst of 429
+    responses counts as a single congestion event.
+
+    A Retry-After delay of a throttled request pauses all requests to the host.
+    """
+
+    def __init__(
+        self,
+        rate: float = 50,
+        burst: float = 100,
+        max_concurrency: int = 10,
+        min_rate: float = 0.5,
+        decrease: float = 0.5,
+    ):
+        super(AdaptiveLimiter, self).__init__()
+        self.bucket = TokenBucket(rate, burst)
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.decrease = decrease
+        self.active = 0
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.condition = threading.Condition()
+
+    @property
+    def rate(self) -> float:
+        return self.bucket.rate
+
+    def wait(self, seconds: Optional[float], action: str):
+        if seconds is not None and not deadline.current.allows(seconds):
+            raise deadline.DeadlineExceeded(deadline.current.diagnostics(action))
+        remaining = deadline.current.remaining
+        timeout = seconds if seconds is not None else remaining
+        self.condition.wait(None if timeout == float("inf") else timeout)
+        deadline.current.check(action)
+
+    def acquire(self, action: str = "waiting for the rate limiter") -> float:
+        """
+        waits for a concurrency slot and a token, and returns the time the request started.
+        Raises DeadlineExceeded if the wait would exceed the deadline.
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    self.wait(self.paused_until - now, action)
+                elif self.active >= int(self.concurrency):
+                    self.wait(None, action)
+                else:
+                    break
+            self.active += 1
+            delay = self.bucket.take()
+
+        if delay > 0:
+            if not deadline.current.allows(delay):
+                self.cancel()
+                raise deadline.DeadlineExceeded(deadline.current.diagnostics(action))
+            metrics.add("RateLimitTime", delay * 1000, "Milliseconds")
+            time.sleep(delay)
+        return now
+
+    def cancel(self):
+        """
+        releases the slot and the token of a request which was not sent, without adapting the
+        limits.
+        """
+        with self.condition:
+            self.active -= 1
+            self.bucket.tokens += 1
+            self.condition.notify_all()
+
+    def release(
+        self, started: float, throttled: bool, retry_after: Optional[float] = None
+    ):
+        """
+        releases the slot of a request started at `started`, and adapts the limits to its
+        outcome.
+        """
+        with self.condition:
+            self.active -= 1
+            if throttled:
+                now = time.monotonic()
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+                if started >= self.decreased_at:
+                    self.decreased_at = now
+                    self.concurrency = max(1.0, self.concurrency * self.decrease)
+                    self.bucket.rate = max(self.min_rate, self.rate * self.decrease)
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+                self.bucket.rate = min(self.max_rate, self.rate + 1 / self.rate)
+            self.condition.notify_all()
+
+
+class Limiters(object):
+    """
+    the adaptive limiters of all hosts, created on first use.
+    """
+
+    def __init__(self, rate: float = 50, burst: float = 100, max_concurrency: int = 10):
+        super(Limiters, self).__init__()
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.limiters: Dict[str, AdaptiveLimiter] = {}
+        self.lock = threading.Lock()
+
+    def get(self, host: str) -> AdaptiveLimiter:
+        with self.lock:
+            result = self.limiters.get(host)
+            if result is None:
+                result = AdaptiveLimiter(self.rate, self.burst, self.max_concurrency)
+                self.limiters[host] = result
+            return result
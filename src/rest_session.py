@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict
+
+import http_session
+
+log = logging.getLogger()
+
+
+class RestSession(object):
+    """
+    a logged in session of the legacy Deep Security REST API, which expires after `ttl` seconds
+    of inactivity.
+    """
+
+    def __init__(self, api_endpoint: str, session_id: str, ttl: float):
+        super(RestSession, self).__init__()
+        self.api_endpoint = api_endpoint
+        self.session_id = session_id
+        self.ttl = ttl
+        self.expires = time.monotonic() + ttl
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def touch(self):
+        self.expires = time.monotonic() + self.ttl
+
+    def logout(self):
+        try:
+            response = http_session.session().delete(
+                f"{self.api_endpoint}/authentication/logout",
+                cookies={"sID": self.session_id},
+                params={"sID": self.session_id},
+            )
+            if response.status_code != 200:
+                log.error(
+                    f"failed to logout with status code {response.status_code}, {response.text}"
+                )
+        except IOError as e:
+            log.error(f"failed to logout, {e}")
+
+
+class RestSessions(object):
+    """
+    keeps a logged in session per endpoint and set of credentials in the container, so that
+    subsequent requests do not have to login and logout.
+
+    An expired session is logged out the next time its key is used or released. Lambda does not
+    run exit handlers when it shuts down a container, so the session of an idle container is
+    never logged out by the provider: it ends with the session timeout of the Deep Security Manager.
+    """
+
+    def __init__(self, ttl: float = 600):
+        super(RestSessions, self).__init__()
+        self.ttl = ttl
+        self.sessions: Dict[tuple, RestSession] = {}
+        self.locks: Dict[tuple, threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.logins = 0
+
+    def _lock(self, key: tuple) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def get(self, key: tuple, api_endpoint: str, login: Callable[[], str]) -> str:
+        """
+        returns the id of the session for `key`, calling `login` to obtain a new one if there is
+        no session or it has expired. returns None if the login failed.
+        """
+        with self._lock(key):
+            session = self.sessions.get(key)
+            if session and not session.expired:
+                return session.session_id
+
+            if session:
+                log.debug("session of %s expired", api_endpoint)
+                del self.sessions[key]
+                session.logout()
+
+            session_id = login()
+            if session_id:
+                self.logins += 1
+                self.sessions[key] = RestSession(api_endpoint, session_id, self.ttl)
+            return session_id
+
+    def touch(self, key: tuple):
+        session = self.sessions.get(key)
+        if session:
+            session.touch()
+
+    def invalidate(self, key: tuple, session_id: str):
+        """
+        forgets the session `session_id` of `key`, after it was rejected by the API.
+        """
+        with self._lock(key):
+            session = self.sessions.get(key)
+            if session and session.session_id == session_id:
+                del self.sessions[key]
+
+    def release(self, key: tuple):
+        """
+        logs out the session of `key` if it has expired, as it is when sessions are not reused.
+        """
+        with self._lock(key):
+            session = self.sessions.get(key)
+            if not session or not session.expired:
+                return
+            del self.sessions[key]
+        session.logout()
+
+    def close(self):
+        """
+        logs out all sessions.
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.logout()
+
+
+sessions = RestSessions(ttl=float(os.getenv("REST_SESSION_TTL", "600")))
@@ -1,21 +1,143 @@
 import os
 import argparse
-import re
+import json
 import sys
 import logging
+import itertools
+from typing import Iterable, Iterator, List
 
 import boto3
 from ruamel.yaml import YAML
 
+import async_client
+import cache_backend
+import catalog_snapshot
+import lookup_cache
+from async_client import ApiClient
+from catalog_snapshot import Snapshot, SnapshotWriter
+from deep_security_lookup_provider import request_schema as lookup_request_schema
+from search_query import Query, QueryError, compile_query
 from template_substitutor import TemplateSubstitutor
 
-if __name__ == "__main__":
+log = logging.getLogger()
 
-    logging.basicConfig(
-        format="%(level_name}s: %(message)s", level=os.getenv("LOG_LEVEL", "ERROR")
+
+class RecordWriter(object):
+    """
+    writes records to `stream` as they arrive, so that the output of a search does not have
+    to be kept in memory.
+    """
+
+    def __init__(self, stream):
+        super(RecordWriter, self).__init__()
+        self.stream = stream
+        self.count = 0
+
+    def write(self, record: dict):
+        self.count += 1
+
+    def write_all(self, records: Iterable[dict]):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        self.stream.flush()
+
+
+class NdjsonWriter(RecordWriter):
+    """
+    writes one JSON document per line.
+    """
+
+    def write(self, record: dict):
+        self.stream.write(json.dumps(record) + "\n")
+        super(NdjsonWriter, self).write(record)
+
+
+class JsonWriter(RecordWriter):
+    """
+    writes a single JSON array.
+    """
+
+    def write(self, record: dict):
+        self.stream.write(",\n  " if self.count else "[\n  ")
+        self.stream.write(json.dumps(record))
+        super(JsonWriter, self).write(record)
+
+    def close(self):
+        self.stream.write("\n]\n" if self.count else "[]\n")
+        super(JsonWriter, self).close()
+
+
+class YamlWriter(RecordWriter):
+    """
+    writes a single YAML sequence, one element at a time.
+    """
+
+    def __init__(self, stream):
+        super(YamlWriter, self).__init__(stream)
+        self.yaml = YAML()
+
+    def write(self, record: dict):
+        self.yaml.dump([record], self.stream)
+        super(YamlWriter, self).write(record)
+
+    def close(self):
+        if not self.count:
+            self.yaml.dump([], self.stream)
+        super(YamlWriter, self).close()
+
+
+writers = {"yaml": YamlWriter, "json": JsonWriter, "ndjson": NdjsonWriter}
+
+# all types supported by the Custom::DeepSecurityLookup provider
+lookup_types = lookup_request_schema["properties"]["Type"]["enum"]
+
+
+def query_records(
+    client: ApiClient, ds_type: str, query: Query, args: argparse.Namespace
+) -> Iterator[dict]:
+    """
+    returns the records matching `query`, as they arrive. The predicates which the API cannot
+    evaluate are applied to each page; a sort on a field other than ID needs all results first.
+    """
+    pages = client.pages(
+        ds_type,
+        query.search(),
+        args.page_size,
+        args.prefetch,
+        query.descending and query.sort_by_id,
+    )
+    records = (r for page in pages for r in page if query.matches(r))
+    if not query.sort_by_id:
+        records = iter(query.sort(list(records)))
+    return records if args.all else itertools.islice(records, args.max_items)
+
+
+def search_records(client: ApiClient, ds_type: str, search: dict) -> (List[dict], str):
+    """
+    returns the result of a single search, from the cache if possible.
+    """
+    key = (
+        lookup_cache.endpoint_key(
+            client.api_endpoint,
+            client.headers["api-secret-key"],
+            client.headers["api-version"],
+        ),
+        ds_type,
+        "search",
+        json.dumps(search, sort_keys=True),
     )
-    log = logging.getLogger()
-    parser = argparse.ArgumentParser(description="search DeepSecurity types.")
+    results = lookup_cache.cache.get(key)
+    if results is None:
+        results, err = async_client.run(client.search(ds_type, search))
+        if err:
+            return None, err
+        lookup_cache.cache.put(key, results)
+    return results, None
+
+
+def add_connection_arguments(parser: argparse.ArgumentParser):
     parser.add_argument(
         "--url",
         default="https://app.deepsecurity.trendmicro.com/api",
@@ -28,15 +150,9 @@ if __name__ == "__main__":
         default="/cfn-deep-security-provider/api_key",
         help="in the parameter store",
     )
-    parser.add_argument("--max-items", default=10, type=int, help="to return")
-    parser.add_argument(
-        "--type", required=True, help="to search for, eg policy, firewallRule, .."
-    )
-    parser.add_argument(
-        "--query", help="to execute, only supported format: field == value"
-    )
 
-    args = parser.parse_args()
+
+def get_api_key(parser: argparse.ArgumentParser, args: argparse.Namespace):
     if not args.api_key:
         try:
             ssm = boto3.client("ssm")
@@ -48,35 +164,178 @@ if __name__ == "__main__":
                 f"failed to retrieve api key from parameter store {args.api_key_parameter_name}, {e}"
             )
 
-    main = TemplateSubstitutor(
-        api_endpoint=args.url, api_key=args.api_key, api_version=args.api_version
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="search DeepSecurity types.",
+        epilog="use 'export' or 'resolve' as first argument to export a snapshot of all lookup "
+        "types, or to resolve the lookups in a file from a snapshot.",
+    )
+    add_connection_arguments(parser)
+    parser.add_argument("--max-items", default=10, type=int, help="to return")
+    parser.add_argument(
+        "--type", required=True, help="to search for, eg policy, firewallRule, .."
+    )
+    parser.add_argument(
+        "--query",
+        help='to execute, eg: name prefix "HTTP" and priority >= 2 sort by name',
     )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="return all results, page by page, instead of --max-items",
+    )
+    parser.add_argument(
+        "--page-size", default=1000, type=int, help="number of results per page"
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="request the next page while writing the current one",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=sorted(writers.keys()),
+        default="yaml",
+        help="of the results",
+    )
+    parser.add_argument(
+        "--cache",
+        choices=["none", "sqlite"],
+        default=os.getenv("CACHE_BACKEND", "none"),
+        help="to store search results in",
+    )
+    parser.add_argument(
+        "--cache-path",
+        default=os.getenv("CACHE_PATH", "/tmp/cfn-deep-security-provider/cache.db"),
+        help="of the sqlite cache",
+    )
+    return parser
+
+
+def export_main(argv: List[str], stream=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="search.py export",
+        description="export a snapshot of all DeepSecurity lookup types.",
+    )
+    add_connection_arguments(parser)
+    parser.add_argument(
+        "--output", required=True, help="of the gzip compressed snapshot"
+    )
+    parser.add_argument(
+        "--types",
+        default=",".join(lookup_types),
+        help="comma separated list of the types to export",
+    )
+    parser.add_argument(
+        "--page-size", default=1000, type=int, help="number of objects per page"
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        default=4,
+        type=int,
+        help="maximum number of concurrent requests",
+    )
+    args = parser.parse_args(argv)
+    get_api_key(parser, args)
+
+    types = [t.strip() for t in args.types.split(",") if t.strip()]
+    client = ApiClient(args.url, args.api_key, args.api_version, args.max_concurrency)
+    writer = SnapshotWriter(args.output, args.url)
+    try:
+        async_client.run(catalog_snapshot.export(client, writer, types, args.page_size))
+        writer.close()
+    except IOError as e:
+        sys.stderr.write(f"ERROR: {e}")
+        return 1
+    finally:
+        writer.abort()
 
-    search = {"maxItems": args.max_items}
-    if args.query:
-        match = re.fullmatch(
-            r"\s*(?P<fieldname>[^\s=]*)\s*(?P<operator>==)\s*\"(?P<value>[^\"]*)\"",
-            args.query,
-        )
-        if not match:
-            parser.error(f"unsupported query syntax '{args.query}'")
+    (stream if stream else sys.stdout).write(
+        f"exported {writer.count} objects of {len(types)} types to {args.output}\n"
+    )
+    return 0
 
-        query = match.groupdict()
-        if query["operator"] != "==":
-            parser.error(f"expected operator ==, found '{query['operator']}'")
-        if not query["fieldname"]:
-            parser.error("no fieldname found, {}".format(query["fieldname"]))
-        search["searchCriteria"] = {
-            "fieldName": query["fieldname"],
-            "stringValue": query["value"],
-        }
 
-    log.debug(f"{search} for {main.search_url(args.type)}\n")
+def resolve_main(argv: List[str], stream=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="search.py resolve",
+        description="resolve the lookups in a YAML or JSON file from a snapshot.",
+    )
+    parser.add_argument("--snapshot", required=True, help="created by export")
+    parser.add_argument("file", help="to resolve the lookups in, - for stdin")
+    args = parser.parse_args(argv)
 
-    results, err = main.search(args.type, search)
-    if err:
-        sys.stderr.write(f"ERROR: {err}")
-        sys.exit(1)
+    try:
+        snapshot = Snapshot.load(args.snapshot)
+    except (IOError, ValueError) as e:
+        parser.error(f"failed to load snapshot {args.snapshot}, {e}")
 
     yaml = YAML()
-    yaml.dump(results, sys.stdout)
+    if args.file == "-":
+        value = yaml.load(sys.stdin)
+    else:
+        with open(args.file) as file:
+            value = yaml.load(file)
+
+    substitutor = TemplateSubstitutor(
+        snapshot.header.get("url"), None, None, snapshot=snapshot
+    )
+    result, errors = substitutor.replace_lookups(value)
+    if errors:
+        sys.stderr.write("ERROR: " + "\nERROR: ".join(errors) + "\n")
+        return 1
+    yaml.dump(result, stream if stream else sys.stdout)
+    return 0
+
+
+commands = {"export": export_main, "resolve": resolve_main}
+
+
+def main(argv: List[str] = None, stream=None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in commands:
+        return commands[argv[0]](argv[1:], stream)
+
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if args.page_size < 1:
+        parser.error("--page-size must be at least 1")
+
+    get_api_key(parser, args)
+    lookup_cache.cache.backend = cache_backend.create_backend(
+        args.cache, args.cache_path
+    )
+    client = ApiClient(args.url, args.api_key, args.api_version)
+
+    try:
+        query = compile_query(args.query) if args.query else Query()
+    except QueryError as e:
+        parser.error(f"invalid query '{args.query}', {e}")
+
+    writer = writers[args.output_format](stream if stream else sys.stdout)
+    try:
+        if args.all or not query.pushed_down:
+            log.debug(f"{query.search()} for {args.type}, {args.page_size} per page\n")
+            writer.write_all(query_records(client, args.type, query, args))
+        else:
+            search = dict(query.search(), maxItems=args.max_items)
+            log.debug(f"{search} for {args.type}\n")
+            results, err = search_records(client, args.type, search)
+            if err:
+                sys.stderr.write(f"ERROR: {err}")
+                return 1
+            writer.write_all(results)
+    except IOError as e:
+        sys.stderr.write(f"ERROR: {e}")
+        return 1
+    finally:
+        writer.close()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(levelname)s: %(message)s", level=os.getenv("LOG_LEVEL", "ERROR")
+    )
+    sys.exit(main())
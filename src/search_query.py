@@ -0,0 +1,275 @@
+import re
+from typing import Iterable, List, Optional
+
+from template_substitutor import TemplateSubstitutor
+
+
+class QueryError(ValueError):
+    pass
+
+
+tokens = re.compile(
+    r"""\s*(?:
+        (?P<string>"(?:[^"\\]|\\.)*")
+        |(?P<number>-?[0-9]+(?:\.[0-9]+)?)(?![\w.])
+        |(?P<operator>==|!=|<=|>=|<|>)
+        |(?P<word>[A-Za-z_][\w.]*)
+    )""",
+    re.VERBOSE,
+)
+
+numeric_tests = {
+    "==": "equal",
+    "!=": "not-equal",
+    "<": "less-than",
+    ">": "greater-than",
+    "<=": "less-than-or-equal",
+    ">=": "greater-than-or-equal",
+}
+
+
+class Predicate(object):
+    """
+    a single clause of a query, `field` `operator` `value`, which is evaluated on a record.
+    Nested fields are addressed with dots, eg `firewall.state`.
+    """
+
+    def __init__(self, field: str, operator: str, value):
+        super(Predicate, self).__init__()
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.pattern = None
+        if operator == "like":
+            self.pattern = TemplateSubstitutor.name_pattern(
+                value.replace("%", "*").replace("_", "?")
+            )
+
+    def get(self, record: dict):
+        value = record
+        for name in self.field.split("."):
+            if not isinstance(value, dict):
+                return None
+            value = value.get(name)
+        return value
+
+    def matches(self, record: dict) -> bool:
+        value = self.get(record)
+        if self.operator == "like":
+            return isinstance(value, str) and bool(self.pattern.fullmatch(value))
+        if self.operator == "prefix":
+            return isinstance(value, str) and value.startswith(self.value)
+        if self.operator == "==":
+            return value == self.value
+        if self.operator == "!=":
+            return value != self.value
+        try:
+            return {
+                "<": lambda: value < self.value,
+                ">": lambda: value > self.value,
+                "<=": lambda: value <= self.value,
+                ">=": lambda: value >= self.value,
+            }[self.operator]()
+        except TypeError:
+            return False
+
+    def criterium(self) -> Optional[dict]:
+        """
+        returns the Deep Security search criterium for this predicate, or None if it cannot
+        be evaluated by the API.
+        """
+        if "." in self.field:
+            return None
+        value, operator = self.value, self.operator
+        if isinstance(value, bool):
+            if operator not in ("==", "!="):
+                return None
+            return {
+                "fieldName": self.field,
+                "booleanValue": value if operator == "==" else not value,
+            }
+        if isinstance(value, (int, float)):
+            if self.field == "ID":
+                return {
+                    "fieldName": "ID",
+                    "idTest": numeric_tests[operator],
+                    "idValue": value,
+                }
+            return {
+                "fieldName": self.field,
+                "numericTest": numeric_tests[operator],
+                "numericValue": value,
+            }
+        if operator in ("==", "!="):
+            return {
+                "fieldName": self.field,
+                "stringTest": numeric_tests[operator],
+                "stringValue": value,
+            }
+        if operator == "like":
+            return {
+                "fieldName": self.field,
+                "stringWildcards": True,
+                "stringValue": value.replace("*", "%").replace("?", "_"),
+            }
+        if operator == "prefix":
+            return {
+                "fieldName": self.field,
+                "stringWildcards": True,
+                "stringValue": f"{value}%",
+            }
+        return None
+
+    @property
+    def exact(self) -> bool:
+        """
+        returns true if the criterium selects precisely the matching records. A prefix with
+        a literal % or _ matches more on the server, and is checked again on the client.
+        """
+        return self.operator != "prefix" or not re.search(r"[%_]", self.value)
+
+
+class Query(object):
+    """
+    a compiled query: the criteria which are evaluated by the Deep Security API, and the
+    predicates and sort order which are evaluated on the client.
+    """
+
+    def __init__(self):
+        super(Query, self).__init__()
+        self.criteria: List[dict] = []
+        self.filters: List[Predicate] = []
+        self.sort_field: Optional[str] = None
+        self.descending = False
+
+    @property
+    def sort_by_id(self) -> bool:
+        return self.sort_field in (None, "ID")
+
+    @property
+    def pushed_down(self) -> bool:
+        """
+        returns true if the API returns precisely the results of the query, in order.
+        """
+        return not self.filters and self.sort_by_id
+
+    def search(self) -> dict:
+        result = {}
+        if self.criteria:
+            result["searchCriteria"] = list(self.criteria)
+        if self.sort_field == "ID":
+            result["sortByObjectID"] = True
+        if self.descending and self.sort_by_id:
+            result["sortDescending"] = True
+        return result
+
+    def matches(self, record: dict) -> bool:
+        return all(f.matches(record) for f in self.filters)
+
+    def sort(self, records: Iterable[dict]) -> List[dict]:
+        """
+        returns `records` in the order of a sort on a field other than ID. Records without
+        the field are sorted last.
+        """
+        key = Predicate(self.sort_field, "==", None).get
+        present = [r for r in records if key(r) is not None]
+        missing = [r for r in records if key(r) is None]
+        try:
+            present.sort(key=key, reverse=self.descending)
+        except TypeError:
+            present.sort(key=lambda r: str(key(r)), reverse=self.descending)
+        return present + missing
+
+
+def tokenize(text: str) -> List[tuple]:
+    result = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = tokens.match(text, position)
+        if not match:
+            position = len(text) - len(text[position:].lstrip())
+            raise QueryError(
+                f"unexpected input at position {position}: '{text[position:]}'"
+            )
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "number":
+            value = float(value) if "." in value else int(value)
+        elif kind == "word" and value in ("true", "false"):
+            kind, value = "boolean", value == "true"
+        result.append((kind, value))
+        position = match.end()
+    return result
+
+
+def compile_query(text: str) -> Query:
+    """
+    compiles a query of the form:
+
+        <field> <operator> <value> [and <field> <operator> <value> ...] [sort by <field> [asc|desc]]
+
+    The operators are ==, !=, <, >, <=, >=, like and prefix. Values are "strings", numbers,
+    true or false. A like pattern uses * or % for any sequence of characters and ? or _ for a
+    single character.
+
+    Raises QueryError if the query is invalid.
+    """
+    query = Query()
+    items = tokenize(text)
+    position = 0
+
+    def next_token(*kinds) -> tuple:
+        nonlocal position
+        if position >= len(items):
+            raise QueryError(f"unexpected end of query, expected {' or '.join(kinds)}")
+        kind, value = items[position]
+        if kind not in kinds:
+            raise QueryError(f"expected {' or '.join(kinds)}, found '{value}'")
+        position += 1
+        return kind, value
+
+    def at_word(*words) -> bool:
+        return (
+            position < len(items)
+            and items[position][0] == "word"
+            and items[position][1].lower() in words
+        )
+
+    while position < len(items) and not at_word("sort"):
+        _, field = next_token("word")
+        if at_word("like", "prefix"):
+            operator = next_token("word")[1].lower()
+            kind, value = next_token("string")
+        else:
+            _, operator = next_token("operator")
+            kind, value = next_token("string", "number", "boolean")
+
+        predicate = Predicate(field, operator, value)
+        criterium = predicate.criterium()
+        if criterium is not None:
+            query.criteria.append(criterium)
+        if criterium is None or not predicate.exact:
+            query.filters.append(predicate)
+
+        if position < len(items) and not at_word("sort"):
+            if not at_word("and"):
+                raise QueryError(f"expected and, found '{items[position][1]}'")
+            position += 1
+            if position >= len(items) or at_word("sort"):
+                raise QueryError("expected a clause after and")
+
+    if at_word("sort"):
+        position += 1
+        if not at_word("by"):
+            raise QueryError("expected by after sort")
+        position += 1
+        _, query.sort_field = next_token("word")
+        if at_word("asc", "desc"):
+            query.descending = next_token("word")[1].lower() == "desc"
+
+    if position < len(items):
+        raise QueryError(f"unexpected '{items[position][1]}' at the end of the query")
+    return query
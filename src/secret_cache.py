@@ -0,0 +1,122 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict, List
+
+import boto3
+from botocore.exceptions import ClientError
+
+import metrics
+
+log = logging.getLogger()
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+class SecretCache(object):
+    """
+    caches the decrypted values of SSM parameters for `ttl` seconds. Missing values are
+    retrieved with a single GetParameters call per 10 names.
+
+    IAM denies a GetParameters call if any of its names may not be read. The names of a denied
+    call are retrieved one by one, so that only the names which may not be read are omitted.
+    """
+
+    batch_size = 10
+
+    def __init__(self, ttl: float = 300):
+        super(SecretCache, self).__init__()
+        self.ttl = ttl
+        self.entries: Dict[str, tuple] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._ssm = None
+
+    @property
+    def ssm(self):
+        if self._ssm is None:
+            with self.lock:
+                if self._ssm is None:
+                    self._ssm = boto3.client("ssm")
+        return self._ssm
+
+    @ssm.setter
+    def ssm(self, client):
+        self._ssm = client
+
+    def get(self, name: str) -> str:
+        """
+        returns the value of the parameter `name`, raises ParameterNotFound if it does not exist.
+        """
+        values = self.get_many([name])
+        if name not in values:
+            raise ParameterNotFound(f"parameter {name} not found")
+        return values[name]
+
+    def get_many(self, names: List[str]) -> Dict[str, str]:
+        """
+        returns the values of the parameters `names`. Names which do not exist are omitted.
+        """
+        result = {}
+        missing = []
+        now = time.monotonic()
+        with self.lock:
+            for name in dict.fromkeys(names):
+                entry = self.entries.get(name)
+                if entry and entry[1] > now:
+                    result[name] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.append(name)
+                    self.misses += 1
+        metrics.add("SecretCacheHits", len(result))
+        metrics.add("SecretCacheMisses", len(missing))
+
+        for i in range(0, len(missing), self.batch_size):
+            response = self._get_parameters(missing[i : i + self.batch_size])
+            expires = time.monotonic() + self.ttl
+            with self.lock:
+                for parameter in response["Parameters"]:
+                    result[parameter["Name"]] = parameter["Value"]
+                    if self.ttl > 0:
+                        self.entries[parameter["Name"]] = (parameter["Value"], expires)
+            if response.get("InvalidParameters"):
+                log.debug("parameters %s not found", response["InvalidParameters"])
+
+        return result
+
+    def _get_parameters(self, names: List[str]) -> dict:
+        try:
+            with metrics.timer("Ssm"):
+                return self.ssm.get_parameters(Names=names, WithDecryption=True)
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "AccessDeniedException":
+                raise
+            if len(names) == 1:
+                log.warning("access to parameter %s denied", names[0])
+                return {"Parameters": [], "InvalidParameters": names}
+
+        result = {"Parameters": [], "InvalidParameters": []}
+        for name in names:
+            response = self._get_parameters([name])
+            result["Parameters"].extend(response["Parameters"])
+            result["InvalidParameters"].extend(response.get("InvalidParameters", []))
+        return result
+
+    def invalidate(self, names: List[str] = None):
+        """
+        removes `names` from the cache, or all parameters if no names are specified.
+        """
+        with self.lock:
+            if names is None:
+                self.entries.clear()
+            else:
+                for name in names:
+                    self.entries.pop(name, None)
+
+
+secrets = SecretCache(ttl=float(os.getenv("SECRET_CACHE_TTL", "300")))
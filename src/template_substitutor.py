@@ -1,7 +1,13 @@
 import re
+from collections import OrderedDict
+from copy import copy
 from io import StringIO
-import requests
-from typing import List
+import async_client
+import lookup_cache
+import catalog_index
+import metrics
+from async_client import ApiClient
+from typing import Dict, List, Tuple
 
 
 class TemplateSubstitutor(object):
@@ -11,80 +17,359 @@ class TemplateSubstitutor(object):
 
     For example: {{ lookup "firewallRule" "" }}
 
+    The references are resolved in two phases: all unique references are collected from the
+    object first and looked up concurrently, using at most `max_workers` threads. The results are
+    substituted afterwards.
+
+    Names of types with a bounded number of objects are resolved from a full catalog index, see
+    catalog_index. When `batch_threshold` or more names of another type are referenced, and the
+    type has at most `batch_limit` objects, the type is indexed with a single search instead of
+    searching for each name separately. The index is reused by subsequent lookups. The names of
+    larger types are searched one by one.
+
+    An element of a list may also be a reference to all objects whose name matches a pattern,
+    in which `*` matches any sequence of characters and `?` a single character:
+
+        {{ lookupAll "intrusionPreventionRule" "Identified Possible Ransomware*" }}
+
+    The element is replaced by the IDs of all matching objects, in order of ID. All matches
+    are retrieved with a single paged search.
+
+    Searches which are rejected because the API key was rotated are retried once with the key
+    returned by `refresh_api_key`. A resource provider passes its own `client` instead, so that
+    its calls use the refreshed key too.
+
+    With a `snapshot`, see catalog_snapshot, all references are resolved from the snapshot,
+    without calling the Deep Security API.
     """
 
-    def __init__(self, api_endpoint, api_key, api_version):
+    def __init__(
+        self,
+        api_endpoint,
+        api_key,
+        api_version,
+        max_workers=8,
+        batch_threshold=10,
+        batch_limit=500,
+        page_size=1000,
+        snapshot=None,
+        refresh_api_key=None,
+        client: ApiClient = None,
+    ):
         super(TemplateSubstitutor, self).__init__()
+        self.snapshot = snapshot
         self.api_endpoint = api_endpoint
         self.api_key = api_key
         self.api_version = api_version
+        self.max_workers = max_workers
+        self.batch_threshold = batch_threshold
+        self.batch_limit = batch_limit
+        self.page_size = page_size
+        self.client = (
+            client
+            if client
+            else ApiClient(
+                api_endpoint, api_key, api_version, refresh_api_key=refresh_api_key
+            )
+        )
+        self.resolved: Dict[Tuple[str, str], Tuple[str, str]] = {}
         self.pattern = re.compile(
             r'{{\s*(lookup)\s+"(?P<ds_type>[^"]*)"\s+"(?P<name>[^"]*)"\s*}}',
             re.MULTILINE,
         )
+        self.all_pattern = re.compile(
+            r'\s*{{\s*lookupAll\s+"(?P<ds_type>[^"]*)"\s+"(?P<pattern>[^"]*)"\s*}}\s*'
+        )
 
-    def plural(self, name) -> str:
-        if name[-1] == "y":
-            return f"{name[0:-1]}ies"
-        else:
-            return f"{name}s"
+    def search_all(self, ds_type: str, search: dict = None) -> (List[dict], str):
+        """
+        returns all objects of `ds_type` matching `search`, in pages of `page_size`.
+        """
+        return self.client.find_all(ds_type, search, self.page_size)
 
-    def search_url(self, ds_type: str) -> str:
-        return f"{self.api_endpoint}/{self.plural(ds_type).lower()}/search"
+    @property
+    def endpoint_key(self) -> str:
+        return lookup_cache.endpoint_key(
+            self.api_endpoint, self.api_key, self.api_version
+        )
 
-    def search(self, ds_type: str, search: dict) -> (List[dict], List[str]):
-        headers = {"api-version": self.api_version, "api-secret-key": self.api_key}
-        try:
-            key_name = self.plural(ds_type)
-            response = requests.post(
-                self.search_url(ds_type), headers=headers, json=search
-            )
+    def _do_lookup(self, ds_type, name) -> (str, List[str]):
+        if self.snapshot is not None:
+            return self.snapshot.lookup(ds_type, name)
 
-            if response.status_code != 200:
-                return (
-                    None,
-                    f"search for '{ds_type}' failed with status {response.status_code} - {response.text}",
-                )
+        value, count = lookup_cache.get((self.endpoint_key, ds_type, name))
+        if value is not None or count is not None:
+            return self._unique(ds_type, name, value, count)
+        return self._do_uncached_lookup(ds_type, name)
 
-            results = response.json()
-            if key_name not in results:
-                return (
-                    None,
-                    f"no field '{key_name}' expected in response, but it is missing.",
-                )
+    def _do_uncached_lookup(self, ds_type, name) -> (str, List[str]):
+        # concurrent lookups of the same name, by any substitutor or lookup provider, share a
+        # single search
+        key = (self.endpoint_key, ds_type, name)
+        ids, err = lookup_cache.flights.do(
+            key, lambda: self._fetch_lookup(ds_type, name)
+        )
+        if err:
+            return None, err
+        return self._unique(ds_type, name, *lookup_cache.result(ids))
+
+    def _fetch_lookup(self, ds_type, name) -> (List[int], str):
+        """
+        returns the IDs of all objects of `ds_type` named `name`, and caches the result.
+        """
+        if catalog_index.indexes.is_indexed(ds_type):
+            ids, err = catalog_index.indexes.lookup(
+                self.endpoint_key, ds_type, name, self.search_all
+            )
+        else:
+            ids, err = self._search_lookup(ds_type, name)
+        if not err:
+            lookup_cache.put((self.endpoint_key, ds_type, name), ids)
+        return ids, err
 
-            return results[key_name], None
-        except IOError as e:
-            return None, f"search for {ds_type} failed, {e}"
+    @staticmethod
+    def _unique(ds_type, name, value, count: int) -> (str, str):
+        """
+        returns `value`, or the error for a lookup which found `count` objects.
+        """
+        if value is None:
+            return None, f"expected single {ds_type} with name {name}, found {count}"
+        return value, None
 
-    def _do_lookup(self, ds_type, name) -> (str, List[str]):
+    def _search_lookup(self, ds_type, name) -> (List[int], str):
         search = {
             "maxItems": 2,
             "searchCriteria": [{"fieldName": "name", "stringValue": name}],
         }
-        results, err = self.search(ds_type, search)
+        results, err = self.client.find(ds_type, search)
         if err:
             return None, err
-        if len(results) != 1:
-            return (
-                None,
-                f"expected single {ds_type} with name {name}, found {len(results)}",
+        if len(results) == 1 and "ID" not in results[0]:
+            return None, f"no field ID in in search result {ds_type}"
+        return [r.get("ID") for r in results], None
+
+    def _do_index_lookups(
+        self, ds_type, names: List[str]
+    ) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        return {
+            (ds_type, name): self._do_uncached_lookup(ds_type, name) for name in names
+        }
+
+    def _do_batch_lookup(
+        self, ds_type, names: List[str]
+    ) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        """
+        resolves `names` of `ds_type` from an index of the type, if it has at most
+        `batch_limit` objects. Returns no results if the type is larger.
+
+        The index may be older than objects created since, so only names with a single match
+        are resolved from it; the others are left to a search by name.
+        """
+        index, err = catalog_index.indexes.probe(
+            self.endpoint_key, ds_type, self.client.find, self.batch_limit
+        )
+        if err:
+            return {(ds_type, name): (None, err) for name in names}
+        if index is None:
+            return {}
+
+        resolved = {}
+        for name in names:
+            ids = index.names.get(name, [])
+            if len(ids) == 1:
+                lookup_cache.put((self.endpoint_key, ds_type, name), ids)
+                resolved[(ds_type, name)] = (f"{ids[0]}", None)
+        return resolved
+
+    def lookup(self, ds_type, name) -> (str, List[str]):
+        key = (ds_type, name)
+        if key not in self.resolved:
+            self.resolved[key] = self._do_lookup(ds_type, name)
+        return self.resolved[key]
+
+    @staticmethod
+    def name_pattern(pattern: str) -> re.Pattern:
+        return re.compile(
+            "".join(
+                ".*" if c == "*" else "." if c == "?" else re.escape(c) for c in pattern
+            ),
+            re.DOTALL,
+        )
+
+    def _do_lookup_all(self, ds_type, pattern) -> (List[int], List[str]):
+        if self.snapshot is not None:
+            return self.snapshot.lookup_all(ds_type, pattern)
+
+        key = (self.endpoint_key, ds_type, pattern, "all")
+        ids = lookup_cache.cache.get(key)
+        if ids is None and lookup_cache.negative_cache.get(key) is None:
+            ids, err = lookup_cache.flights.do(
+                key, lambda: self._fetch_lookup_all(ds_type, pattern)
             )
+            if err:
+                return None, err
+        return self._any(ds_type, pattern, ids)
 
-        if "ID" not in results[0]:
-            return None, f"no field ID in in search result {ds_type}"
+    @staticmethod
+    def _any(ds_type, pattern, ids: List[int]) -> (List[int], str):
+        """
+        returns `ids`, or the error for a lookupAll of `pattern` which found no objects.
+        """
+        if not ids:
+            return None, f"no {ds_type} found with a name matching {pattern}"
+        return ids, None
+
+    def _fetch_lookup_all(self, ds_type, pattern) -> (List[int], List[str]):
+        key = (self.endpoint_key, ds_type, pattern, "all")
+        matcher = self.name_pattern(pattern)
+        if catalog_index.indexes.is_indexed(ds_type):
+            index, err = catalog_index.indexes.get(
+                self.endpoint_key, ds_type, self.search_all
+            )
+            if err:
+                return None, err
+            ids = index.matching(matcher)
+        else:
+            # the api wildcards are % and _, which also match themselves. The results are
+            # filtered on the pattern, to remove names with a literal % or _ that do not match.
+            wildcards = pattern.replace("*", "%").replace("?", "_")
+            criterium = {
+                "fieldName": "name",
+                "stringWildcards": True,
+                "stringValue": wildcards,
+            }
+            results, err = self.search_all(ds_type, {"searchCriteria": [criterium]})
+            if err:
+                return None, err
+            ids = [
+                r["ID"]
+                for r in results
+                if "ID" in r and matcher.fullmatch(r.get("name", ""))
+            ]
 
-        return results[0]["ID"], None
+        if ids:
+            lookup_cache.cache.put(key, ids)
+        else:
+            lookup_cache.negative_cache.put(key, 0)
+        return ids, None
+
+    def _do_single_lookup_all(
+        self, ds_type, pattern
+    ) -> Dict[Tuple[str, str, str], Tuple[List[int], str]]:
+        return {("lookupAll", ds_type, pattern): self._do_lookup_all(ds_type, pattern)}
+
+    def lookup_all(self, ds_type, pattern) -> (List[int], List[str]):
+        key = ("lookupAll", ds_type, pattern)
+        if key not in self.resolved:
+            self.resolved[key] = self._do_lookup_all(ds_type, pattern)
+        return self.resolved[key]
+
+    def collect_references(
+        self, obj: object, references: dict = None, patterns: dict = None
+    ) -> List[Tuple[str, str]]:
+        """
+        returns the unique (ds_type, name) lookup references in `obj`, in order of appearance.
+        The (ds_type, pattern) of lookupAll references in lists are added to `patterns`.
+        """
+        if references is None:
+            references = {}
+        if isinstance(obj, dict):
+            for value in obj.values():
+                self.collect_references(value, references, patterns)
+        elif isinstance(obj, list):
+            for value in obj:
+                if patterns is not None and isinstance(value, str) and "{{" in value:
+                    m = self.all_pattern.fullmatch(value)
+                    if m:
+                        patterns[(m.group("ds_type"), m.group("pattern"))] = True
+                        continue
+                self.collect_references(value, references, patterns)
+        elif isinstance(obj, str) and "{{" in obj:
+            for m in self.pattern.finditer(obj):
+                references[(m.group("ds_type"), m.group("name"))] = True
+        return list(references.keys())
+
+    def resolve(
+        self,
+        references: List[Tuple[str, str]],
+        patterns: List[Tuple[str, str]] = (),
+    ):
+        """
+        looks up all `references` and lookupAll `patterns` concurrently, and stores the results
+        in self.resolved. Names of the same type are resolved in a single batch, if there are
+        `batch_threshold` or more and the type is small.
+        """
+        if self.snapshot is not None:
+            for ds_type, name in references:
+                self.resolved[(ds_type, name)] = self._do_lookup(ds_type, name)
+            for ds_type, pattern in patterns:
+                self.resolved[("lookupAll", ds_type, pattern)] = self._do_lookup_all(
+                    ds_type, pattern
+                )
+            return
+
+        tasks = []
+        for ds_type, pattern in patterns:
+            if ("lookupAll", ds_type, pattern) not in self.resolved:
+                tasks.append((self._do_single_lookup_all, ds_type, pattern))
+
+        by_type = OrderedDict()
+        for ds_type, name in references:
+            if (ds_type, name) in self.resolved:
+                continue
+            value, count = lookup_cache.get((self.endpoint_key, ds_type, name))
+            if value is not None or count is not None:
+                self.resolved[(ds_type, name)] = self._unique(
+                    ds_type, name, value, count
+                )
+                metrics.add("LookupCacheHits")
+            else:
+                by_type.setdefault(ds_type, []).append(name)
+                metrics.add("LookupCacheMisses")
+
+        for ds_type, names in by_type.items():
+            if catalog_index.indexes.is_indexed(ds_type):
+                tasks.append((self._do_index_lookups, ds_type, names))
+            elif len(names) >= self.batch_threshold:
+                tasks.append((self._do_batch_lookup, ds_type, names))
+            else:
+                tasks.extend((self._do_single_lookup, ds_type, name) for name in names)
+
+        self._run(tasks)
+
+        # the names of types which are too large to index, and the names without a single match
+        # in the index of a small type, are searched one by one
+        self._run(
+            [
+                (self._do_single_lookup, ds_type, name)
+                for ds_type, names in by_type.items()
+                for name in names
+                if (ds_type, name) not in self.resolved
+            ]
+        )
+
+    def _run(self, tasks: List[tuple]):
+        # close to the deadline, the remaining lookups are done one by one, so that those
+        # which can no longer finish fail without being sent
+        for result in async_client.map(
+            lambda task: task[0](*task[1:]), tasks, self.max_workers
+        ):
+            self.resolved.update(result)
+
+    def _do_single_lookup(
+        self, ds_type, name
+    ) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        return {(ds_type, name): self._do_uncached_lookup(ds_type, name)}
 
     def replace_references(self, value) -> (object, List[str]):
-        if isinstance(value, str):
+        if isinstance(value, str) and "{{" in value:
             errors = []
             matches: List[re.MatchObject] = [m for m in self.pattern.finditer(value)]
             if matches:
                 result = StringIO()
                 previous = 0
                 for m in matches:
-                    new_value, err = self._do_lookup(**m.groupdict())
+                    new_value, err = self.lookup(**m.groupdict())
                     if not err:
                         result.write(value[previous : m.start()])
                         result.write(f"{new_value}")
@@ -100,22 +385,64 @@ class TemplateSubstitutor(object):
             return value, []
 
     def replace_lookups(self, obj: object) -> (object, List[str]):
+        """
+        returns a copy of `obj` in which all lookup references are replaced. `obj` itself is not
+        modified: only the containers on the path to a replaced value are copied, unchanged
+        values are shared with `obj`.
+        """
+        self.resolved = {}
+        with metrics.timer("Lookups"):
+            patterns = {}
+            references = self.collect_references(obj, patterns=patterns)
+            self.resolve(references, list(patterns.keys()))
+        return self._replace_lookups(obj)
+
+    def _replace_lookups(self, obj: object) -> (object, List[str]):
         errors = []
         if isinstance(obj, dict):
+            result = obj
             for key, value in obj.items():
-                new_value, err = self.replace_lookups(value)
-                if not err:
-                    obj[key] = new_value
-                else:
-                    errors.extend(err)
-            return obj, errors
+                new_value, err = self._replace_lookups(value)
+                errors.extend(err)
+                # a string with a failed lookup is kept as is, a container is always replaced
+                if new_value is not value and (not err or not isinstance(value, str)):
+                    if result is obj:
+                        result = copy(obj)
+                    result[key] = new_value
+            return result, errors
         elif isinstance(obj, list):
+            result = None
             for i, value in enumerate(obj):
-                new_value, err = self.replace_lookups(value)
-                if not err:
-                    obj[i] = new_value
-                else:
-                    errors.extend(err)
-            return obj, errors
+                new_values, err = self._replace_element(value)
+                errors.extend(err)
+                if result is None and (
+                    len(new_values) != 1 or new_values[0] is not value
+                ):
+                    result = obj[:i]
+                if result is not None:
+                    result.extend(new_values)
+            return (obj if result is None else result), errors
         else:
-            return self.replace_references(obj)
+            value, errors = self.replace_references(obj)
+            if isinstance(obj, str) and "{{" in obj and self.all_pattern.search(obj):
+                errors.append(
+                    f"lookupAll can only be used as an element of a list, {obj}"
+                )
+            return value, errors
+
+    def _replace_element(self, value: object) -> (list, List[str]):
+        """
+        returns the values which replace the list element `value`. The IDs of a lookupAll are
+        strings, like those of a lookup.
+        """
+        if isinstance(value, str) and "{{" in value:
+            m = self.all_pattern.fullmatch(value)
+            if m:
+                ids, err = self.lookup_all(**m.groupdict())
+                return ([value], [err]) if err else ([f"{i}" for i in ids], [])
+
+        new_value, err = self._replace_lookups(value)
+        # a string with a failed lookup is kept as is, a container is always replaced
+        if err and isinstance(value, str):
+            return [value], err
+        return [new_value], err
@@ -0,0 +1,347 @@
+"""
+benchmarks the hot paths of the provider and the Datadog event forwarder against a local stub
+of the Deep Security and Datadog API, and writes the results as JSON.
+
+    PYTHONPATH=src:tests python tests/benchmark.py --latency 0.02 --output benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import logging
+import statistics
+import subprocess
+from datetime import datetime
+from functools import partial
+
+import datadog
+
+import catalog_index
+import lookup_cache
+import metrics
+import secret_cache
+from conftest import cfn_request
+from stub_api import StubApi, StubSSM
+from template_substitutor import TemplateSubstitutor
+
+scenarios = {}
+
+
+def scenario(function):
+    scenarios[function.__name__] = function
+    return function
+
+
+def reset_caches():
+    lookup_cache.cache.invalidate()
+    lookup_cache.negative_cache.invalidate()
+    catalog_index.indexes.invalidate()
+
+
+def measure(function, repeat: int, setup=None) -> dict:
+    seconds = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "median": statistics.median(seconds),
+        "min": min(seconds),
+    }
+
+
+def rule_names(api: StubApi, count: int) -> list:
+    names = [f"Benchmark Rule {i}" for i in range(count)]
+    existing = {o["name"] for o in api.objects["intrusionpreventionrules"].values()}
+    for name in names:
+        if name not in existing:
+            api.add("intrusionPreventionRule", name)
+    return names
+
+
+def lookup_tree(names: list, depth: int, breadth: int) -> object:
+    if depth == 0:
+        return [f'{{{{lookup "intrusionPreventionRule" "{name}"}}}}' for name in names]
+    return {
+        f"level{depth}-{i}": lookup_tree(names, depth - 1, breadth)
+        for i in range(breadth)
+    }
+
+
+@scenario
+def provider_create(api: StubApi, args) -> dict:
+    """
+    creates a policy with `lookups` intrusion prevention rule references through the provider.
+    """
+    import deep_security_provider
+
+    names = rule_names(api, args.lookups)
+
+    def create():
+        value = {
+            "name": f"benchmark-{uuid.uuid4()}",
+            "intrusionPrevention": {
+                "state": "prevent",
+                "ruleIDs": lookup_tree(names, 0, 0),
+            },
+        }
+        request = cfn_request(api, "Create", "Policy", {"Value": value})
+        response = deep_security_provider.handler(request, {})
+        assert response["Status"] == "SUCCESS", response["Reason"]
+
+    before = api.count()
+    result = {
+        "lookups": args.lookups,
+        "cold": measure(create, args.repeat, setup=reset_caches),
+        "requests_per_create": (api.count() - before) / args.repeat,
+    }
+    result["warm"] = measure(create, args.repeat)
+    return result
+
+
+@scenario
+def replace_lookups(api: StubApi, args) -> dict:
+    """
+    substitutes the lookups in a tree of `depth` levels of `breadth` dictionaries, with
+    `lookups` references in each leaf.
+    """
+    names = rule_names(api, args.lookups)
+    tree = lookup_tree(names, args.depth, args.breadth)
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+
+    def substitute():
+        result, err = substitutor.replace_lookups(json.loads(json.dumps(tree)))
+        assert not err, err
+
+    return {
+        "lookups": args.lookups,
+        "depth": args.depth,
+        "breadth": args.breadth,
+        "cold": measure(substitute, args.repeat, setup=reset_caches),
+        "warm": measure(substitute, args.repeat),
+    }
+
+
+def large_policy(names: list, leaves: int) -> dict:
+    """
+    returns a policy document with `leaves` values, a few of which contain lookups.
+    """
+    settings = {f"setting{i}": {"value": f"value {i}"} for i in range(leaves // 2)}
+    rule_ids = list(range(leaves - len(settings) - len(names)))
+    rule_ids.extend(f'{{{{lookup "intrusionPreventionRule" "{n}"}}}}' for n in names)
+    return {
+        "name": "large policy",
+        "policySettings": settings,
+        "intrusionPrevention": {"state": "prevent", "ruleIDs": rule_ids},
+    }
+
+
+@scenario
+def replace_lookups_large(api: StubApi, args) -> dict:
+    """
+    substitutes `lookups` references in a generated policy with `leaves` values, compared to
+    the deep copy that was made before each substitution.
+    """
+    names = rule_names(api, args.lookups)
+    policy = large_policy(names, args.leaves)
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    substitutor.replace_lookups(policy)
+
+    def substitute():
+        result, err = substitutor.replace_lookups(policy)
+        assert not err, err
+
+    return {
+        "leaves": args.leaves,
+        "lookups": args.lookups,
+        "warm": measure(substitute, args.repeat),
+        "json_copy": measure(lambda: json.loads(json.dumps(policy)), args.repeat),
+    }
+
+
+@scenario
+def forwarder_handler(api: StubApi, args) -> dict:
+    """
+    forwards `records` SNS records of `events_per_record` Deep Security events to Datadog.
+    """
+    import datadog_event_forwarder
+
+    api_host = datadog.api._api_host
+    datadog.api._api_host = None
+    datadog.initialize(api_key="benchmark", app_key="benchmark", api_host=api.url)
+
+    message = [
+        {
+            "EventType": "PacketLog",
+            "Hostname": "ec2-3-123-36-92.eu-central-1.compute.amazonaws.com (bench) [i-0187d96402df8c28d]",
+            "LogDate": datetime.now().isoformat(),
+            "Severity": 3,
+            "SeverityString": "High",
+            "Title": "Identified Possible Ransomware File Rename Activity Over Network Share",
+        }
+    ] * args.events_per_record
+    event = {
+        "Records": [
+            {"Sns": {"MessageId": f"m{i}", "Message": json.dumps(message)}}
+            for i in range(args.records)
+        ]
+    }
+
+    def forward():
+        result = datadog_event_forwarder.handler(event, {})
+        assert result["forwarded"] == args.records * args.events_per_record, result
+
+    try:
+        return {
+            "records": args.records,
+            "events_per_record": args.events_per_record,
+            "events": measure(forward, args.repeat),
+        }
+    finally:
+        datadog.api._api_host = api_host
+
+
+@scenario
+def event_converter(api: StubApi, args) -> dict:
+    """
+    converts `conversions` Deep Security events to Datadog events, with the conversion as it
+    was before the EventConverter, and with the EventConverter in both text formats.
+    """
+    from datadog_event_forwarder import EventConverter
+    from sample_events import events, legacy_convert
+
+    tags = "env=prod, team=security"
+    converters = {
+        "legacy": lambda message_id, message: legacy_convert(message_id, message, tags),
+        "yaml": EventConverter(static_tags=tags).convert,
+        "json": EventConverter(static_tags=tags, text_format="json").convert,
+    }
+    messages = [events[i % len(events)] for i in range(args.conversions)]
+
+    def convert_all(convert):
+        for message_id, message in messages:
+            convert(message_id, message)
+
+    result = {"conversions": args.conversions}
+    for name, convert in converters.items():
+        result[name] = measure(partial(convert_all, convert), args.repeat)
+    return result
+
+
+def import_profile(module: str) -> dict:
+    """
+    imports `module` in a fresh interpreter with -X importtime, and returns the cumulative
+    import time in microseconds of the module and of its most expensive dependencies.
+    """
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+    env = dict(
+        os.environ, PYTHONPATH=os.pathsep.join([src, os.getenv("PYTHONPATH", "")])
+    )
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module}; print(','.join(sorted(sys.modules)))",
+        ],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and fields[1].strip().isdigit():
+            cumulative[fields[2].strip()] = int(fields[1])
+
+    modules = process.stdout.strip().split(",")
+    return {
+        "cumulative_us": cumulative.get(module),
+        "top": dict(sorted(cumulative.items(), key=lambda i: -i[1])[0:10]),
+        "modules": len(modules),
+        "providers": [m for m in modules if m.startswith("deep_security_")],
+    }
+
+
+@scenario
+def startup(api: StubApi, args) -> dict:
+    """
+    profiles the import of the Lambda handler modules, as done on a cold start, and of the
+    provider module imported by the first request.
+    """
+    return {
+        "provider": import_profile("provider"),
+        "deep_security_provider": import_profile("deep_security_provider"),
+        "datadog_event_forwarder": import_profile("datadog_event_forwarder"),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark the provider hot paths.")
+    parser.add_argument(
+        "--latency", default=0.01, type=float, help="of the stub API in seconds"
+    )
+    parser.add_argument("--repeat", default=3, type=int, help="each scenario")
+    parser.add_argument("--lookups", default=80, type=int, help="per policy")
+    parser.add_argument("--depth", default=3, type=int, help="of the lookup tree")
+    parser.add_argument("--breadth", default=3, type=int, help="of the lookup tree")
+    parser.add_argument("--leaves", default=10000, type=int, help="of the large policy")
+    parser.add_argument("--records", default=50, type=int, help="per SNS event")
+    parser.add_argument(
+        "--events-per-record", default=4, type=int, help="in each SNS message"
+    )
+    parser.add_argument(
+        "--conversions", default=10000, type=int, help="of the event converter"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=sorted(scenarios.keys()),
+        help="to run, default all",
+    )
+    parser.add_argument("--output", help="file to write the results to")
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    logging.basicConfig(level=os.environ["LOG_LEVEL"])
+    logging.getLogger().setLevel(os.environ["LOG_LEVEL"])
+    # metrics are still collected, but not written in between the results
+    namespace, metrics.namespace = metrics.namespace, ""
+
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "latency": args.latency,
+        "scenarios": {},
+    }
+    with StubApi(latency=args.latency) as api:
+        secret_cache.secrets.ssm = StubSSM(
+            {"/cfn-deep-security-provider/api_key": api.api_key}
+        )
+        try:
+            for name in args.scenario or scenarios.keys():
+                results["scenarios"][name] = scenarios[name](api, args)
+        finally:
+            metrics.namespace = namespace
+            secret_cache.secrets.ssm = None
+            secret_cache.secrets.invalidate()
+            reset_caches()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import uuid
+import pytest
+import secret_cache
+import lookup_cache
+import catalog_index
+from stub_api import StubApi, StubSSM
+
+
+def cfn_request(
+    api,
+    request_type,
+    resource_type,
+    properties,
+    old_properties=None,
+    physical_resource_id=None,
+) -> dict:
+    """
+    returns a CloudFormation `request_type` request for the custom resource `resource_type`
+    with `properties`, connected to the /api of the stub `api` unless `properties` specifies a
+    Connection. The `old_properties` of an update are merged over `properties`.
+    """
+    resource_properties = dict(
+        {
+            "ServiceToken": "arn:aws:lambda:eu-central-1:123456789012:function:provider",
+            "Connection": {"URL": f"{api.url}/api"},
+        },
+        **properties,
+    )
+    result = {
+        "RequestType": request_type,
+        "ResponseURL": f"{api.url}/cfn-response",
+        "StackId": "arn:aws:cloudformation:eu-central-1:EXAMPLE/test/guid",
+        "RequestId": f"request-{uuid.uuid4()}",
+        "ResourceType": f"Custom::DeepSecurity{resource_type}",
+        "LogicalResourceId": resource_type,
+        "ResourceProperties": resource_properties,
+    }
+    if old_properties is not None:
+        result["OldResourceProperties"] = dict(resource_properties, **old_properties)
+    if physical_resource_id:
+        result["PhysicalResourceId"] = physical_resource_id
+    return result
+
+
+def reset_caches():
+    secret_cache.secrets.invalidate()
+    lookup_cache.cache.invalidate()
+    lookup_cache.negative_cache.invalidate()
+    catalog_index.indexes.invalidate()
+
+
+@pytest.fixture
+def api():
+    """
+    a stub Deep Security API, with its API key in a stub parameter store. All caches of the
+    container are cleared before and after the test.
+    """
+    reset_caches()
+    with StubApi() as api:
+        secret_cache.secrets.ssm = StubSSM(
+            {"/cfn-deep-security-provider/api_key": api.api_key}
+        )
+        try:
+            yield api
+        finally:
+            secret_cache.secrets.ssm = None
+            reset_caches()
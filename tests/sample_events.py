@@ -0,0 +1,150 @@
+"""
+sample Deep Security events for the tests and the benchmark, and the conversion of events to
+Datadog events as it was done before the EventConverter was introduced.
+"""
+
+import re
+from copy import copy
+from datetime import datetime
+from io import StringIO
+
+from ruamel.yaml import YAML
+
+system_event = [
+    {
+        "ActionBy": "System",
+        "Description": "Alert: New Pattern Update is Downloaded and Available\\nSeverity: Warning\\n",
+        "EventID": 6813,
+        "EventType": "SystemEvent",
+        "LogDate": datetime.now().isoformat(),
+        "ManagerNodeID": 123,
+        "ManagerNodeName": "job7-123",
+        "Number": 192,
+        "Origin": 3,
+        "OriginString": "Manager",
+        "Severity": 1,
+        "SeverityString": "Info",
+        "Tags": "",
+        "TargetID": 1,
+        "TargetName": "ec2-12-123-123-123.us-west-2.compute.amazonaws.com",
+        "TargetType": "Host",
+        "TenantID": 123,
+        "TenantName": "Umbrella Corp.",
+        "Title": "Alert Ended",
+    }
+]
+
+anti_malware_event = [
+    {
+        "AMTargetTypeString": "N/A",
+        "ATSEDetectionLevel": 0,
+        "CreationTime": "2018-12-04T15:57:18.000Z",
+        "EngineType": 1_207_959_848,
+        "EngineVersion": "10.0.0.1040",
+        "ErrorCode": 0,
+        "EventID": 1,
+        "EventType": "AntiMalwareEvent",
+        "HostAgentGUID": "4A5BF25A-4446-DD8B-DFB7-564C275F5F6B",
+        "HostAgentVersion": "11.1.0.163",
+        "HostID": 1,
+        "HostOS": "Amazon Linux (64 bit) (4.14.62-65.117.amzn1.x86_64)",
+        "HostSecurityPolicyID": 3,
+        "HostSecurityPolicyName": "PolicyA",
+        "Hostname": "ec2-12-123-123-123.us-west-2.compute.amazonaws.com",
+        "InfectedFilePath": "/tmp/eicar_1543939038890.txt",
+        "LogDate": datetime.now().isoformat(),
+        "MajorVirusType": 2,
+        "MajorVirusTypeString": "Virus",
+        "MalwareName": "Eicar_test_file",
+        "MalwareType": 1,
+        "ModificationTime": "2018-12-04T15:57:18.000Z",
+        "Origin": 0,
+        "OriginString": "Agent",
+        "PatternVersion": "14.665.00",
+        "Protocol": 0,
+        "Reason": "Default Real-Time Scan Configuration",
+        "ScanAction1": 4,
+        "ScanAction2": 3,
+        "ScanResultAction1": -81,
+        "ScanResultAction2": 0,
+        "ScanResultString": "Quarantined",
+        "ScanType": 0,
+        "ScanTypeString": "Real Time",
+        "Tags": "",
+        "TenantID": 123,
+        "TenantName": "Umbrella Corp.",
+    },
+    {
+        "AMTargetTypeString": "N/A",
+        "ATSEDetectionLevel": 0,
+        "CreationTime": "2018-12-04T15:57:21.000Z",
+    },
+    {
+        "AMTargetTypeString": "N/A",
+        "ATSEDetectionLevel": 0,
+        "CreationTime": "2018-12-04T15:57:29.000Z",
+    },
+]
+
+intrusion_prevention_event = {
+    "Action": 2,
+    "ActionString": "Reset",
+    "DestinationIP": "10.0.5.82",
+    "DestinationPort": 445,
+    "Direction": 1,
+    "DirectionString": "Incoming",
+    "EventID": 4242,
+    "EventType": "PacketLog",
+    "Hostname": "ec2-3-123-36-92.eu-central-1.compute.amazonaws.com (ebms.prod-api) [i-0187d96402df8c28d]",
+    "LogDate": "2023-03-01T12:00:00.000Z",
+    "Protocol": 1,
+    "ProtocolString": "TCP",
+    "Severity": 3,
+    "SeverityString": "High",
+    "SourceIP": "10.0.7.13",
+    "SourcePort": 52123,
+    "Title": "Identified Possible Ransomware File Rename Activity Over Network Share",
+}
+
+
+def legacy_convert(message_id, message, static_tags):
+    """
+    the conversion as it was done before the EventConverter was introduced.
+    """
+    tags = []
+    m = re.match(
+        r"(?P<fqdn>.*)\s*\((?P<name>[^)]*)\)\s+\[(?P<instanceid>i-[^\]]*)\]",
+        message.get("Hostname", ""),
+    )
+    if m and m.group("name"):
+        tags.append(f"name:{m.group('name')}")
+    tags.extend(
+        f"{t[0]}:{t[1] if len(t) > 1 else ''}"
+        for t in map(lambda t: t.strip().split("=", 1), static_tags.split(","))
+    )
+
+    YAML()
+    result = StringIO()
+    message = copy(message)
+    for name in ["Description", "OSSEC_Log"]:
+        if message.get(name):
+            result.write(message[name])
+            result.write("\n")
+            break
+    for name in ["Title", "Description", "LogDate", "OSSEC_Description", "OSSEC_Log"]:
+        if name in message:
+            message.pop(name)
+    to_remove = [
+        k for k in message if isinstance(message[k], int) and f"{k}String" in message
+    ]
+    for key in to_remove:
+        message[key] = message.pop(f"{key}String")
+    YAML().dump(message, result)
+    return result.getvalue(), tags
+
+
+events = [
+    ("m1", system_event[0]),
+    ("m2", anti_malware_event[0]),
+    ("m3", intrusion_prevention_event),
+]
@@ -0,0 +1,313 @@
+import re
+import json
+import time
+import threading
+from collections import Counter
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+types = [
+    "antiMalwareConfiguration",
+    "context",
+    "firewallRule",
+    "integrityMonitoringRule",
+    "interfaceType",
+    "intrusionPreventionRule",
+    "ipList",
+    "logInspectionRule",
+    "macList",
+    "policy",
+    "portList",
+    "schedule",
+    "statefulConfiguration",
+]
+
+
+def plural(name: str) -> str:
+    if name[-1] == "y":
+        return f"{name[0:-1]}ies"
+    else:
+        return f"{name}s"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body=None):
+        if isinstance(body, (dict, list)):
+            data = json.dumps(body).encode("utf-8")
+            content_type = "application/json"
+        else:
+            data = (body if body is not None else "").encode("utf-8")
+            content_type = "text/plain"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        api = self.server.api
+        path = urlparse(self.path).path
+        api.record(self.command, path)
+        if api.latency:
+            time.sleep(api.latency)
+
+        status = api.next_status(self.command, path)
+        if status:
+            self.reply(status, {"message": f"stubbed status {status}"})
+            return
+
+        try:
+            request = json.loads(body) if body else None
+        except ValueError:
+            self.reply(400, {"message": "invalid json"})
+            return
+
+        status, response = api.dispatch(self.command, path, request, self.headers)
+        self.reply(status, response)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+    do_DELETE = handle_request
+
+
+class StubApi(object):
+    """
+    a local imitation of the Deep Security /api and legacy /rest API, the Datadog events and
+    logs intake, and the CloudFormation response URL. Every request is delayed by `latency`
+    seconds, and counted in `requests`.
+    """
+
+    def __init__(self, latency: float = 0.0, api_key: str = "stub-api-key"):
+        super(StubApi, self).__init__()
+        self.latency = latency
+        self.api_key = api_key
+        self.lock = threading.Lock()
+        self.objects = {plural(t).lower(): {} for t in types}
+        self.keys = {plural(t).lower(): plural(t) for t in types}
+        self.next_id = 1
+        self.requests = Counter()
+        self.statuses = {}
+        self.events = []
+        self.logs = []
+        self.responses = []
+        self.sessions = set()
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "StubApi":
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def record(self, method: str, path: str):
+        with self.lock:
+            self.requests[f"{method} {re.sub(r'/[0-9]+', '/{id}', path)}"] += 1
+
+    def count(self, prefix: str = "") -> int:
+        with self.lock:
+            return sum(n for r, n in self.requests.items() if r.startswith(prefix))
+
+    def fail_next(self, method: str, path: str, *statuses: int):
+        """
+        responds to the next requests to `path` with `statuses`.
+        """
+        with self.lock:
+            self.statuses.setdefault(f"{method} {path}", []).extend(statuses)
+
+    def next_status(self, method: str, path: str) -> int:
+        with self.lock:
+            statuses = self.statuses.get(f"{method} {path}")
+            return statuses.pop(0) if statuses else None
+
+    def add(self, ds_type: str, name: str, **fields) -> dict:
+        with self.lock:
+            obj = dict(fields, name=name, ID=self.next_id)
+            self.next_id += 1
+            self.objects[plural(ds_type).lower()][obj["ID"]] = obj
+            return obj
+
+    def dispatch(self, method: str, path: str, request, headers) -> (int, object):
+        parts = path.strip("/").split("/")
+        if parts[0] == "api" and len(parts) > 1:
+            if parts[1] in ("v1", "v2"):
+                return self.datadog(parts[1:], request)
+            if headers.get("api-secret-key") != self.api_key:
+                return 401, {"message": "invalid api key"}
+            return self.api(method, parts[1:], request)
+        if parts[0] == "rest":
+            return self.rest(method, parts[1:], request, headers)
+        if parts[0] == "cfn-response" and method == "PUT":
+            with self.lock:
+                self.responses.append(request)
+            return 200, ""
+        return 404, {"message": f"no handler for {method} {path}"}
+
+    def api(self, method: str, parts: list, request) -> (int, object):
+        collection = parts[0]
+        if collection not in self.objects:
+            return 404, {"message": f"unknown type {collection}"}
+        objects = self.objects[collection]
+
+        if len(parts) == 2 and parts[1] == "search" and method == "POST":
+            return 200, {self.keys[collection]: self.search(objects, request or {})}
+
+        if len(parts) == 1 and method == "POST":
+            with self.lock:
+                obj = dict(request, ID=self.next_id)
+                self.next_id += 1
+                objects[obj["ID"]] = obj
+            return 200, obj
+
+        if len(parts) == 2 and parts[1].isdigit():
+            object_id = int(parts[1])
+            with self.lock:
+                if object_id not in objects:
+                    return 404, {"message": f"{collection} {object_id} not found"}
+                if method == "POST":
+                    objects[object_id].update(request)
+                    return 200, objects[object_id]
+                if method == "DELETE":
+                    del objects[object_id]
+                    return 204, ""
+                return 200, objects[object_id]
+
+        return 404, {"message": f"unsupported {method} on {collection}"}
+
+    def search(self, objects: dict, search: dict) -> list:
+        with self.lock:
+            results = sorted(objects.values(), key=lambda o: o["ID"])
+        criteria = search.get("searchCriteria", [])
+        if isinstance(criteria, dict):
+            criteria = [criteria]
+        for criterium in criteria:
+            results = [r for r in results if self.matches(r, criterium)]
+        if search.get("sortDescending"):
+            results.reverse()
+        return results[0 : search.get("maxItems", 5000) or 5000]
+
+    @staticmethod
+    def matches(obj: dict, criterium: dict) -> bool:
+        value = obj.get(criterium.get("fieldName"))
+        if "idValue" in criterium:
+            test = criterium.get("idTest", "equal")
+            return {
+                "equal": obj["ID"] == criterium["idValue"],
+                "not-equal": obj["ID"] != criterium["idValue"],
+                "greater-than": obj["ID"] > criterium["idValue"],
+                "greater-than-or-equal": obj["ID"] >= criterium["idValue"],
+                "less-than": obj["ID"] < criterium["idValue"],
+                "less-than-or-equal": obj["ID"] <= criterium["idValue"],
+            }[test]
+        if "stringValue" in criterium:
+            expected = criterium["stringValue"]
+            if criterium.get("stringWildcards"):
+                pattern = "".join(
+                    ".*" if c == "%" else "." if c == "_" else re.escape(c)
+                    for c in expected
+                )
+                result = isinstance(value, str) and re.fullmatch(pattern, value)
+            else:
+                result = value == expected
+            if criterium.get("stringTest", "equal") == "not-equal":
+                return not result
+            return bool(result)
+        if "numericValue" in criterium:
+            expected = criterium["numericValue"]
+            if not isinstance(value, (int, float)):
+                return False
+            return {
+                "equal": value == expected,
+                "not-equal": value != expected,
+                "greater-than": value > expected,
+                "greater-than-or-equal": value >= expected,
+                "less-than": value < expected,
+                "less-than-or-equal": value <= expected,
+            }[criterium.get("numericTest", "equal")]
+        if "booleanValue" in criterium:
+            return value == criterium["booleanValue"]
+        return True
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def rest(self, method: str, parts: list, request, headers) -> (int, object):
+        path = "/".join(parts)
+        if path == "authentication/login" and method == "POST":
+            with self.lock:
+                self.next_id += 1
+                self.sessions.add(f"session-{self.next_id}")
+                return 200, f"session-{self.next_id}"
+
+        cookie = SimpleCookie(headers.get("Cookie", ""))
+        session_id = cookie["sID"].value if "sID" in cookie else None
+        with self.lock:
+            if session_id not in self.sessions:
+                return 403, {"message": "invalid session"}
+            if path == "authentication/logout" and method == "DELETE":
+                self.sessions.discard(session_id)
+                return 200, ""
+        if path == "cloudaccounts/aws" and method == "POST":
+            with self.lock:
+                self.next_id += 1
+                return 200, {"AddAwsAccountResponse": {"internalId": self.next_id}}
+        if path.startswith("cloudaccounts/aws/"):
+            return 200, ""
+        return 404, {"message": f"unsupported {method} on /rest/{path}"}
+
+    def datadog(self, parts: list, request) -> (int, object):
+        if parts == ["v1", "events"]:
+            with self.lock:
+                self.events.append(request)
+            return 202, {"status": "ok", "event": {"id": len(self.events)}}
+        if parts == ["v2", "logs"]:
+            with self.lock:
+                self.logs.extend(request)
+            return 202, {}
+        return 404, {"message": "unknown datadog endpoint"}
+
+
+class StubSSM(object):
+    """
+    a local imitation of the SSM GetParameters API.
+    """
+
+    def __init__(self, parameters: dict):
+        super(StubSSM, self).__init__()
+        self.parameters = parameters
+        self.calls = 0
+
+    def get_parameters(self, Names, WithDecryption=False):
+        self.calls += 1
+        return {
+            "Parameters": [
+                {"Name": n, "Value": self.parameters[n]}
+                for n in Names
+                if n in self.parameters
+            ],
+            "InvalidParameters": [n for n in Names if n not in self.parameters],
+        }
@@ -0,0 +1,145 @@
+import time
+import asyncio
+import threading
+import pytest
+import async_client
+import rest_session
+from async_client import ApiClient, Engine, RestClient
+from stub_api import StubApi
+
+
+def test_map():
+    engine = Engine(max_workers=4)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def square(n):
+        with lock:
+            active.append(n)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.remove(n)
+        return n * n
+
+    assert engine.map(square, list(range(10)), max_concurrency=3) == [
+        n * n for n in range(10)
+    ]
+    assert max(peak) == 3
+
+
+def test_nested_map_runs_inline():
+    engine = Engine(max_workers=2)
+
+    def outer(n):
+        return engine.map(lambda m: (n, m), [1, 2], max_concurrency=2)
+
+    assert engine.map(outer, [1, 2, 3], max_concurrency=2) == [
+        [(n, 1), (n, 2)] for n in (1, 2, 3)
+    ]
+
+
+def test_run_from_threads():
+    async def double(n):
+        await asyncio.sleep(0.01)
+        return n * 2
+
+    results = {}
+    threads = [
+        threading.Thread(
+            target=lambda n=n: results.update({n: async_client.run(double(n))})
+        )
+        for n in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {n: n * 2 for n in range(5)}
+
+
+def test_exceptions_are_raised():
+    def fail(n):
+        raise ValueError(n)
+
+    with pytest.raises(ValueError):
+        async_client.map(fail, [1, 2])
+
+
+def test_api_search():
+    with StubApi() as api:
+        for i in range(25):
+            api.add("firewallRule", f"rule-{i}")
+        client = ApiClient(f"{api.url}/api", api.api_key, max_concurrency=4)
+
+        async def search():
+            return await asyncio.gather(
+                client.search(
+                    "firewallRule",
+                    {
+                        "searchCriteria": [
+                            {"fieldName": "name", "stringValue": "rule-1"}
+                        ]
+                    },
+                ),
+                client.search("policy", {}),
+            )
+
+        (rules, err), (policies, policy_err) = async_client.run(search())
+        assert err is None and policy_err is None
+        assert [r["name"] for r in rules] == ["rule-1"]
+        assert policies == []
+
+        async def pages():
+            return [
+                [r["ID"] for r in page]
+                async for page in client.search_pages("firewallRule", page_size=10)
+            ]
+
+        result = async_client.run(pages())
+        assert [len(p) for p in result] == [10, 10, 5]
+        assert sum(result, []) == sorted(sum(result, []))
+        assert api.count("POST /api/firewallrules/search") == 4
+
+
+def test_api_search_error():
+    with StubApi() as api:
+        client = ApiClient(f"{api.url}/api", "wrong key")
+        rules, err = async_client.run(client.search("firewallRule", {}))
+        assert rules is None
+        assert err.startswith("search for 'firewallRule' failed with status 401")
+
+
+def test_rest_request():
+    with StubApi() as api:
+        logins = []
+
+        def login():
+            logins.append(f"session-{len(logins) + 1}")
+            api.sessions.add(logins[-1])
+            return logins[-1]
+
+        rest_session.sessions.close()
+        try:
+            client = RestClient(f"{api.url}/rest", ("stub",), login)
+
+            async def create():
+                return await asyncio.gather(
+                    *[
+                        client.request("POST", "cloudaccounts/aws", json={})
+                        for _ in range(3)
+                    ]
+                )
+
+            responses = async_client.run(create())
+            assert [r.status_code for r in responses] == [200, 200, 200]
+            assert logins == ["session-1"]
+
+            # a rejected session is replaced by a new login
+            api.expire_sessions()
+            response = client.call("POST", "cloudaccounts/aws", json={})
+            assert response.status_code == 200
+            assert logins == ["session-1", "session-2"]
+        finally:
+            rest_session.sessions.close()
@@ -0,0 +1,32 @@
+from benchmark import main
+
+
+def test_benchmark_scenarios(tmp_path):
+    output = tmp_path / "benchmark.json"
+    results = main(
+        [
+            "--latency=0",
+            "--repeat=1",
+            "--lookups=12",
+            "--depth=2",
+            "--breadth=2",
+            "--leaves=100",
+            "--records=3",
+            "--events-per-record=2",
+            "--conversions=6",
+            f"--output={output}",
+        ]
+    )
+    assert output.exists()
+    scenarios = results["scenarios"]
+    assert set(scenarios.keys()) == {
+        "provider_create",
+        "replace_lookups",
+        "replace_lookups_large",
+        "forwarder_handler",
+        "event_converter",
+        "startup",
+    }
+    assert scenarios["provider_create"]["requests_per_create"] > 0
+    assert scenarios["forwarder_handler"]["events"]["median"] > 0
+    assert scenarios["event_converter"]["json"]["median"] > 0
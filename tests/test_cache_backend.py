@@ -0,0 +1,132 @@
+import time
+import threading
+from cache_backend import SQLiteBackend, CacheBackend, create_backend
+from lookup_cache import LookupCache
+from catalog_index import CatalogIndexes
+
+
+def test_get_put(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache" / "cache.db"))
+    assert backend.get(("lookup", "e", "policy", "Base")) is None
+    backend.put(("lookup", "e", "policy", "Base"), 1, ttl=60)
+    backend.put(("lookup", "e", "policy", "Linux"), [2, 3], ttl=60)
+    assert backend.get(("lookup", "e", "policy", "Base")) == 1
+    assert backend.get(("lookup", "e", "policy", "Linux")) == [2, 3]
+    assert backend.stats == {"hits": 2, "misses": 1, "errors": 0}
+
+
+def test_ttl(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.db"))
+    backend.put(("lookup", "e", "policy", "Base"), 1, ttl=0.05)
+    backend.put(("lookup", "e", "policy", "Linux"), 2, ttl=0)
+    assert backend.get(("lookup", "e", "policy", "Base")) == 1
+    assert backend.get(("lookup", "e", "policy", "Linux")) is None
+    time.sleep(0.06)
+    assert backend.get(("lookup", "e", "policy", "Base")) is None
+    backend.expire()
+    count = backend.connection.execute("SELECT count(*) FROM entries").fetchone()
+    assert count == (0,)
+
+
+def test_invalidate_prefix(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "cache.db"))
+    backend.put(("lookup", "e1", "policy", "Base"), 1, ttl=60)
+    backend.put(("lookup", "e1", "policyX", "Base"), 2, ttl=60)
+    backend.put(("lookup", "e2", "policy", "Base"), 3, ttl=60)
+    backend.put(("catalog", "e1", "policy"), {"names": {}}, ttl=60)
+
+    backend.invalidate(("lookup", "e1", "policy"))
+    assert backend.get(("lookup", "e1", "policy", "Base")) is None
+    assert backend.get(("lookup", "e1", "policyX", "Base")) == 2
+    assert backend.get(("lookup", "e2", "policy", "Base")) == 3
+
+    backend.invalidate(("lookup",))
+    assert backend.get(("lookup", "e2", "policy", "Base")) is None
+    assert backend.get(("catalog", "e1", "policy")) == {"names": {}}
+
+    backend.invalidate()
+    assert backend.get(("catalog", "e1", "policy")) is None
+
+
+def test_concurrent_access(tmp_path):
+    path = str(tmp_path / "cache.db")
+    errors = []
+
+    def worker(n):
+        # every thread uses its own connection, as would another process
+        backend = SQLiteBackend(path)
+        try:
+            for i in range(50):
+                backend.put(("lookup", "e", "policy", f"{n}-{i}"), i, ttl=60)
+                assert backend.get(("lookup", "e", "policy", f"{n}-{i}")) == i
+        except AssertionError as e:
+            errors.append(e)
+        errors.extend([backend.stats["errors"]] if backend.stats["errors"] else [])
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+
+
+def test_unusable_path_is_a_miss(tmp_path):
+    (tmp_path / "file").write_text("")
+    backend = SQLiteBackend(str(tmp_path / "file" / "cache.db"))
+    backend.put(("lookup", "e", "policy", "Base"), 1, ttl=60)
+    assert backend.get(("lookup", "e", "policy", "Base")) is None
+    assert backend.stats["errors"] == 2
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend("sqlite", str(tmp_path / "c.db")), SQLiteBackend)
+    assert type(create_backend("none", "")) == CacheBackend
+    assert type(create_backend("redis", "")) == CacheBackend
+
+
+def test_lookup_cache_survives_reload(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = LookupCache(ttl=60, backend=SQLiteBackend(path))
+    cache.put(("e", "policy", "Base"), 1)
+
+    reloaded = LookupCache(ttl=60, backend=SQLiteBackend(path))
+    assert reloaded.get(("e", "policy", "Base")) == 1
+    assert reloaded.stats == {"size": 1, "hits": 1, "misses": 0, "evictions": 0}
+
+    reloaded.invalidate(("e", "policy", "Base"))
+    assert (
+        LookupCache(ttl=60, backend=SQLiteBackend(path)).get(("e", "policy", "Base"))
+        is None
+    )
+
+
+def test_lookup_cache_keeps_backend_expiry(tmp_path):
+    path = str(tmp_path / "cache.db")
+    SQLiteBackend(path).put(("lookup", "e", "policy", "Base"), 1, ttl=0.05)
+
+    cache = LookupCache(ttl=60, backend=SQLiteBackend(path))
+    assert cache.get(("e", "policy", "Base")) == 1
+    time.sleep(0.06)
+    assert cache.get(("e", "policy", "Base")) is None
+
+
+def test_catalog_survives_reload(tmp_path):
+    path = str(tmp_path / "cache.db")
+    loads = []
+
+    def search_all(ds_type):
+        loads.append(ds_type)
+        return [{"ID": 1, "name": "Base"}, {"ID": 2, "name": "Linux"}], None
+
+    indexes = CatalogIndexes(["policy"], ttl=60, backend=SQLiteBackend(path))
+    assert indexes.lookup("e", "policy", "Base", search_all) == ([1], None)
+
+    reloaded = CatalogIndexes(["policy"], ttl=60, backend=SQLiteBackend(path))
+    assert reloaded.lookup("e", "policy", "Linux", search_all) == ([2], None)
+    assert loads == ["policy"]
+
+    reloaded.invalidate("e", "policy")
+    fresh = CatalogIndexes(["policy"], ttl=60, backend=SQLiteBackend(path))
+    assert fresh.lookup("e", "policy", "Linux", search_all) == ([2], None)
+    assert loads == ["policy", "policy"]
@@ -0,0 +1,71 @@
+import time
+from catalog_index import CatalogIndexes
+
+
+class Catalog(object):
+    def __init__(self, objects):
+        self.objects = objects
+        self.loads = 0
+
+    def search_all(self, ds_type):
+        self.loads += 1
+        if ds_type == "broken":
+            return None, "search for 'broken' failed with status 500 - oops"
+        return list(self.objects), None
+
+
+def test_lookup():
+    catalog = Catalog(
+        [
+            {"ID": 1, "name": "Base"},
+            {"ID": 2, "name": "Linux Server"},
+            {"ID": 3, "name": "Linux Server"},
+            {"name": "no id"},
+        ]
+    )
+    indexes = CatalogIndexes(["policy"], ttl=60, refresh_interval=60)
+    assert indexes.is_indexed("policy")
+    assert not indexes.is_indexed("intrusionPreventionRule")
+
+    assert indexes.lookup("e", "policy", "Base", catalog.search_all) == ([1], None)
+    assert indexes.lookup("e", "policy", "Linux Server", catalog.search_all) == (
+        [2, 3],
+        None,
+    )
+    assert indexes.lookup("e", "policy", "Missing", catalog.search_all) == ([], None)
+    assert catalog.loads == 1, "the catalog should be loaded once"
+
+    indexes.lookup("other-endpoint", "policy", "Base", catalog.search_all)
+    assert catalog.loads == 2
+
+
+def test_refresh_on_miss():
+    catalog = Catalog([{"ID": 1, "name": "Base"}])
+    indexes = CatalogIndexes(["policy"], ttl=60, refresh_interval=0.05)
+    assert indexes.lookup("e", "policy", "New", catalog.search_all) == ([], None)
+    assert catalog.loads == 1
+
+    catalog.objects.append({"ID": 2, "name": "New"})
+    assert indexes.lookup("e", "policy", "New", catalog.search_all) == ([], None)
+    assert catalog.loads == 1, "a young index should not be refreshed"
+
+    time.sleep(0.06)
+    assert indexes.lookup("e", "policy", "New", catalog.search_all) == ([2], None)
+    assert catalog.loads == 2
+
+
+def test_ttl():
+    catalog = Catalog([{"ID": 1, "name": "Base"}])
+    indexes = CatalogIndexes(["policy"], ttl=0.05)
+    indexes.lookup("e", "policy", "Base", catalog.search_all)
+    time.sleep(0.06)
+    indexes.lookup("e", "policy", "Base", catalog.search_all)
+    assert catalog.loads == 2
+
+
+def test_error():
+    catalog = Catalog([])
+    indexes = CatalogIndexes(["broken"])
+    ids, err = indexes.lookup("e", "broken", "Base", catalog.search_all)
+    assert ids is None
+    assert err == "search for 'broken' failed with status 500 - oops"
@@ -0,0 +1,139 @@
+import io
+import os
+import gzip
+import json
+import logging
+import asyncio
+import pytest
+from ruamel.yaml import YAML
+import async_client
+import catalog_snapshot
+import search
+from catalog_snapshot import Snapshot, SnapshotWriter
+from stub_api import StubApi
+from template_substitutor import TemplateSubstitutor
+
+
+def export(tmp_path, *args) -> str:
+    path = str(tmp_path / "snapshot.json.gz")
+    with StubApi() as api:
+        api.add("firewallRule", "SMTP Server")
+        api.add("firewallRule", "FTP Server")
+        api.add("firewallRule", "duplicate")
+        api.add("firewallRule", "duplicate")
+        for i in range(12):
+            api.add("intrusionPreventionRule", f"{1000 + i} - Ransomware {i}")
+        api.add("policy", "base")
+        argv = ["export", "--url", f"{api.url}/api", "--api-key", api.api_key]
+        output = io.StringIO()
+        assert search.main(argv + ["--output", path] + list(args), output) == 0
+        assert output.getvalue().startswith("exported 17 objects of ")
+    return path
+
+
+def test_export(tmp_path, caplog):
+    caplog.set_level(logging.INFO)
+    path = export(tmp_path, "--page-size", "5")
+    assert "exported 4 firewallRule" in caplog.messages
+    assert "exported 12 intrusionPreventionRule" in caplog.messages
+    with gzip.open(path, "rt") as file:
+        lines = [json.loads(line) for line in file]
+    assert lines[0]["snapshot"] == 1
+    assert lines[0]["url"].endswith("/api")
+    assert len([line for line in lines if "object" in line]) == 17
+    index = lines[-1]["index"]
+    assert set(search.lookup_types) == set(index.keys())
+    assert index["policy"] == {"base": [17]}
+    assert index["firewallRule"]["duplicate"] == [3, 4]
+
+
+def test_failed_export_leaves_no_snapshot(tmp_path, capsys):
+    path = str(tmp_path / "snapshot.json.gz")
+    with StubApi() as api:
+        api.add("firewallRule", "SMTP Server")
+        api.fail_next("POST", "/api/policies/search", 400)
+        argv = ["export", "--url", f"{api.url}/api", "--api-key", api.api_key]
+        assert search.main(argv + ["--output", path]) == 1
+    assert "status 400" in capsys.readouterr().err
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(IOError):
+        Snapshot.load(path)
+
+
+class FailingClient(object):
+    def __init__(self):
+        self.cancelled = []
+
+    async def search_pages(self, ds_type: str, page_size: int):
+        if ds_type == "policy":
+            raise IOError("search for policy failed")
+        try:
+            while True:
+                await asyncio.sleep(0.01)
+                yield [{"ID": 1, "name": ds_type}]
+        except asyncio.CancelledError:
+            self.cancelled.append(ds_type)
+            raise
+
+
+def test_export_cancels_other_types_on_error(tmp_path):
+    client = FailingClient()
+    writer = SnapshotWriter(str(tmp_path / "snapshot.json.gz"), "http://localhost")
+    with pytest.raises(IOError):
+        async_client.run(
+            catalog_snapshot.export(client, writer, ["firewallRule", "policy"])
+        )
+    writer.abort()
+    assert client.cancelled == ["firewallRule"]
+    assert os.listdir(tmp_path) == []
+
+
+def test_resolve_from_snapshot(tmp_path):
+    snapshot = Snapshot.load(export(tmp_path, "--page-size", "5"))
+    substitutor = TemplateSubstitutor(
+        "http://127.0.0.1:1/api", None, None, snapshot=snapshot
+    )
+    result, errors = substitutor.replace_lookups(
+        {
+            "parentID": '{{lookup "policy" "base"}}',
+            "firewall": {
+                "ruleIDs": [
+                    '{{lookup "firewallRule" "SMTP Server"}}',
+                    '{{lookup "firewallRule" "FTP Server"}}',
+                ]
+            },
+            "intrusionPrevention": {
+                "ruleIDs": ['{{lookupAll "intrusionPreventionRule" "100? - *"}}']
+            },
+        }
+    )
+    assert errors == []
+    assert result["parentID"] == "17"
+    assert result["firewall"]["ruleIDs"] == ["1", "2"]
+    assert result["intrusionPrevention"]["ruleIDs"] == [str(i) for i in range(5, 15)]
+
+    result, errors = substitutor.replace_lookups(
+        [
+            '{{lookup "firewallRule" "duplicate"}}',
+            '{{lookup "firewallRule" "missing"}}',
+            '{{lookup "computerGroup" "all"}}',
+        ]
+    )
+    assert errors == [
+        "expected single firewallRule with name duplicate, found 2",
+        "expected single firewallRule with name missing, found 0",
+        "computerGroup is not in the snapshot",
+    ]
+
+
+def test_resolve_command(tmp_path, capsys):
+    path = export(tmp_path, "--types", "firewallRule,intrusionPreventionRule,policy")
+    template = tmp_path / "value.yaml"
+    template.write_text('ruleIDs:\n  - \'{{lookup "firewallRule" "SMTP Server"}}\'\n')
+    output = io.StringIO()
+    assert search.main(["resolve", "--snapshot", path, str(template)], output) == 0
+    assert YAML().load(output.getvalue()) == {"ruleIDs": ["1"]}
+
+    template.write_text('ruleIDs:\n  - \'{{lookup "firewallRule" "missing"}}\'\n')
+    assert search.main(["resolve", "--snapshot", path, str(template)]) == 1
+    assert "found 0" in capsys.readouterr().err
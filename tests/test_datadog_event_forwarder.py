@@ -11,11 +11,27 @@ from datadog_event_forwarder import tags
 from datadog_event_forwarder import date_happened
 from datadog_event_forwarder import ossec_level_to_log_level
 from datadog_event_forwarder import log_level
+from datadog_event_forwarder import send_datadog_events
+import datadog
+import threading
+import datadog_event_forwarder
+import secret_cache
+import pytest
+from stub_api import StubSSM
+from sample_events import system_event, anti_malware_event
 
 
 logging.basicConfig(level=logging.INFO)
 
 
+@pytest.fixture(autouse=True)
+def ssm_references(monkeypatch):
+    """
+    forgets the parameter references of the environment loaded by other tests.
+    """
+    monkeypatch.setattr(datadog_event_forwarder, "ssm_references", {})
+
+
 def test_load_ssm_parameters():
     name = f"n{uuid.uuid4()}"
     value = f"value for {name}"
@@ -68,6 +84,123 @@ def test_invalid_message():
     handler(event, {})
 
 
+class FakeEvent(object):
+    def __init__(self, fail_titles=()):
+        self.events = []
+        self.fail_titles = fail_titles
+        self.lock = threading.Lock()
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.events.append(kwargs)
+        if kwargs["title"] in self.fail_titles:
+            return {"errors": ["Forbidden"]}
+        return {"status": "ok", "event": {"id": len(self.events)}}
+
+
+def test_send_datadog_events(monkeypatch):
+    fake = FakeEvent(fail_titles=["SystemEvent : failing"])
+    monkeypatch.setattr(datadog.api, "Event", fake)
+    monkeypatch.setenv("DATADOG_TAGS", "")
+
+    failing = dict(system_event[0], Title="failing")
+    messages = [("m1", system_event[0]), ("m2", failing), ("m3", anti_malware_event[0])]
+    result = send_datadog_events(messages)
+    assert result == {"forwarded": ["m1", "m3"], "failed": ["m2"]}
+    assert len(fake.events) == 3
+    assert sorted(e["title"] for e in fake.events) == [
+        "AntiMalwareEvent : message id m3",
+        "SystemEvent : Alert Ended",
+        "SystemEvent : failing",
+    ]
+
+
+class KeyCheckingEvent(FakeEvent):
+    def __init__(self, api_key: str):
+        super(KeyCheckingEvent, self).__init__()
+        self.api_key = api_key
+
+    def create(self, **kwargs):
+        if datadog.api._api_key != self.api_key:
+            return {"errors": ["Forbidden"]}
+        return super(KeyCheckingEvent, self).create(**kwargs)
+
+
+def test_rejected_api_key_is_refreshed(monkeypatch):
+    ssm = StubSSM({"/datadog/api-key": "stale-key"})
+    monkeypatch.setattr(datadog.api, "_api_host", None)
+    monkeypatch.setattr(datadog.api, "_api_key", None)
+    monkeypatch.setattr(datadog.api, "_application_key", None)
+    monkeypatch.setenv("DATADOG_API_KEY", "ssm:///datadog/api-key")
+    monkeypatch.setenv("DATADOG_APP_KEY", "dd-app-key")
+    monkeypatch.setenv("DATADOG_TAGS", "")
+    secret_cache.secrets.invalidate()
+    secret_cache.secrets.ssm = ssm
+    try:
+        datadog_event_forwarder.connect_to_datadog()
+        assert datadog.api._api_key == "stale-key"
+
+        ssm.parameters["/datadog/api-key"] = "rotated-key"
+        fake = KeyCheckingEvent("rotated-key")
+        monkeypatch.setattr(datadog.api, "Event", fake)
+        result = send_datadog_events([("m1", system_event[0]), ("m2", system_event[0])])
+        assert result == {"forwarded": ["m1", "m2"], "failed": []}
+        assert datadog.api._api_key == "rotated-key"
+        assert ssm.calls == 2, "concurrent rejections should share a single reload"
+
+        # a key which is rejected after the reload is not retried again
+        fake.api_key = "other-key"
+        result = send_datadog_events([("m3", system_event[0])])
+        assert result == {"forwarded": [], "failed": ["m3"]}
+        assert ssm.calls == 3
+    finally:
+        secret_cache.secrets.ssm = None
+        secret_cache.secrets.invalidate()
+
+
+def test_send_datadog_events_as_logs(monkeypatch):
+    requests = []
+
+    class Session(object):
+        def post(self, url, headers, json):
+            requests.append((url, headers, json))
+            return type("Response", (), {"status_code": 202, "text": ""})
+
+    monkeypatch.setattr("http_session.session", lambda: Session())
+    monkeypatch.setenv("DATADOG_DELIVERY", "logs")
+    monkeypatch.setenv("DATADOG_SITE", "datadoghq.eu")
+    monkeypatch.setattr(datadog.api, "_api_key", "dd-api-key")
+
+    messages = [(f"m{i}", system_event[0]) for i in range(1500)]
+    result = send_datadog_events(messages)
+    assert len(result["forwarded"]) == 1500
+    assert not result["failed"]
+    assert [len(r[2]) for r in requests] == [1000, 500]
+    assert requests[0][0] == "https://http-intake.logs.datadoghq.eu/api/v2/logs"
+    assert requests[0][1] == {"DD-API-KEY": "dd-api-key"}
+    assert requests[0][2][0]["status"] == "info"
+    assert requests[0][2][0]["hostname"] == system_event[0]["TargetName"]
+
+
+def test_handler_forwards_all_events(monkeypatch):
+    fake = FakeEvent()
+    monkeypatch.setattr(datadog.api, "Event", fake)
+    monkeypatch.setattr(datadog.api, "_api_host", "https://api.datadoghq.com")
+    monkeypatch.setenv("DATADOG_BATCH_SIZE", "2")
+
+    event = sns_event(anti_malware_event)
+    event["Records"].extend(sns_event(system_event)["Records"])
+    event["Records"].extend(sns_event({})["Records"])
+    result = handler(event, {})
+    assert result == {"received": 4, "forwarded": 4, "invalid": 1, "failed": []}
+    assert len(fake.events) == 4
+
+    message_id = event["Records"][0]["Sns"]["MessageId"]
+    assert "AntiMalwareEvent : message id " + message_id + "/0" in [
+        e["title"] for e in fake.events
+    ]
+
+
 def test_tags():
     result = tags("A=1, B=2, D, C=3")
     assert len(result) == 4
@@ -146,83 +279,6 @@ def sns_event(message) -> dict:
     )
 
 
-system_event = [
-    {
-        "ActionBy": "System",
-        "Description": "Alert: New Pattern Update is Downloaded and Available\\nSeverity: Warning\\n",
-        "EventID": 6813,
-        "EventType": "SystemEvent",
-        "LogDate": datetime.now().isoformat(),
-        "ManagerNodeID": 123,
-        "ManagerNodeName": "job7-123",
-        "Number": 192,
-        "Origin": 3,
-        "OriginString": "Manager",
-        "Severity": 1,
-        "SeverityString": "Info",
-        "Tags": "",
-        "TargetID": 1,
-        "TargetName": "ec2-12-123-123-123.us-west-2.compute.amazonaws.com",
-        "TargetType": "Host",
-        "TenantID": 123,
-        "TenantName": "Umbrella Corp.",
-        "Title": "Alert Ended",
-    }
-]
-
-anti_malware_event = [
-    {
-        "AMTargetTypeString": "N/A",
-        "ATSEDetectionLevel": 0,
-        "CreationTime": "2018-12-04T15:57:18.000Z",
-        "EngineType": 1_207_959_848,
-        "EngineVersion": "10.0.0.1040",
-        "ErrorCode": 0,
-        "EventID": 1,
-        "EventType": "AntiMalwareEvent",
-        "HostAgentGUID": "4A5BF25A-4446-DD8B-DFB7-564C275F5F6B",
-        "HostAgentVersion": "11.1.0.163",
-        "HostID": 1,
-        "HostOS": "Amazon Linux (64 bit) (4.14.62-65.117.amzn1.x86_64)",
-        "HostSecurityPolicyID": 3,
-        "HostSecurityPolicyName": "PolicyA",
-        "Hostname": "ec2-12-123-123-123.us-west-2.compute.amazonaws.com",
-        "InfectedFilePath": "/tmp/eicar_1543939038890.txt",
-        "LogDate": datetime.now().isoformat(),
-        "MajorVirusType": 2,
-        "MajorVirusTypeString": "Virus",
-        "MalwareName": "Eicar_test_file",
-        "MalwareType": 1,
-        "ModificationTime": "2018-12-04T15:57:18.000Z",
-        "Origin": 0,
-        "OriginString": "Agent",
-        "PatternVersion": "14.665.00",
-        "Protocol": 0,
-        "Reason": "Default Real-Time Scan Configuration",
-        "ScanAction1": 4,
-        "ScanAction2": 3,
-        "ScanResultAction1": -81,
-        "ScanResultAction2": 0,
-        "ScanResultString": "Quarantined",
-        "ScanType": 0,
-        "ScanTypeString": "Real Time",
-        "Tags": "",
-        "TenantID": 123,
-        "TenantName": "Umbrella Corp.",
-    },
-    {
-        "AMTargetTypeString": "N/A",
-        "ATSEDetectionLevel": 0,
-        "CreationTime": "2018-12-04T15:57:21.000Z",
-    },
-    {
-        "AMTargetTypeString": "N/A",
-        "ATSEDetectionLevel": 0,
-        "CreationTime": "2018-12-04T15:57:29.000Z",
-    },
-]
-
-
 if __name__ == "__main__":
     sns = boto3.client("sns")
     sts = boto3.client("sts")
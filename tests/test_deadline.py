@@ -0,0 +1,93 @@
+import time
+import pytest
+import deadline
+import http_session
+import deep_security_provider
+from deadline import Deadline, DeadlineExceeded
+from stub_api import StubApi
+from conftest import cfn_request
+
+
+class Context(object):
+    def __init__(self, remaining: float):
+        self.expires = time.monotonic() + remaining
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.expires - time.monotonic()) * 1000)
+
+
+def test_no_budget():
+    d = Deadline.from_context({})
+    assert d.remaining == float("inf")
+    assert d.timeout(30) == 30
+    assert d.workers(8, 30) == 8
+    d.check("doing nothing")
+
+
+def test_budget():
+    d = Deadline.from_context(Context(20), reserve=10)
+    assert 9 < d.remaining <= 10
+    assert d.timeout(30) <= 10
+    assert d.timeout(5) == 5
+    assert d.workers(8, 5) == 8
+    assert d.workers(8, 30) == 1
+
+    expired = Deadline(budget=10, reserve=10)
+    with pytest.raises(DeadlineExceeded) as e:
+        expired.timeout(30, "calling the api")
+    assert str(e.value).startswith("deadline exceeded while calling the api, after ")
+
+
+def test_retries_stop_at_deadline():
+    with StubApi() as api:
+        api.fail_next("GET", "/api/policies/1", 503, 503, 503)
+        session = http_session.create_session(retries=3, backoff_factor=0.5)
+        with deadline.invocation(Context(0.6)):
+            deadline.current.reserve = 0
+            start = time.monotonic()
+            response = session.get(f"{api.url}/api/policies/1")
+        # the first retry is immediate, the second would sleep beyond the deadline
+        assert response.status_code == 503
+        assert api.count("GET /api/policies") == 2
+        assert time.monotonic() - start < 0.5
+
+
+def test_no_request_after_deadline():
+    with StubApi() as api:
+        session = http_session.create_session()
+        with deadline.invocation(Context(0)):
+            with pytest.raises(DeadlineExceeded):
+                session.get(f"{api.url}/api/policies/1")
+        assert api.count() == 0
+
+
+@pytest.fixture
+def api(api):
+    api.latency = 0.3
+    return api
+
+
+def test_provider_fails_before_deadline(api, monkeypatch):
+    monkeypatch.setattr(deadline, "reserve", 0.5)
+    names = [f"rule-{i}" for i in range(6)]
+    for name in names:
+        api.add("firewallRule", name)
+    connection = {"URL": f"{api.url}/api", "MaxConcurrentLookups": 1}
+    value = {
+        "name": "my-policy",
+        "firewall": {
+            "ruleIDs": [f'{{{{lookup "firewallRule" "{n}"}}}}' for n in names]
+        },
+    }
+    request = cfn_request(
+        api, "Create", "Policy", {"Connection": connection, "Value": value}
+    )
+
+    start = time.monotonic()
+    response = deep_security_provider.handler(request, Context(1.5))
+    assert time.monotonic() - start < 1.5
+
+    assert response["Status"] == "FAILED"
+    assert "deadline exceeded while calling POST" in response["Reason"]
+    assert api.responses[-1]["Status"] == "FAILED"
+    assert api.count("POST /api/policies") == 0
@@ -0,0 +1,188 @@
+import deep_security_rule_set_provider
+from deep_security_rule_set_provider import DeepSecurityRuleSetProvider
+from conftest import cfn_request
+
+
+def request(api, request_type, values, old_values=None, physical_resource_id=None):
+    return cfn_request(
+        api,
+        request_type,
+        "RuleSet",
+        {"Type": "FirewallRule", "Values": values},
+        {"Values": old_values} if old_values is not None else None,
+        physical_resource_id,
+    )
+
+
+def handle(api, *args, **kwargs):
+    return deep_security_rule_set_provider.handler(request(api, *args, **kwargs), {})
+
+
+def rules(api) -> dict:
+    return {r["name"]: r for r in api.objects["firewallrules"].values()}
+
+
+def rule(name: str, **fields) -> dict:
+    return dict({"name": name, "action": "allow", "priority": "3"}, **fields)
+
+
+def test_create(api):
+    values = [rule(f"rule-{i}") for i in range(5)]
+    response = handle(api, "Create", values)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"].startswith("ruleset-")
+
+    existing = rules(api)
+    assert sorted(existing.keys()) == [f"rule-{i}" for i in range(5)]
+    data = response["Data"]
+    for name, r in existing.items():
+        assert data[name] == str(r["ID"])
+        assert r["priority"] == "3"
+    assert data["IDs"] == ",".join(data[f"rule-{i}"] for i in range(5))
+
+
+def test_create_with_lookups(api):
+    ip_list = api.add("ipList", "office")
+    values = [rule("ssh", sourceIPListID='{{lookup "ipList" "office"}}')]
+    response = handle(api, "Create", values)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert rules(api)["ssh"]["sourceIPListID"] == str(ip_list["ID"])
+
+
+def test_failed_create_is_rolled_back(api):
+    api.fail_next("POST", "/api/firewallrules", 500)
+    values = [rule(f"rule-{i}") for i in range(5)]
+    response = handle(api, "Create", values)
+    assert response["Status"] == "FAILED"
+    assert response["PhysicalResourceId"] == "failed-to-create"
+    assert response["Reason"].startswith("Could not create the FirewallRule")
+    assert rules(api) == {}
+
+    response = handle(
+        api, "Delete", values, physical_resource_id=response["PhysicalResourceId"]
+    )
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert api.count("POST /api/firewallrules/search") == 0
+
+
+def test_duplicate_keys(api):
+    response = handle(api, "Create", [rule("a"), rule("a")])
+    assert response["Status"] == "FAILED"
+    assert response["Reason"] == "duplicate name in 'Values': a"
+    assert api.count("POST /api") == 0
+
+
+def test_invalid_requests(api):
+    response = handle(api, "Create", [])
+    assert response["Status"] == "SUCCESS", response["Reason"]
+
+    create = request(api, "Create", [rule("a")])
+    del create["ResourceProperties"]["Values"]
+    response = deep_security_rule_set_provider.handler(create, {})
+    assert response["Status"] == "FAILED"
+    assert "'Values' is a required property" in response["Reason"]
+
+    create = request(api, "Create", [rule("a")])
+    create["ResourceProperties"]["Connection"]["MaxConcurrentRequests"] = "0"
+    response = deep_security_rule_set_provider.handler(create, {})
+    assert response["Status"] == "FAILED"
+    assert "0 is less than the minimum of 1" in response["Reason"]
+    assert api.count("POST /api") == 0
+
+
+def test_key_cannot_be_changed(api):
+    values = [rule("a", description="rule a")]
+    response = handle(api, "Create", values)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+
+    update = request(api, "Update", values, values, response["PhysicalResourceId"])
+    update["ResourceProperties"]["Key"] = "description"
+    response = deep_security_rule_set_provider.handler(update, {})
+    assert response["Status"] == "FAILED"
+    assert response["Reason"] == (
+        "'Key' cannot be changed from 'name' to 'description', replace the resource instead"
+    )
+    assert len(rules(api)) == 1
+
+
+def test_update(api):
+    old_values = [rule("keep"), rule("change"), rule("remove")]
+    response = handle(api, "Create", old_values)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    physical_resource_id = response["PhysicalResourceId"]
+    ids = response["Data"]
+
+    before = api.count("POST /api/firewallrules/{id}")
+    new_values = [rule("keep"), rule("change", action="deny"), rule("add")]
+    response = handle(api, "Update", new_values, old_values, physical_resource_id)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"] == physical_resource_id
+
+    existing = rules(api)
+    assert sorted(existing.keys()) == ["add", "change", "keep"]
+    assert existing["change"]["action"] == "deny"
+    assert api.count("POST /api/firewallrules/{id}") - before == 1
+    assert response["Data"]["keep"] == ids["keep"]
+    assert response["Data"]["change"] == ids["change"]
+    assert response["Data"]["add"] == str(existing["add"]["ID"])
+
+
+def test_requires_replacement_without_url(api):
+    values = [rule("a")]
+    update = request(api, "Update", values, values, "ruleset-1")
+    for properties in ("ResourceProperties", "OldResourceProperties"):
+        update[properties] = dict(update[properties], Connection={"Version": "v1"})
+
+    provider = DeepSecurityRuleSetProvider()
+    provider.set_request(update, {})
+    assert provider.is_valid_request()
+    assert not provider.requires_replacement()
+
+    update["ResourceProperties"]["Connection"] = {"URL": f"{api.url}/api"}
+    provider.set_request(update, {})
+    assert provider.requires_replacement()
+
+
+def test_large_set_returns_only_ids(api):
+    values = [rule(f"{'a long firewall rule name ' * 4}{i}") for i in range(50)]
+    response = handle(api, "Create", values)
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert list(response["Data"].keys()) == ["IDs"]
+    assert len(response["Data"]["IDs"].split(",")) == 50
+
+
+def test_failed_update_is_rolled_back(api):
+    old_values = [rule("a"), rule("b")]
+    response = handle(api, "Create", old_values)
+    physical_resource_id = response["PhysicalResourceId"]
+
+    api.fail_next("POST", "/api/firewallrules", 500)
+    new_values = [rule("a", action="deny"), rule("b"), rule("c")]
+    response = handle(api, "Update", new_values, old_values, physical_resource_id)
+    assert response["Status"] == "FAILED"
+
+    existing = rules(api)
+    assert sorted(existing.keys()) == ["a", "b"]
+    assert existing["a"]["action"] == "allow"
+
+
+def test_update_recreates_missing(api):
+    values = [rule("a"), rule("b")]
+    response = handle(api, "Create", values)
+    del api.objects["firewallrules"][int(response["Data"]["b"])]
+
+    response = handle(api, "Update", values, values, response["PhysicalResourceId"])
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert sorted(rules(api).keys()) == ["a", "b"]
+
+
+def test_delete(api):
+    api.add("firewallRule", "unrelated")
+    values = [rule(f"rule-{i}") for i in range(3)]
+    response = handle(api, "Create", values)
+
+    response = handle(
+        api, "Delete", values, physical_resource_id=response["PhysicalResourceId"]
+    )
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert list(rules(api).keys()) == ["unrelated"]
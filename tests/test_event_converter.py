@@ -0,0 +1,22 @@
+import json
+
+from datadog_event_forwarder import EventConverter
+from sample_events import events, intrusion_prevention_event, legacy_convert
+
+
+def test_converter_is_equivalent():
+    converter = EventConverter(static_tags="env=prod, team=security")
+    for message_id, message in events:
+        text, tags = legacy_convert(message_id, message, "env=prod, team=security")
+        event = converter.convert(message_id, message)
+        assert event["text"] == text
+        assert event["tags"] == tags
+
+
+def test_json_text():
+    converter = EventConverter(text_format="json")
+    text = converter.convert("m3", intrusion_prevention_event)["text"]
+    fields = json.loads(text)
+    assert fields["Action"] == "Reset"
+    assert "ActionString" not in fields
+    assert "Title" not in fields
@@ -0,0 +1,121 @@
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_session
+from http_session import create_session
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+
+        self.server.requests.append((self.command, self.path, self.client_address))
+        statuses = self.server.statuses.get(self.path, [])
+        status = statuses.pop(0) if statuses else 200
+        body = json.dumps({"status": status}).encode("utf-8")
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", self.server.retry_after)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = respond
+    do_DELETE = respond
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = []
+    server.statuses = {}
+    server.retry_after = "0"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_keep_alive(server):
+    session = create_session(pool_size=1)
+    for _ in range(5):
+        response = session.post(url(server, "/api/policies/search"), json={})
+        assert response.status_code == 200
+    assert len(server.requests) == 5
+    assert len(set(r[2] for r in server.requests)) == 1, "expected a single connection"
+
+
+def test_retry_throttled_post(server):
+    server.statuses["/api/policies"] = [429, 429]
+    session = create_session(retries=3, backoff_factor=0)
+    response = session.post(url(server, "/api/policies"), json={})
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_no_retry_server_error_on_post(server):
+    server.statuses["/api/policies"] = [503]
+    session = create_session(retries=3, backoff_factor=0)
+    response = session.post(url(server, "/api/policies"), json={})
+    assert response.status_code == 503
+    assert len(server.requests) == 1
+
+
+def test_retry_server_error_on_search(server):
+    server.statuses["/api/policies/search"] = [503, 500]
+    session = create_session(retries=3, backoff_factor=0)
+    response = session.post(url(server, "/api/policies/search"), json={})
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_retry_server_error_on_delete(server):
+    server.statuses["/api/policies/1"] = [503, 502]
+    session = create_session(retries=3, backoff_factor=0)
+    response = session.delete(url(server, "/api/policies/1"))
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+
+
+def test_retries_exhausted(server):
+    server.statuses["/api/policies"] = [429, 429, 429]
+    session = create_session(retries=1, backoff_factor=0)
+    response = session.post(url(server, "/api/policies"), json={})
+    assert response.status_code == 429
+    assert len(server.requests) == 2
+
+
+def test_retry_after(server):
+    server.statuses["/api/policies"] = [429]
+    server.retry_after = "0.5"
+    session = create_session(retries=3, backoff_factor=0)
+    start = time.monotonic()
+    response = session.post(url(server, "/api/policies"), json={})
+    assert response.status_code == 200
+    assert time.monotonic() - start >= 0.5
+    assert len(server.requests) == 2
+
+    limiter = session.limiters.get(f"127.0.0.1:{server.server_address[1]}")
+    assert limiter.concurrency < 10
+    assert limiter.active == 0
+
+
+def test_shared_session():
+    assert http_session.session() is http_session.session()
@@ -0,0 +1,251 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import lookup_cache
+import deep_security_provider
+import deep_security_rule_set_provider
+from lookup_cache import LookupCache, SingleFlight, endpoint_key
+from template_substitutor import TemplateSubstitutor
+from deep_security_lookup_provider import DeepSecurityLookupProvider
+from conftest import cfn_request
+
+
+def lookup_request(api, name) -> dict:
+    return cfn_request(api, "Create", "Lookup", {"Type": "firewallRule", "Name": name})
+
+
+def test_ttl():
+    cache = LookupCache(ttl=0.05, max_size=10)
+    cache.put(("e", "policy", "Base"), 1)
+    assert cache.get(("e", "policy", "Base")) == 1
+    time.sleep(0.06)
+    assert cache.get(("e", "policy", "Base")) is None
+    assert cache.stats == {"size": 0, "hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_lru_eviction():
+    cache = LookupCache(ttl=60, max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None, "least recently used entry should be evicted"
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats["evictions"] == 1
+
+
+def test_endpoint_key():
+    url = "https://app.deepsecurity.trendmicro.com/api"
+    assert endpoint_key(url, "key-1", "v1") == endpoint_key(url, "key-1", "v1")
+    assert endpoint_key(url, "key-1", "v1") != endpoint_key(url, "key-2", "v1")
+    assert "key-1" not in endpoint_key(url, "key-1", "v1")
+
+
+class CountingSubstitutor(TemplateSubstitutor):
+    def __init__(self, api_key="api-key"):
+        super(CountingSubstitutor, self).__init__(
+            "https://localhost/api", api_key, "v1"
+        )
+        self.calls = 0
+
+    def _search_lookup(self, ds_type, name):
+        self.calls += 1
+        return ([] if name == "Missing" else [42]), None
+
+
+def test_substitutor_uses_cache():
+    lookup_cache.cache.invalidate()
+    lookup_cache.negative_cache.invalidate()
+    value = [
+        '{{lookup "firewallRule" "FTP Server"}}',
+        '{{lookup "firewallRule" "Missing"}}',
+    ]
+
+    misses = lookup_cache.cache.stats["misses"]
+    negative_misses = lookup_cache.negative_cache.stats["misses"]
+    first = CountingSubstitutor()
+    result, err = first.replace_lookups(list(value))
+    assert len(err) == 1
+    assert result == ["42", value[1]]
+    assert first.calls == 2
+    assert lookup_cache.cache.stats["misses"] - misses == 2
+    assert lookup_cache.negative_cache.stats["misses"] - negative_misses == 2
+
+    second = CountingSubstitutor()
+    result, err = second.replace_lookups(list(value[0:1]))
+    assert not err, err
+    assert result == ["42"]
+    assert second.calls == 0, "resolved lookups should be served from the cache"
+
+    other_tenant = CountingSubstitutor(api_key="other-key")
+    other_tenant.replace_lookups(list(value[0:1]))
+    assert other_tenant.calls == 1
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    started = threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return 42
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        first = executor.submit(flights.do, ("e", "policy", "Base"), slow)
+        started.wait()
+        others = [
+            executor.submit(flights.do, ("e", "policy", "Base"), slow) for _ in range(7)
+        ]
+        results = [first.result()] + [f.result() for f in others]
+
+    assert results == [42] * 8
+    assert len(calls) == 1
+    assert flights.coalesced == 7
+    assert not flights.flights
+
+    # once the flight has landed, the next call executes again
+    assert flights.do(("e", "policy", "Base"), slow) == 42
+    assert len(calls) == 2
+
+
+def test_single_flight_error():
+    flights = SingleFlight()
+
+    def fail():
+        raise IOError("connection refused")
+
+    with pytest.raises(IOError):
+        flights.do(("e", "policy", "Base"), fail)
+    assert not flights.flights
+
+
+@pytest.fixture
+def api(api):
+    api.latency = 0.1
+    return api
+
+
+def test_concurrent_substitutors_share_a_search(api):
+    api.add("firewallRule", "SMTP Server")
+
+    def replace(_):
+        substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+        return substitutor.replace_lookups(['{{lookup "firewallRule" "SMTP Server"}}'])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(replace, range(8)))
+
+    assert results == [(["1"], [])] * 8
+    assert api.count("POST /api/firewallrules/search") == 1
+
+
+def test_failed_lookups_are_cached(api, monkeypatch):
+    api.add("firewallRule", "SMTP Server")
+    api.add("firewallRule", "SMTP Server")
+    value = [
+        '{{lookup "firewallRule" "SMTP Server"}}',
+        '{{lookup "firewallRule" "Missing"}}',
+    ]
+    errors = [
+        "expected single firewallRule with name SMTP Server, found 2",
+        "expected single firewallRule with name Missing, found 0",
+    ]
+    for _ in range(3):
+        substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+        result, err = substitutor.replace_lookups(value)
+        assert result == value
+        assert err == errors
+    assert api.count("POST /api/firewallrules/search") == 2
+
+    monkeypatch.setattr(lookup_cache.negative_cache, "ttl", 0.05)
+    lookup_cache.negative_cache.invalidate()
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    substitutor.replace_lookups(value)
+    time.sleep(0.06)
+    substitutor.replace_lookups(value)
+    assert api.count("POST /api/firewallrules/search") == 6
+
+
+def test_failed_transport_is_not_cached(api):
+    api.fail_next("POST", "/api/firewallrules/search", 404, 404)
+    api.add("firewallRule", "SMTP Server")
+    value = ['{{lookup "firewallRule" "SMTP Server"}}']
+
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    result, err = substitutor.replace_lookups(value)
+    assert len(err) == 1
+    result, err = substitutor.replace_lookups(value)
+    assert len(err) == 1
+    result, err = substitutor.replace_lookups(value)
+    assert result == ["1"]
+
+
+def test_lookup_provider_coalesces_and_caches_failures(api):
+    api.add("firewallRule", "SMTP Server")
+
+    def handle(name):
+        provider = DeepSecurityLookupProvider()
+        return provider.handle(lookup_request(api, name), {})
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(handle, ["SMTP Server"] * 4))
+    assert [r["PhysicalResourceId"] for r in responses] == ["1"] * 4
+    assert api.count("POST /api/firewallrules/search") == 1
+
+    for _ in range(3):
+        response = handle("Missing")
+        assert response["Status"] == "FAILED"
+        assert response["Reason"] == "expected precisely 1 result, got 0"
+    assert api.count("POST /api/firewallrules/search") == 2
+
+
+def test_cached_failures_are_reported_per_call_site(api):
+    response = DeepSecurityLookupProvider().handle(lookup_request(api, "Missing"), {})
+    assert response["Reason"] == "expected precisely 1 result, got 0"
+
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    _, err = substitutor.replace_lookups(['{{lookup "firewallRule" "Missing"}}'])
+    assert err == ["expected single firewallRule with name Missing, found 0"]
+    assert api.count("POST /api/firewallrules/search") == 1
+
+
+def test_created_objects_are_found_by_lookups(api):
+    api.add("ipList", "existing")
+    value = ['{{lookup "ipList" "existing"}}', '{{lookup "ipList" "new-list"}}']
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    _, err = substitutor.replace_lookups(value)
+    assert err == ["expected single ipList with name new-list, found 0"]
+
+    request = cfn_request(api, "Create", "IpList", {"Value": {"name": "new-list"}})
+    response = deep_security_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    list_id = response["PhysicalResourceId"]
+    result, err = substitutor.replace_lookups(value)
+    assert not err, err
+    assert result[1] == list_id
+
+    request = cfn_request(api, "Delete", "IpList", {"Value": {}}, None, list_id)
+    response = deep_security_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    _, err = substitutor.replace_lookups(value)
+    assert err == ["expected single ipList with name new-list, found 0"]
+
+
+def test_rule_set_objects_are_found_by_lookups(api):
+    value = ['{{lookup "firewallRule" "new-rule"}}']
+    substitutor = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    _, err = substitutor.replace_lookups(value)
+    assert err == ["expected single firewallRule with name new-rule, found 0"]
+
+    properties = {"Type": "FirewallRule", "Values": [{"name": "new-rule"}]}
+    request = cfn_request(api, "Create", "RuleSet", properties)
+    response = deep_security_rule_set_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    result, err = substitutor.replace_lookups(value)
+    assert not err, err
+    assert result == [response["Data"]["new-rule"]]
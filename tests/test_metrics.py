@@ -0,0 +1,102 @@
+import io
+import json
+import metrics
+import deep_security_provider
+from metrics import Metrics
+from conftest import cfn_request
+
+
+def test_emf():
+    m = Metrics("test", Service="unit", ResourceType=None)
+    with m.timer("Api"):
+        pass
+    with m.timer("Api"):
+        pass
+    m.add("ApiBytesSent", 100, "Bytes")
+    m.add("ApiBytesSent", 20, "Bytes")
+    m.add("Retries")
+
+    output = io.StringIO()
+    m.emit(output)
+    lines = output.getvalue().splitlines()
+    assert len(lines) == 1
+    emf = json.loads(lines[0])
+
+    directive = emf["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "test"
+    assert directive["Dimensions"] == [["Service"]]
+    assert {m["Name"]: m["Unit"] for m in directive["Metrics"]} == {
+        "ApiTime": "Milliseconds",
+        "ApiCalls": "Count",
+        "ApiBytesSent": "Bytes",
+        "Retries": "Count",
+    }
+    assert emf["Service"] == "unit"
+    assert "ResourceType" not in emf
+    assert emf["ApiCalls"] == 2
+    assert emf["ApiBytesSent"] == 120
+    assert emf["Retries"] == 1
+    assert emf["ApiTime"] >= 0
+    assert isinstance(emf["_aws"]["Timestamp"], int)
+
+
+def test_invocation_emits_one_line(capsys):
+    with metrics.invocation("unit", ResourceType="Custom::Test"):
+        metrics.add("Things", 3)
+        with metrics.timer("Work"):
+            pass
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    emf = json.loads(lines[0])
+    assert emf["Service"] == "unit"
+    assert emf["ResourceType"] == "Custom::Test"
+    assert emf["Things"] == 3
+    assert emf["WorkCalls"] == 1
+    assert emf["InvocationCalls"] == 1
+
+
+def test_invocation_disabled(capsys, monkeypatch):
+    monkeypatch.setattr(metrics, "namespace", "")
+    with metrics.invocation("unit"):
+        metrics.add("Things")
+    assert capsys.readouterr().out == ""
+
+
+def test_provider_phases(api, capsys):
+    api.add("firewallRule", "SMTP Server")
+    api.add("firewallRule", "FTP Server")
+    api.fail_next("POST", "/api/firewallrules/search", 429)
+    connection = {"URL": f"{api.url}/api", "MaxConcurrentLookups": 1}
+    value = {
+        "name": "my-policy",
+        "firewall": {
+            "ruleIDs": [
+                '{{lookup "firewallRule" "SMTP Server"}}',
+                '{{lookup "firewallRule" "FTP Server"}}',
+                '{{lookup "firewallRule" "SMTP Server"}}',
+            ]
+        },
+    }
+    request = cfn_request(
+        api, "Create", "Policy", {"Connection": connection, "Value": value}
+    )
+    capsys.readouterr()
+    response = deep_security_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    emf = json.loads(lines[0])
+    assert emf["Service"] == "DeepSecurityProvider"
+    assert emf["ResourceType"] == "Custom::DeepSecurityPolicy"
+    assert emf["SsmCalls"] == 1
+    assert emf["SecretCacheMisses"] == 1
+    assert emf["LookupCacheMisses"] == 2
+    assert emf["SearchCalls"] == 2
+    assert emf["SearchBytes"] > 0
+    assert emf["Retries"] == 1
+    assert emf["LookupsCalls"] == 1
+    assert emf["ApiCalls"] == 1
+    assert emf["ApiBytesSent"] > 0
+    assert emf["ApiBytesReceived"] > 0
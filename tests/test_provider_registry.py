@@ -0,0 +1,31 @@
+from benchmark import import_profile
+from provider import provider_module
+
+
+def test_provider_module():
+    assert (
+        provider_module("Custom::DeepSecurityLookup").__name__
+        == "deep_security_lookup_provider"
+    )
+    assert (
+        provider_module("Custom::DeepSecurityAWSCloudAccount").__name__
+        == "deep_security_aws_cloudaccount_provider"
+    )
+    assert (
+        provider_module("Custom::DeepSecuritySystemSetting").__name__
+        == "deep_security_system_settings_provider"
+    )
+    assert (
+        provider_module("Custom::DeepSecurityRuleSet").__name__
+        == "deep_security_rule_set_provider"
+    )
+    assert (
+        provider_module("Custom::DeepSecurityPolicy").__name__
+        == "deep_security_provider"
+    )
+
+
+def test_startup_imports_no_providers():
+    profile = import_profile("provider")
+    assert profile["providers"] == [], "providers should be imported on first use"
+    assert profile["cumulative_us"] > 0
@@ -0,0 +1,98 @@
+import deep_security_provider
+import deep_security_system_settings_provider
+from conftest import cfn_request
+
+
+def test_unchanged_update_is_skipped(api):
+    rule = api.add("firewallRule", "SMTP Server")
+    policy = api.add("policy", "my-policy")
+    value = {
+        "name": "my-policy",
+        "firewall": {"ruleIDs": ['{{lookup "firewallRule" "SMTP Server"}}']},
+    }
+    update = cfn_request(
+        api, "Update", "Policy", {"Value": value}, {}, str(policy["ID"])
+    )
+
+    before = api.count("POST /api")
+    response = deep_security_provider.handler(update, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"] == str(policy["ID"])
+    assert api.count("POST /api") == before
+    assert "firewall" not in api.objects["policies"][policy["ID"]]
+    assert rule["ID"]
+
+
+def test_unchanged_update_ignores_type_conversion(api):
+    rule = api.add("firewallRule", "my-rule")
+    value = {"name": "my-rule", "priority": 2, "enabled": True}
+    old_value = {"name": "my-rule", "priority": "2", "enabled": "true"}
+    update = cfn_request(
+        api,
+        "Update",
+        "FirewallRule",
+        {"Value": value},
+        {"Value": old_value},
+        str(rule["ID"]),
+    )
+
+    response = deep_security_provider.handler(update, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert api.count("POST /api") == 0
+
+
+def test_changed_update_is_sent(api):
+    policy = api.add("policy", "my-policy", description="old")
+    update = cfn_request(
+        api,
+        "Update",
+        "Policy",
+        {"Value": {"name": "my-policy", "description": "new"}},
+        {"Value": {"name": "my-policy", "description": "old"}},
+        str(policy["ID"]),
+    )
+
+    response = deep_security_provider.handler(update, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert api.count("POST /api/policies/{id}") == 1
+    assert api.objects["policies"][policy["ID"]]["description"] == "new"
+
+
+def test_partial_update_sends_changed_fields(api):
+    rule = api.add("firewallRule", "SMTP Server")
+    policy = api.add("policy", "my-policy", description="old")
+    old_value = {
+        "name": "my-policy",
+        "description": "old",
+        "firewall": {"ruleIDs": ['{{lookup "firewallRule" "SMTP Server"}}']},
+    }
+    value = dict(old_value, description="new")
+    update = cfn_request(
+        api,
+        "Update",
+        "Policy",
+        {"Value": value, "PartialUpdate": "true"},
+        {"Value": old_value},
+        str(policy["ID"]),
+    )
+
+    response = deep_security_provider.handler(update, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    # the unchanged lookup is not resolved, and only the description is sent
+    assert api.count("POST /api/firewallrules/search") == 0
+    assert api.count("POST /api/policies/{id}") == 1
+    assert api.objects["policies"][policy["ID"]] == {
+        "name": "my-policy",
+        "description": "new",
+        "ID": policy["ID"],
+    }
+    assert rule["ID"]
+
+
+def test_system_settings_unchanged_update_is_skipped(api):
+    value = {"platformSettingDemoModeEnabled": {"value": "false"}}
+    update = cfn_request(api, "Update", "SystemSetting", {"Value": value}, {}, "global")
+
+    response = deep_security_system_settings_provider.handler(update, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert api.count("POST /api") == 0
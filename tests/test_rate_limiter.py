@@ -0,0 +1,123 @@
+import time
+import threading
+from email.utils import formatdate
+
+import pytest
+
+import deadline
+from deadline import Deadline, DeadlineExceeded
+from rate_limiter import AdaptiveLimiter, Limiters, TokenBucket, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("-1") == 0
+    assert parse_retry_after("soon") is None
+    assert 8 < parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.take() == 0
+    assert bucket.take() == 0
+    assert bucket.take() == pytest.approx(0.1, abs=0.01)
+    assert bucket.take() == pytest.approx(0.2, abs=0.01)
+
+
+def test_rate_limit():
+    limiter = AdaptiveLimiter(rate=20, burst=1, max_concurrency=4)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.release(limiter.acquire(), throttled=False)
+    assert 0.15 < time.monotonic() - start < 0.5
+
+
+def test_aimd():
+    limiter = AdaptiveLimiter(rate=40, burst=10000, max_concurrency=8)
+    started = [limiter.acquire() for _ in range(4)]
+    for s in started:
+        limiter.release(s, throttled=True)
+    # concurrent throttled requests count as a single decrease
+    assert limiter.concurrency == 4
+    assert limiter.rate == 20
+
+    limiter.release(limiter.acquire(), throttled=True)
+    assert limiter.concurrency == 2
+    assert limiter.rate == 10
+
+    for _ in range(4):
+        limiter.release(limiter.acquire(), throttled=False)
+    assert 3 < limiter.concurrency < 4
+    assert 10 < limiter.rate < 11
+
+    for _ in range(2000):
+        limiter.release(limiter.acquire(), throttled=False)
+    assert limiter.concurrency == 8
+    assert limiter.rate == 40
+
+
+def test_concurrency_limit():
+    limiter = AdaptiveLimiter(rate=1000, burst=1000, max_concurrency=2)
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def request():
+        started = limiter.acquire()
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.pop()
+        limiter.release(started, throttled=False)
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 2
+
+
+def test_retry_after_pauses_host():
+    limiter = AdaptiveLimiter(rate=1000, burst=1000, max_concurrency=4)
+    limiter.release(limiter.acquire(), throttled=True, retry_after=0.3)
+    start = time.monotonic()
+    limiter.release(limiter.acquire(), throttled=False)
+    assert 0.25 < time.monotonic() - start < 0.6
+
+
+def test_pause_beyond_deadline():
+    limiter = AdaptiveLimiter()
+    limiter.release(limiter.acquire(), throttled=True, retry_after=30)
+    try:
+        deadline.current = Deadline(budget=5, reserve=0)
+        with pytest.raises(DeadlineExceeded):
+            limiter.acquire("calling the api")
+    finally:
+        deadline.current = Deadline()
+    assert limiter.active == 0
+
+
+def test_token_beyond_deadline():
+    limiter = AdaptiveLimiter(rate=1, burst=1, max_concurrency=4)
+    limiter.release(limiter.acquire(), throttled=True)
+    try:
+        deadline.current = Deadline(budget=1, reserve=0)
+        with pytest.raises(DeadlineExceeded):
+            limiter.acquire("calling the api")
+    finally:
+        deadline.current = Deadline()
+    # a request which was not sent does not raise the limits
+    assert limiter.active == 0
+    assert limiter.rate == 0.5
+    assert limiter.concurrency == 2
+
+
+def test_limiter_per_host():
+    limiters = Limiters()
+    assert limiters.get("a.example.com") is limiters.get("a.example.com")
+    assert limiters.get("a.example.com") is not limiters.get("b.example.com")
@@ -0,0 +1,88 @@
+import pytest
+import secret_cache
+import rest_session
+import deep_security_aws_cloudaccount_provider
+from conftest import cfn_request
+
+
+@pytest.fixture
+def api(api):
+    secret_cache.secrets.ssm.parameters.update(
+        {
+            "/cfn-deep-security-provider/user": "user",
+            "/cfn-deep-security-provider/password": "password",
+            "/cfn-deep-security-provider/tenant": "tenant",
+        }
+    )
+    rest_session.sessions.close()
+    try:
+        yield api
+    finally:
+        rest_session.sessions.close()
+        rest_session.sessions.ttl = 600
+
+
+def request(api, request_type, physical_resource_id=None) -> dict:
+    return cfn_request(
+        api,
+        request_type,
+        "AWSCloudAccount",
+        {
+            "Connection": {"URL": f"{api.url}/rest"},
+            "AWSAccountRequest": {"useInstanceRole": True},
+        },
+        physical_resource_id=physical_resource_id,
+    )
+
+
+def handle(api, request_type, physical_resource_id=None):
+    response = deep_security_aws_cloudaccount_provider.handler(
+        request(api, request_type, physical_resource_id), {}
+    )
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    return response["PhysicalResourceId"]
+
+
+def test_session_is_reused(api):
+    ids = [handle(api, "Create") for _ in range(5)]
+    handle(api, "Update", ids[0])
+    handle(api, "Delete", ids[0])
+
+    assert api.count("POST /rest/authentication/login") == 1
+    assert api.count("DELETE /rest/authentication/logout") == 0
+    assert len(api.sessions) == 1
+
+    rest_session.sessions.close()
+    assert api.count("DELETE /rest/authentication/logout") == 1
+    assert not api.sessions
+
+
+def test_login_after_rejected_session(api):
+    physical_resource_id = handle(api, "Create")
+    api.expire_sessions()
+
+    handle(api, "Update", physical_resource_id)
+    assert api.count("POST /rest/authentication/login") == 2
+    assert api.count("POST /rest/cloudaccounts/aws/{id}/update") == 2
+
+
+def test_logout_on_expiry(api):
+    rest_session.sessions.ttl = 0
+    handle(api, "Create")
+    handle(api, "Create")
+
+    assert api.count("POST /rest/authentication/login") == 2
+    assert api.count("DELETE /rest/authentication/logout") == 2
+    assert not api.sessions
+
+
+def test_failed_login(api):
+    api.fail_next("POST", "/rest/authentication/login", 401, 401)
+    response = deep_security_aws_cloudaccount_provider.handler(
+        request(api, "Create"), {}
+    )
+    assert response["Status"] == "FAILED"
+    assert response["Reason"].startswith("login failed with status code 401")
+    assert response["PhysicalResourceId"] == "failed-to-create"
+    assert api.count("POST /rest/cloudaccounts/aws") == 0
+    assert not rest_session.sessions.sessions
@@ -0,0 +1,122 @@
+import io
+import json
+import pytest
+from ruamel.yaml import YAML
+import search
+
+
+@pytest.fixture
+def api(api):
+    for i in range(25):
+        api.add("firewallRule", f"rule-{i}", action="allow" if i % 2 else "deny")
+    return api
+
+
+def run(api, *args) -> str:
+    output = io.StringIO()
+    argv = ["--url", f"{api.url}/api", "--api-key", api.api_key, "--type"]
+    assert search.main(argv + list(args), output) == 0
+    return output.getvalue()
+
+
+def test_max_items(api):
+    results = YAML().load(run(api, "firewallRule", "--max-items", "5"))
+    assert [r["name"] for r in results] == [f"rule-{i}" for i in range(5)]
+
+
+def test_all_ndjson(api):
+    output = run(
+        api, "firewallRule", "--all", "--page-size", "10", "--output-format", "ndjson"
+    )
+    lines = output.splitlines()
+    assert [json.loads(line)["name"] for line in lines] == [
+        f"rule-{i}" for i in range(25)
+    ]
+    assert api.count("POST /api/firewallrules/search") == 3
+
+
+def test_all_json_with_prefetch(api):
+    output = run(
+        api,
+        "firewallRule",
+        "--all",
+        "--page-size",
+        "5",
+        "--prefetch",
+        "--output-format",
+        "json",
+        "--query",
+        'action == "deny"',
+    )
+    results = json.loads(output)
+    assert [r["name"] for r in results] == [f"rule-{i}" for i in range(0, 25, 2)]
+    assert api.count("POST /api/firewallrules/search") == 3
+
+
+def test_all_yaml(api):
+    results = YAML().load(run(api, "firewallRule", "--all", "--page-size", "7"))
+    assert len(results) == 25
+
+
+def test_empty_results(api):
+    assert json.loads(run(api, "policy", "--all", "--output-format", "json")) == []
+    assert YAML().load(run(api, "policy")) == []
+
+
+def test_failed_search(api, capsys):
+    argv = ["--url", f"{api.url}/api", "--api-key", "wrong", "--type", "policy"]
+    assert search.main(argv + ["--all"], io.StringIO()) == 1
+    assert "failed with status 401" in capsys.readouterr().err
+
+
+def test_client_side_filter(api):
+    output = run(
+        api,
+        "firewallRule",
+        "--output-format",
+        "ndjson",
+        "--page-size",
+        "10",
+        "--max-items",
+        "3",
+        "--query",
+        'action == "allow" and name > "rule-2"',
+    )
+    names = [json.loads(line)["name"] for line in output.splitlines()]
+    assert names == ["rule-3", "rule-5", "rule-7"]
+    # the search stops once enough records were found
+    assert api.count("POST /api/firewallrules/search") == 1
+
+
+def test_sort(api):
+    output = run(
+        api,
+        "firewallRule",
+        "--all",
+        "--output-format",
+        "ndjson",
+        "--query",
+        'name prefix "rule-1" sort by name desc',
+    )
+    names = [json.loads(line)["name"] for line in output.splitlines()]
+    assert names == sorted([f"rule-{i}" for i in [1] + list(range(10, 20))])[::-1]
+
+    output = run(
+        api,
+        "firewallRule",
+        "--all",
+        "--page-size",
+        "10",
+        "--output-format",
+        "ndjson",
+        "--query",
+        "ID <= 12 sort by ID desc",
+    )
+    ids = [json.loads(line)["ID"] for line in output.splitlines()]
+    assert ids == list(range(12, 0, -1))
+
+
+def test_invalid_query(api, capsys):
+    with pytest.raises(SystemExit):
+        run(api, "firewallRule", "--query", 'name = "x"')
+    assert "invalid query" in capsys.readouterr().err
@@ -0,0 +1,103 @@
+import pytest
+from search_query import Predicate, QueryError, compile_query
+
+
+def test_equal_string():
+    query = compile_query('name == "SMTP Server"')
+    assert query.search() == {
+        "searchCriteria": [
+            {"fieldName": "name", "stringTest": "equal", "stringValue": "SMTP Server"}
+        ]
+    }
+    assert query.pushed_down
+
+
+def test_pushed_down_clauses():
+    query = compile_query(
+        'name != "x" and priority >= 2 and ID > 100 and enabled == true '
+        'and templateType != false and name like "HTTP*" and description prefix "abc" '
+        "sort by ID desc"
+    )
+    assert query.pushed_down
+    assert query.search() == {
+        "searchCriteria": [
+            {"fieldName": "name", "stringTest": "not-equal", "stringValue": "x"},
+            {
+                "fieldName": "priority",
+                "numericTest": "greater-than-or-equal",
+                "numericValue": 2,
+            },
+            {"fieldName": "ID", "idTest": "greater-than", "idValue": 100},
+            {"fieldName": "enabled", "booleanValue": True},
+            {"fieldName": "templateType", "booleanValue": True},
+            {"fieldName": "name", "stringWildcards": True, "stringValue": "HTTP%"},
+            {
+                "fieldName": "description",
+                "stringWildcards": True,
+                "stringValue": "abc%",
+            },
+        ],
+        "sortByObjectID": True,
+        "sortDescending": True,
+    }
+
+
+def test_client_side_predicates():
+    query = compile_query(
+        'name > "M" and firewall.state == "on" and name prefix "a_b" sort by name desc'
+    )
+    assert not query.pushed_down
+    assert query.search() == {
+        "searchCriteria": [
+            {"fieldName": "name", "stringWildcards": True, "stringValue": "a_b%"}
+        ]
+    }
+    assert [f.operator for f in query.filters] == [">", "==", "prefix"]
+    assert query.matches({"name": "a_b c", "firewall": {"state": "on"}})
+    assert not query.matches({"name": "axb c", "firewall": {"state": "on"}})
+    assert not query.matches({"name": "a_b c", "firewall": {"state": "off"}})
+    assert not query.matches({"name": "a_b c"})
+
+    records = [{"name": "b"}, {"ID": 1}, {"name": "c"}, {"name": "a"}]
+    assert query.sort(records) == [
+        {"name": "c"},
+        {"name": "b"},
+        {"name": "a"},
+        {"ID": 1},
+    ]
+
+
+def test_matches():
+    assert compile_query("priority < 3").pushed_down
+    assert compile_query('name like "*Server?"').pushed_down
+
+    assert Predicate("name", "like", "%Server_").matches({"name": "SMTP Servers"})
+    assert not Predicate("name", "like", "%Server_").matches({"name": "SMTP Server"})
+    assert Predicate("priority", "<", 3).matches({"priority": 2})
+    assert not Predicate("priority", "<", 3).matches({"priority": "2"})
+    assert not Predicate("priority", "<", 3).matches({})
+    assert Predicate("enabled", "!=", True).matches({})
+
+
+def test_string_escapes():
+    query = compile_query(r'name == "say \"hi\""')
+    assert query.criteria[0]["stringValue"] == 'say "hi"'
+
+
+@pytest.mark.parametrize(
+    "text, message",
+    [
+        ('name = "x"', "unexpected input at position 5"),
+        ('name == "x" or id == 1', "expected and, found 'or'"),
+        ('name == "x" and', "expected a clause after and"),
+        ("name ==", "unexpected end of query"),
+        ("name == value", "expected string or number or boolean, found 'value'"),
+        ("name like 3", "expected string, found '3'"),
+        ('name == "x" sort name', "expected by after sort"),
+        ('name == "x" sort by name up', "unexpected 'up' at the end of the query"),
+    ],
+)
+def test_invalid(text, message):
+    with pytest.raises(QueryError) as e:
+        compile_query(text)
+    assert str(e.value).startswith(message)
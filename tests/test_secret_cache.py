@@ -0,0 +1,152 @@
+import time
+import pytest
+import secret_cache
+import deep_security_provider
+import deep_security_lookup_provider
+from botocore.exceptions import ClientError
+from secret_cache import SecretCache, ParameterNotFound
+from datadog_event_forwarder import load_ssm_parameters
+from conftest import cfn_request
+
+
+class FakeSSM(object):
+    def __init__(self, parameters: dict, denied=()):
+        self.parameters = parameters
+        self.denied = denied
+        self.calls = []
+
+    def get_parameters(self, Names, WithDecryption):
+        assert WithDecryption
+        assert len(Names) <= 10
+        self.calls.append(Names)
+        if any(n in self.denied for n in Names):
+            raise ClientError(
+                {"Error": {"Code": "AccessDeniedException", "Message": "denied"}},
+                "GetParameters",
+            )
+        return {
+            "Parameters": [
+                {"Name": n, "Value": self.parameters[n]}
+                for n in Names
+                if n in self.parameters
+            ],
+            "InvalidParameters": [n for n in Names if n not in self.parameters],
+        }
+
+
+def test_get_many_batches():
+    ssm = FakeSSM({f"/p/{i}": f"v{i}" for i in range(25)})
+    cache = SecretCache(ttl=60)
+    cache.ssm = ssm
+    names = [f"/p/{i}" for i in range(25)] + ["/p/missing"]
+    values = cache.get_many(names)
+    assert values == {f"/p/{i}": f"v{i}" for i in range(25)}
+    assert len(ssm.calls) == 3
+
+    assert cache.get_many(names[0:25]) == values
+    assert len(ssm.calls) == 3, "all values should be cached"
+    assert cache.hits == 25
+
+
+def test_get():
+    ssm = FakeSSM({"/api_key": "secret"})
+    cache = SecretCache(ttl=60)
+    cache.ssm = ssm
+    assert cache.get("/api_key") == "secret"
+    assert cache.get("/api_key") == "secret"
+    assert len(ssm.calls) == 1
+    with pytest.raises(ParameterNotFound):
+        cache.get("/missing")
+
+
+def test_denied_parameter_does_not_fail_the_batch():
+    ssm = FakeSSM({"/api_key": "secret", "/other": "other"}, denied=["/other"])
+    cache = SecretCache(ttl=60)
+    cache.ssm = ssm
+    assert cache.get_many(["/api_key", "/other", "/missing"]) == {"/api_key": "secret"}
+    assert ssm.calls == [
+        ["/api_key", "/other", "/missing"],
+        ["/api_key"],
+        ["/other"],
+        ["/missing"],
+    ]
+    with pytest.raises(ParameterNotFound):
+        cache.get("/other")
+
+
+def test_ttl_and_invalidate():
+    ssm = FakeSSM({"/api_key": "secret"})
+    cache = SecretCache(ttl=0.05)
+    cache.ssm = ssm
+    cache.get("/api_key")
+    time.sleep(0.06)
+    cache.get("/api_key")
+    assert len(ssm.calls) == 2
+
+    ssm.parameters["/api_key"] = "rotated"
+    cache.invalidate(["/api_key"])
+    assert cache.get("/api_key") == "rotated"
+    assert len(ssm.calls) == 3
+
+
+def test_load_ssm_parameters():
+    ssm = FakeSSM({"/datadog/api-key": "dd-api-key", "/datadog/app-key": "dd-app-key"})
+    secret_cache.secrets.invalidate()
+    secret_cache.secrets.ssm = ssm
+    try:
+        env = {
+            "DATADOG_API_KEY": "ssm:///datadog/api-key",
+            "DATADOG_APP_KEY": "ssm:///datadog/app-key",
+            "DATADOG_TAGS": "ssm:///datadog/tags?default=env=test",
+            "DATADOG_HOST": "ssm:///datadog/host",
+            "LOG_LEVEL": "INFO",
+        }
+        load_ssm_parameters(env)
+        assert env == {
+            "DATADOG_API_KEY": "dd-api-key",
+            "DATADOG_APP_KEY": "dd-app-key",
+            "DATADOG_TAGS": "env=test",
+            "DATADOG_HOST": "ssm:///datadog/host",
+            "LOG_LEVEL": "INFO",
+        }
+        assert len(ssm.calls) == 1
+    finally:
+        secret_cache.secrets.invalidate()
+        secret_cache.secrets.ssm = None
+
+
+def rotate_api_key(api):
+    """
+    caches a stale API key, and stores the key of the stub API in the parameter store.
+    """
+    name = "/cfn-deep-security-provider/api_key"
+    secret_cache.secrets.ssm.parameters[name] = "stale-api-key"
+    assert secret_cache.secrets.get(name) == "stale-api-key"
+    secret_cache.secrets.ssm.parameters[name] = api.api_key
+
+
+def test_lookups_refresh_rotated_api_key(api):
+    rule = api.add("firewallRule", "SMTP Server")
+    rotate_api_key(api)
+    value = {
+        "name": "my-policy",
+        "firewall": {"ruleIDs": ['{{lookup "firewallRule" "SMTP Server"}}']},
+    }
+    request = cfn_request(api, "Create", "Policy", {"Value": value})
+    response = deep_security_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    policy = api.objects["policies"][int(response["PhysicalResourceId"])]
+    assert policy["firewall"]["ruleIDs"] == [str(rule["ID"])]
+    assert api.count("POST /api/firewallrules/search") == 2
+    assert secret_cache.secrets.ssm.calls == 2
+
+
+def test_lookup_provider_refreshes_rotated_api_key(api):
+    rule = api.add("firewallRule", "SMTP Server")
+    rotate_api_key(api)
+    request = cfn_request(
+        api, "Create", "Lookup", {"Type": "firewallRule", "Name": "SMTP Server"}
+    )
+    response = deep_security_lookup_provider.handler(request, {})
+    assert response["Status"] == "SUCCESS", response["Reason"]
+    assert response["PhysicalResourceId"] == str(rule["ID"])
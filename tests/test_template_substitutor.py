@@ -1,7 +1,13 @@
 import pytest
 import re
+import json
+import threading
+import time
 import boto3
 import logging
+import lookup_cache
+import catalog_index
+from async_client import ApiClient
 from template_substitutor import TemplateSubstitutor
 
 
@@ -77,3 +83,318 @@ def test_nested_array(expander):
         assert re.fullmatch(r"[0-9]+", v), f"expected integer at offset {i}, got '{v}'"
     for k, v in result["mail"].items():
         assert re.fullmatch(r"[0-9]+", v), f"expected integer in field {k}, got '{v}'"
+
+
+class StubSubstitutor(TemplateSubstitutor):
+    def __init__(self, ids: dict, max_workers=8, batch_threshold=100):
+        super(StubSubstitutor, self).__init__(
+            "https://localhost/api",
+            "api-key",
+            "v1",
+            max_workers,
+            batch_threshold=batch_threshold,
+        )
+        lookup_cache.cache.invalidate()
+        lookup_cache.negative_cache.invalidate()
+        catalog_index.indexes.invalidate()
+        self.ids = ids
+        self.calls = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def _do_uncached_lookup(self, ds_type, name):
+        with self.lock:
+            self.calls.append((ds_type, name))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(0.01)
+            if (ds_type, name) in self.ids:
+                return self.ids[(ds_type, name)], None
+            return None, f"expected single {ds_type} with name {name}, found 0"
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def test_collect_references():
+    expander = StubSubstitutor({})
+    d = {
+        "a": ['{{lookup "firewallRule" "FTP Server"}}', 1, True, None],
+        "b": {
+            "c": '{{lookup "firewallRule" "SMTP Server"}}|{{lookup "policy" "Base"}}'
+        },
+        "d": '{{lookup "firewallRule" "FTP Server"}}',
+    }
+    assert expander.collect_references(d) == [
+        ("firewallRule", "FTP Server"),
+        ("firewallRule", "SMTP Server"),
+        ("policy", "Base"),
+    ]
+
+
+def test_concurrent_lookups():
+    ids = {("intrusionPreventionRule", f"rule {i}"): i for i in range(40)}
+    expander = StubSubstitutor(ids, max_workers=4)
+    rule_ids = [
+        f'{{{{lookup "intrusionPreventionRule" "rule {i}"}}}}' for i in range(40)
+    ]
+    result, err = expander.replace_lookups({"ruleIDs": rule_ids + rule_ids})
+    assert not err, err
+    assert result["ruleIDs"] == [str(i) for i in range(40)] * 2
+    assert len(expander.calls) == 40, "each unique reference is looked up once"
+    assert 1 < expander.max_active <= 4
+
+
+def test_concurrent_lookup_errors():
+    ids = {("firewallRule", "FTP Server"): 10}
+    expander = StubSubstitutor(ids)
+    value = {
+        "ok": '{{lookup "firewallRule" "FTP Server"}}',
+        "missing": [
+            '{{lookup "firewallRule" "Missing"}}',
+            '{{lookup "firewallRule" "FTP Server"}}|{{lookup "directory" "Missing"}}',
+        ],
+    }
+    result, err = expander.replace_lookups(value)
+    assert err == [
+        "expected single firewallRule with name Missing, found 0",
+        "expected single directory with name Missing, found 0",
+    ]
+    assert result["ok"] == "10"
+    assert result["missing"] == value["missing"]
+
+
+class CatalogClient(ApiClient):
+    """
+    serves the /search API from an in-memory catalog of objects.
+    """
+
+    def __init__(self, catalog: dict):
+        super(CatalogClient, self).__init__("https://localhost/api", "api-key")
+        self.catalog = catalog
+        self.searches = []
+        self.lock = threading.Lock()
+
+    def find(self, ds_type, search):
+        with self.lock:
+            self.searches.append((ds_type, json.loads(json.dumps(search))))
+        results = sorted(self.catalog.get(ds_type, []), key=lambda r: r["ID"])
+        for criterium in search.get("searchCriteria", []):
+            if criterium.get("idTest") == "greater-than":
+                results = [r for r in results if r["ID"] > criterium["idValue"]]
+            elif criterium.get("fieldName") == "name":
+                results = [r for r in results if r["name"] == criterium["stringValue"]]
+        return results[0 : search.get("maxItems", 5000)], None
+
+
+class CatalogSubstitutor(StubSubstitutor):
+    def __init__(self, catalog: dict, batch_threshold=3, page_size=2, batch_limit=10):
+        super(CatalogSubstitutor, self).__init__({}, batch_threshold=batch_threshold)
+        self.page_size = page_size
+        self.batch_limit = batch_limit
+        self.client = CatalogClient(catalog)
+
+    def _do_uncached_lookup(self, ds_type, name):
+        return TemplateSubstitutor._do_uncached_lookup(self, ds_type, name)
+
+
+def test_batch_lookups():
+    catalog = {
+        "firewallRule": [{"ID": i, "name": f"rule {i}"} for i in range(1, 8)]
+        + [{"ID": 8, "name": "rule 1"}],
+        "policy": [{"ID": 1, "name": "Base"}],
+    }
+    expander = CatalogSubstitutor(catalog)
+    value = {
+        "firewall": {
+            "ruleIDs": [
+                '{{lookup "firewallRule" "rule 2"}}',
+                '{{lookup "firewallRule" "rule 3"}}',
+                '{{lookup "firewallRule" "rule 7"}}',
+            ]
+        },
+        "duplicate": '{{lookup "firewallRule" "rule 1"}}',
+        "missing": '{{lookup "firewallRule" "rule 9"}}',
+        "parentID": '{{lookup "policy" "Base"}}',
+    }
+    result, err = expander.replace_lookups(value)
+    assert err == [
+        "expected single firewallRule with name rule 1, found 2",
+        "expected single firewallRule with name rule 9, found 0",
+    ]
+    assert result["firewall"]["ruleIDs"] == ["2", "3", "7"]
+    assert result["parentID"] == "1"
+
+    # names without a single match in the index are searched by name
+    firewall_searches = [s for t, s in expander.client.searches if t == "firewallRule"]
+    assert firewall_searches[0] == {"maxItems": 11, "sortByObjectID": True}
+    assert sorted(
+        s["searchCriteria"][0]["stringValue"] for s in firewall_searches[1:]
+    ) == [
+        "rule 1",
+        "rule 9",
+    ]
+    assert len([t for t, s in expander.client.searches if t == "policy"]) == 1
+
+    # the index of the small type is reused by subsequent lookups
+    searches = len(expander.client.searches)
+    rule_ids = [f'{{{{lookup "firewallRule" "rule {i}"}}}}' for i in (4, 5, 6)]
+    result, err = expander.replace_lookups(rule_ids)
+    assert not err, err
+    assert result == ["4", "5", "6"]
+    assert len(expander.client.searches) == searches
+
+
+def test_batch_finds_objects_created_after_the_index():
+    catalog = {"firewallRule": [{"ID": i, "name": f"rule {i}"} for i in range(1, 5)]}
+    expander = CatalogSubstitutor(catalog)
+    rule_ids = [f'{{{{lookup "firewallRule" "rule {i}"}}}}' for i in (1, 2, 3)]
+    result, err = expander.replace_lookups(rule_ids)
+    assert not err, err
+
+    catalog["firewallRule"].extend({"ID": i, "name": f"rule {i}"} for i in (5, 6))
+    rule_ids = [f'{{{{lookup "firewallRule" "rule {i}"}}}}' for i in (4, 5, 6)]
+    expander.resolved = {}
+    result, err = expander.replace_lookups(rule_ids)
+    assert not err, err
+    assert result == ["4", "5", "6"]
+
+    # the name is cached, not the miss of the index
+    expander.resolved = {}
+    result, err = expander.replace_lookups(['{{lookup "firewallRule" "rule 5"}}'])
+    assert not err, err
+    assert result == ["5"]
+
+
+def test_large_types_are_searched_by_name():
+    catalog = {
+        "firewallRule": [{"ID": i, "name": f"rule {i}"} for i in range(1, 9)],
+    }
+    expander = CatalogSubstitutor(catalog, batch_limit=5)
+    for names in [(1, 2, 3), (4, 5, 6)]:
+        rule_ids = [f'{{{{lookup "firewallRule" "rule {i}"}}}}' for i in names]
+        result, err = expander.replace_lookups(rule_ids)
+        assert not err, err
+        assert result == [str(i) for i in names]
+
+    searches = [s for _, s in expander.client.searches]
+    assert searches[0] == {"maxItems": 6, "sortByObjectID": True}
+    assert len(searches) == 7, "the size of a large type is probed once"
+
+
+def test_copy_on_write():
+    ids = {("firewallRule", "FTP Server"): 10}
+    expander = StubSubstitutor(ids)
+    value = {
+        "name": "policy",
+        "firewall": {
+            "state": "on",
+            "ruleIDs": [1, '{{lookup "firewallRule" "FTP Server"}}'],
+        },
+        "intrusionPrevention": {"state": "off", "ruleIDs": [1, 2, 3]},
+    }
+    original = json.loads(json.dumps(value))
+    result, err = expander.replace_lookups(value)
+    assert not err, err
+    assert value == original, "the value should not be modified"
+    assert result["firewall"]["ruleIDs"] == [1, "10"]
+    assert result is not value
+    assert result["firewall"] is not value["firewall"]
+    assert result["intrusionPrevention"] is value["intrusionPrevention"]
+
+    result, err = expander.replace_lookups(value["intrusionPrevention"])
+    assert result is value["intrusionPrevention"], "unchanged values are not copied"
+
+
+def test_partial_failure_in_container():
+    ids = {("firewallRule", "FTP Server"): 10}
+    expander = StubSubstitutor(ids)
+    value = {
+        "ruleIDs": [
+            '{{lookup "firewallRule" "FTP Server"}}',
+            '{{lookup "firewallRule" "Missing"}}',
+        ]
+    }
+    result, err = expander.replace_lookups(value)
+    assert err == ["expected single firewallRule with name Missing, found 0"]
+    assert result["ruleIDs"] == ["10", '{{lookup "firewallRule" "Missing"}}']
+
+
+def test_lookup_all(api):
+    ids = [
+        api.add("intrusionPreventionRule", name)["ID"]
+        for name in [
+            "1000001 - Identified Possible Ransomware File Rename Activity",
+            "1000002 - Identified Possible Ransomware File Extension",
+            "1000003 - Identified Possible Ransomware_Activity",
+            "1000004 - Identified Possible Ransomwar",
+            "1000005 - SMTP Server",
+        ]
+    ]
+    expander = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1", page_size=2)
+    value = {
+        "intrusionPrevention": {
+            "ruleIDs": [
+                1,
+                '{{lookupAll "intrusionPreventionRule" "* - Identified Possible Ransomware *"}}',
+                '{{lookup "intrusionPreventionRule" "1000005 - SMTP Server"}}',
+            ]
+        }
+    }
+    result, err = expander.replace_lookups(value)
+    assert not err, err
+    assert result["intrusionPrevention"]["ruleIDs"] == [
+        1,
+        f"{ids[0]}",
+        f"{ids[1]}",
+        f"{ids[4]}",
+    ]
+    assert api.count("POST /api/intrusionpreventionrules/search") == 3
+
+    # the results are cached
+    result, err = expander.replace_lookups(value)
+    assert api.count("POST /api/intrusionpreventionrules/search") == 3
+
+
+def test_lookup_all_pattern_is_literal(api):
+    api.add("firewallRule", "rule_1")
+    api.add("firewallRule", "ruleX1")
+    api.add("firewallRule", "rule 100%")
+    expander = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+
+    result, err = expander.replace_lookups(['{{lookupAll "firewallRule" "rule_?"}}'])
+    assert not err, err
+    assert result == ["1"]
+
+    result, err = expander.replace_lookups(['{{lookupAll "firewallRule" "rule 1%"}}'])
+    assert err == ["no firewallRule found with a name matching rule 1%"]
+
+
+def test_lookup_all_errors(api):
+    api.add("firewallRule", "rule 1")
+    expander = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    value = {
+        "ruleIDs": ['{{lookupAll "firewallRule" "missing*"}}', 2],
+        "ruleID": '{{lookupAll "firewallRule" "rule*"}}',
+    }
+    result, err = expander.replace_lookups(value)
+    assert err == [
+        "no firewallRule found with a name matching missing*",
+        'lookupAll can only be used as an element of a list, {{lookupAll "firewallRule" "rule*"}}',
+    ]
+    assert result == value
+
+
+def test_lookup_all_from_catalog_index(api):
+    policies = [
+        api.add("policy", name)["ID"] for name in ["Linux", "Linux Web", "Windows"]
+    ]
+    expander = TemplateSubstitutor(f"{api.url}/api", api.api_key, "v1")
+    result, err = expander.replace_lookups(
+        ['{{lookupAll "policy" "Linux*"}}', '{{lookupAll "policy" "*"}}']
+    )
+    assert not err, err
+    assert result == [str(i) for i in policies[0:2] + policies]
+    assert api.count("POST /api/policies/search") == 1